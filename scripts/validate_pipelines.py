@@ -11,10 +11,16 @@ import jsonschema
 import yaml
 
 
-def validate_yaml_file(yaml_file, schema):
+def validate_yaml_file(yaml_file, schemas):
     with open(yaml_file, "r") as file:
         pipeline = yaml.safe_load(file)
 
+    major = str(pipeline.get("version", "1.0")).split(".")[0]
+    schema = schemas.get(major)
+    if schema is None:
+        print(f"Validation failed for {yaml_file}: unknown version {major}")
+        return False
+
     try:
         validate(instance=pipeline, schema=schema)
         print(f"Validation successful for {yaml_file}.")
@@ -25,9 +31,11 @@ def validate_yaml_file(yaml_file, schema):
 
 
 def main():
-    schema_path = "src/instructlab/sdg/pipelines/schema/v1.json"
-    with open(schema_path, "r") as file:
-        schema = json.load(file)
+    schemas = {}
+    for schema_path in glob.glob("src/instructlab/sdg/pipelines/schema/v*.json"):
+        major = schema_path.rsplit("/v", 1)[1].split(".")[0]
+        with open(schema_path, "r") as file:
+            schemas[major] = json.load(file)
 
     yaml_files = glob.glob("src/instructlab/sdg/pipelines/**/*.yaml", recursive=True)
     yaml_files.extend(glob.glob("docs/examples/**/pipeline.yaml", recursive=True))
@@ -36,7 +44,7 @@ def main():
         print("=======================================================")
         print("=== Validating", yaml_file)
         print("=======================================================")
-        if not validate_yaml_file(yaml_file, schema):
+        if not validate_yaml_file(yaml_file, schemas):
             all_valid = False
 
     return 1 if not all_valid else 0
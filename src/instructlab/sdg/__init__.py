@@ -1,10 +1,16 @@
 # SPDX-License-Identifier: Apache-2.0
 
-# NOTE: This package imports Torch and other heavy packages.
+# The public names are imported on first use through __getattr__, so that
+# importing the package, or only the pipeline and blocks, does not pay for
+# generate_data and the heavy packages it needs (docling, torch,
+# transformers, GitPython, ...).
 __all__ = (
+    "AsyncClientPool",
+    "AutoTuner",
     "Block",
     "BlockConfigParserError",
     "BlockRegistry",
+    "ClientPool",
     "CombineColumnsBlock",
     "ConditionalLLMBlock",
     "DuplicateColumnsBlock",
@@ -13,6 +19,7 @@ __all__ = (
     "FilterByValueBlockError",
     "FlattenColumnsBlock",
     "GenerateException",
+    "HedgePolicy",
     "IterBlock",
     "LLMBlock",
     "LLMLogProbBlock",
@@ -21,11 +28,18 @@ __all__ = (
     "PipelineBlockError",
     "PipelineConfigParserError",
     "PipelineContext",
+    "PipelineEstimate",
+    "PipelineProfiler",
     "PromptRegistry",
+    "RateLimiter",
     "RenameColumnsBlock",
+    "ResponseCache",
+    "RetryPolicy",
     "SamplePopulatorBlock",
     "SelectorBlock",
     "SetToMajorityValueBlock",
+    "SQLiteResponseCache",
+    "WorkQueue",
     "FULL_PIPELINES_PACKAGE",
     "SIMPLE_PIPELINES_PACKAGE",
     "LLAMA_PIPELINES_PKG",
@@ -33,36 +47,124 @@ __all__ = (
     "mix_datasets",
 )
 
-# Local
-from .blocks.block import Block, BlockConfigParserError
-from .blocks.filterblock import FilterByValueBlock, FilterByValueBlockError
-from .blocks.iterblock import IterBlock
-from .blocks.llmblock import (
-    ConditionalLLMBlock,
-    LLMBlock,
-    LLMLogProbBlock,
-    LLMMessagesBlock,
-)
-from .blocks.utilblocks import (
-    CombineColumnsBlock,
-    DuplicateColumnsBlock,
-    FlattenColumnsBlock,
-    RenameColumnsBlock,
-    SamplePopulatorBlock,
-    SelectorBlock,
-    SetToMajorityValueBlock,
-)
-from .generate_data import generate_data, mix_datasets
-from .pipeline import (
-    FULL_PIPELINES_PACKAGE,
-    LLAMA_PIPELINES_PKG,
-    SIMPLE_PIPELINES_PACKAGE,
-    EmptyDatasetError,
-    Pipeline,
-    PipelineBlockError,
-    PipelineConfigParserError,
-    PipelineContext,
-)
-from .registry import BlockRegistry, PromptRegistry
-from .utils import GenerateException
-from .utils.taxonomy import TaxonomyReadingException
+# Standard
+from typing import TYPE_CHECKING
+import importlib
+import sys
+import types
+
+# The module each public name is defined in, relative to this package
+_LAZY_IMPORTS = {
+    "AutoTuner": ".autotune",
+    "Block": ".blocks.block",
+    "BlockConfigParserError": ".blocks.block",
+    "AsyncClientPool": ".clientpool",
+    "ClientPool": ".clientpool",
+    "FilterByValueBlock": ".blocks.filterblock",
+    "FilterByValueBlockError": ".blocks.filterblock",
+    "IterBlock": ".blocks.iterblock",
+    "ConditionalLLMBlock": ".blocks.llmblock",
+    "LLMBlock": ".blocks.llmblock",
+    "LLMLogProbBlock": ".blocks.llmblock",
+    "LLMMessagesBlock": ".blocks.llmblock",
+    "CombineColumnsBlock": ".blocks.utilblocks",
+    "DuplicateColumnsBlock": ".blocks.utilblocks",
+    "FlattenColumnsBlock": ".blocks.utilblocks",
+    "RenameColumnsBlock": ".blocks.utilblocks",
+    "SamplePopulatorBlock": ".blocks.utilblocks",
+    "SelectorBlock": ".blocks.utilblocks",
+    "SetToMajorityValueBlock": ".blocks.utilblocks",
+    "PipelineEstimate": ".estimate",
+    "HedgePolicy": ".hedging",
+    "generate_data": ".generate_data",
+    "mix_datasets": ".generate_data",
+    "FULL_PIPELINES_PACKAGE": ".pipeline",
+    "LLAMA_PIPELINES_PKG": ".pipeline",
+    "SIMPLE_PIPELINES_PACKAGE": ".pipeline",
+    "EmptyDatasetError": ".pipeline",
+    "Pipeline": ".pipeline",
+    "PipelineBlockError": ".pipeline",
+    "PipelineConfigParserError": ".pipeline",
+    "PipelineContext": ".pipeline",
+    "PipelineProfiler": ".profiling",
+    "RateLimiter": ".ratelimit",
+    "RetryPolicy": ".ratelimit",
+    "BlockRegistry": ".registry",
+    "PromptRegistry": ".registry",
+    "ResponseCache": ".response_cache",
+    "SQLiteResponseCache": ".response_cache",
+    "GenerateException": ".utils",
+    "TaxonomyReadingException": ".utils.taxonomy",
+    "WorkQueue": ".workqueue",
+}
+
+
+def __getattr__(name):
+    module = _LAZY_IMPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module, __name__), name)
+    # Cache the value so __getattr__ is only called once per name
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_IMPORTS))
+
+
+class _Package(types.ModuleType):
+    def __setattr__(self, name, value):
+        # Once a submodule is loaded, the import system sets it as an
+        # attribute of this package. For instructlab.sdg.generate_data that
+        # would hide the generate_data function exported here.
+        if name == "generate_data" and isinstance(value, types.ModuleType):
+            value = value.generate_data
+        super().__setattr__(name, value)
+
+
+sys.modules[__name__].__class__ = _Package
+
+
+if TYPE_CHECKING:
+    # Local
+    from .autotune import AutoTuner
+    from .blocks.block import Block, BlockConfigParserError
+    from .blocks.filterblock import FilterByValueBlock, FilterByValueBlockError
+    from .blocks.iterblock import IterBlock
+    from .blocks.llmblock import (
+        ConditionalLLMBlock,
+        LLMBlock,
+        LLMLogProbBlock,
+        LLMMessagesBlock,
+    )
+    from .blocks.utilblocks import (
+        CombineColumnsBlock,
+        DuplicateColumnsBlock,
+        FlattenColumnsBlock,
+        RenameColumnsBlock,
+        SamplePopulatorBlock,
+        SelectorBlock,
+        SetToMajorityValueBlock,
+    )
+    from .clientpool import AsyncClientPool, ClientPool
+    from .estimate import PipelineEstimate
+    from .generate_data import generate_data, mix_datasets
+    from .hedging import HedgePolicy
+    from .pipeline import (
+        FULL_PIPELINES_PACKAGE,
+        LLAMA_PIPELINES_PKG,
+        SIMPLE_PIPELINES_PACKAGE,
+        EmptyDatasetError,
+        Pipeline,
+        PipelineBlockError,
+        PipelineConfigParserError,
+        PipelineContext,
+    )
+    from .profiling import PipelineProfiler
+    from .ratelimit import RateLimiter, RetryPolicy
+    from .registry import BlockRegistry, PromptRegistry
+    from .response_cache import ResponseCache, SQLiteResponseCache
+    from .utils import GenerateException
+    from .utils.taxonomy import TaxonomyReadingException
+    from .workqueue import WorkQueue
@@ -0,0 +1,253 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Optional
+import logging
+import statistics
+import threading
+import time
+
+# Third Party
+import openai
+
+logger = logging.getLogger(__name__)
+
+
+def is_throttled(err: Exception) -> bool:
+    """Whether an exception means the LLM server asked us to slow down"""
+    if isinstance(err, openai.RateLimitError):
+        return True
+    return isinstance(err, openai.APIStatusError) and err.status_code in (429, 503)
+
+
+# This is part of the public API.
+class AutoTuner:  # pylint: disable=too-many-instance-attributes
+    """
+    Adjusts the batch size and number of concurrent batches of a pipeline at
+    runtime, based on how the LLM server is coping with the current load.
+
+    LLM blocks report the latency and outcome of every request they make.
+    Every `window` requests, the tuner looks at what happened and adjusts
+    using additive-increase/multiplicative-decrease (AIMD):
+
+    - Any throttling (429/503) or an error rate above `max_error_rate`
+      halves both the batch size and the number of workers.
+    - A mean latency above `latency_tolerance` times the best latency seen
+      so far means the server is queueing requests, so one worker is
+      removed.
+    - Otherwise the server has room to spare, so one worker is added and
+      the batch size grows by `batch_size_step`.
+
+    A pipeline seeds the tuner with the batch_size and batch_num_workers of
+    its PipelineContext, unless the tuner was given its own. Without a number
+    of workers from either, calibration picks one.
+
+    Args:
+        batch_size: The initial number of samples per batch.
+        num_workers: The initial number of batches processed concurrently.
+        min_batch_size / max_batch_size: Bounds for the batch size.
+        min_workers / max_workers: Bounds for the number of workers.
+        batch_size_step: How much to grow the batch size on each increase.
+        window: The number of requests between adjustments.
+        max_error_rate: The fraction of failed requests in a window above
+            which the tuner backs off.
+        latency_tolerance: How much slower than the baseline a window may
+            be before the tuner considers the server saturated.
+        probe_requests: The number of requests sent at each concurrency
+            level during calibration. Set to 0 to skip calibration.
+    """
+
+    # The starting point when neither the tuner nor the pipeline was given one
+    DEFAULT_BATCH_SIZE = 8
+    DEFAULT_NUM_WORKERS = 4
+
+    def __init__(
+        self,
+        batch_size: Optional[int] = None,
+        num_workers: Optional[int] = None,
+        min_batch_size: int = 1,
+        max_batch_size: int = 64,
+        min_workers: int = 1,
+        max_workers: int = 64,
+        batch_size_step: int = 1,
+        window: int = 16,
+        max_error_rate: float = 0.05,
+        latency_tolerance: float = 2.0,
+        probe_requests: int = 4,
+    ) -> None:
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.batch_size_step = batch_size_step
+        self.window = window
+        self.max_error_rate = max_error_rate
+        self.latency_tolerance = latency_tolerance
+        self.probe_requests = probe_requests
+        self.calibrated = False
+        self.baseline_latency: Optional[float] = None
+        self._batch_size: Optional[int] = None
+        self._num_workers: Optional[int] = None
+        self._lock = threading.Lock()
+        self.seed(batch_size, num_workers)
+        self._window_start = time.monotonic()
+        self._latencies: list[float] = []
+        self._errors = 0
+        self._throttled = 0
+
+    @property
+    def batch_size(self) -> int:
+        if self._batch_size is None:
+            return self._clamp(
+                self.DEFAULT_BATCH_SIZE, self.min_batch_size, self.max_batch_size
+            )
+        return self._batch_size
+
+    @property
+    def num_workers(self) -> int:
+        if self._num_workers is None:
+            return self._clamp(
+                self.DEFAULT_NUM_WORKERS, self.min_workers, self.max_workers
+            )
+        return self._num_workers
+
+    def seed(self, batch_size: Optional[int], num_workers: Optional[int]) -> None:
+        """Start from batch_size and num_workers, where the tuner has no
+        starting point yet
+        """
+        with self._lock:
+            if batch_size and self._batch_size is None:
+                self._batch_size = self._clamp(
+                    batch_size, self.min_batch_size, self.max_batch_size
+                )
+            if num_workers and self._num_workers is None:
+                self._num_workers = self._clamp(
+                    num_workers, self.min_workers, self.max_workers
+                )
+
+    def record_request(
+        self, latency: float, error: bool = False, throttled: bool = False
+    ) -> None:
+        """Record the outcome of a single LLM request"""
+        with self._lock:
+            self._latencies.append(latency)
+            self._errors += int(error)
+            self._throttled += int(throttled)
+            if len(self._latencies) >= self.window:
+                self._adjust()
+
+    @contextmanager
+    def observe(self):
+        """Time the LLM request made inside this context and record it"""
+        start = time.monotonic()
+        try:
+            yield
+        except Exception as err:
+            self.record_request(
+                time.monotonic() - start, error=True, throttled=is_throttled(err)
+            )
+            raise
+        self.record_request(time.monotonic() - start)
+
+    def calibrate(self, probe: Callable[[], None]) -> None:
+        """
+        Find a starting number of workers before the run begins by sending
+        `probe_requests` requests at doubling levels of concurrency. The
+        baseline latency is measured with one request at a time, and the
+        highest concurrency that stays within `latency_tolerance` of it
+        becomes the starting point. A number of workers the tuner was given
+        or seeded with is kept, and only the baseline latency is measured.
+
+        Args:
+            probe: Sends one small request to the LLM server.
+        """
+        self.calibrated = True
+        if self.probe_requests <= 0:
+            return
+
+        def timed_probe():
+            start = time.monotonic()
+            probe()
+            return time.monotonic() - start
+
+        concurrency = 1
+        chosen = self.min_workers
+        max_concurrency = 1 if self._num_workers is not None else self.max_workers
+        try:
+            while concurrency <= max_concurrency:
+                num_probes = self.probe_requests * concurrency
+                with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                    latencies = list(
+                        executor.map(lambda _: timed_probe(), range(num_probes))
+                    )
+                latency = statistics.mean(latencies)
+                if self.baseline_latency is None:
+                    self.baseline_latency = latency
+                elif latency > self.baseline_latency * self.latency_tolerance:
+                    break
+                chosen = concurrency
+                concurrency *= 2
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            logger.warning(f"Calibration probe failed, keeping defaults: {err}")
+            return
+
+        with self._lock:
+            if self._num_workers is None:
+                self._num_workers = self._clamp(
+                    chosen, self.min_workers, self.max_workers
+                )
+        logger.info(
+            "Calibrated auto-tuning: baseline latency %.3fs, starting with %s workers and batch size %s",
+            self.baseline_latency,
+            self.num_workers,
+            self.batch_size,
+        )
+
+    def _adjust(self) -> None:
+        # From here on the tuner has a batch size and number of workers of
+        # its own
+        self._batch_size = self.batch_size
+        self._num_workers = self.num_workers
+        num_requests = len(self._latencies)
+        mean_latency = statistics.mean(self._latencies)
+        elapsed = time.monotonic() - self._window_start
+        error_rate = self._errors / num_requests
+
+        if self.baseline_latency is None or mean_latency < self.baseline_latency:
+            self.baseline_latency = mean_latency
+
+        if self._throttled or error_rate > self.max_error_rate:
+            self._num_workers = max(self.min_workers, self._num_workers // 2)
+            self._batch_size = max(self.min_batch_size, self._batch_size // 2)
+            reason = "backing off"
+        elif mean_latency > self.baseline_latency * self.latency_tolerance:
+            self._num_workers = max(self.min_workers, self._num_workers - 1)
+            reason = "server saturated"
+        else:
+            self._num_workers = min(self.max_workers, self._num_workers + 1)
+            self._batch_size = min(
+                self.max_batch_size, self._batch_size + self.batch_size_step
+            )
+            reason = "ramping up"
+
+        logger.debug(
+            "Auto-tuning (%s): %.1f req/s, mean latency %.3fs, error rate %.2f, throttled %s -> %s workers, batch size %s",
+            reason,
+            num_requests / elapsed if elapsed > 0 else 0,
+            mean_latency,
+            error_rate,
+            self._throttled,
+            self._num_workers,
+            self._batch_size,
+        )
+
+        self._window_start = time.monotonic()
+        self._latencies = []
+        self._errors = 0
+        self._throttled = 0
+
+    @staticmethod
+    def _clamp(value: int, lower: int, upper: int) -> int:
+        return max(lower, min(upper, value))
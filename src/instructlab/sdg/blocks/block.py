@@ -2,16 +2,19 @@
 
 # Standard
 from abc import ABC
+from concurrent.futures import Executor
 from typing import Any, Dict, Union
+import asyncio
 import logging
 import os.path
 
 # Third Party
 from jinja2 import Template, UndefinedError
-import yaml
 
 # Local
+from ..estimate import BlockEstimate, EstimateOptions
 from ..registry import BlockRegistry
+from ..utils.config import load_yaml
 
 logger = logging.getLogger(__name__)
 
@@ -19,11 +22,67 @@ logger = logging.getLogger(__name__)
 # This is part of the public API.
 @BlockRegistry.register("Block")
 class Block(ABC):
+    """
+    Base class of all pipeline blocks.
+
+    A Pipeline instantiates each of its blocks once and shares that instance
+    between every batch, including batches processed concurrently by worker
+    threads or on an event loop. Any state set up in __init__ must therefore
+    be treated as read-only by generate and agenerate, with per-call state
+    kept in local variables.
+    """
+
     def __init__(self, ctx, pipe, block_name: str) -> None:
         self.ctx = ctx
         self.pipe = pipe
         self.block_name = block_name
 
+    async def agenerate(self, samples):
+        """
+        Generate the output from the block with asyncio. Blocks that do not
+        wait on the network have no reason to override this, so by default
+        the synchronous generate runs in the default executor of the loop.
+        """
+        return await asyncio.to_thread(self.generate, samples)
+
+    def estimate(
+        self,
+        samples,
+        rows: float,
+        options: EstimateOptions,  # pylint: disable=unused-argument
+    ) -> tuple[Any, BlockEstimate]:
+        """
+        Predict the cost of running this block over `rows` rows, from a
+        non-empty sample of them, for Pipeline.estimate. Returns the sample
+        the next block should see along with the estimate.
+
+        By default the block runs over the sample, which suits blocks that
+        only transform columns. Blocks that send requests to the LLM server
+        must override this to count their requests instead of sending them,
+        unless options.pilot is set.
+        """
+        output = self.generate(samples)  # pylint: disable=no-member
+        return output, BlockEstimate.measured(self, rows, len(samples), len(output))
+
+    def _run_cpu_bound(self, fn, *args):
+        """
+        Run CPU-heavy work on the cpu_executor of the PipelineContext if one
+        is configured, or inline otherwise. When the executor is a process
+        pool, fn and args are pickled, so fn should be a method of this block
+        or a module-level function.
+        """
+        executor = getattr(self.ctx, "cpu_executor", None)
+        if isinstance(executor, Executor):
+            return executor.submit(fn, *args).result()
+        return fn(*args)
+
+    async def _arun_cpu_bound(self, fn, *args):
+        """Like _run_cpu_bound, without blocking the event loop"""
+        executor = getattr(self.ctx, "cpu_executor", None)
+        if isinstance(executor, Executor):
+            return await asyncio.wrap_future(executor.submit(fn, *args))
+        return fn(*args)
+
     def _validate(self, prompt_template: Template, input_dict: Dict[str, Any]) -> bool:
         """
         Validate the input data for this block. This method validates whether all required
@@ -66,8 +125,7 @@ class Block(ABC):
             config_path = os.path.join(
                 os.path.dirname(self.pipe.config_path), config_path
             )
-        with open(config_path, "r", encoding="utf-8") as config_file:
-            return yaml.safe_load(config_file)
+        return load_yaml(config_path)
 
 
 # This is part of the public API.
@@ -8,6 +8,7 @@ import operator
 from datasets import Dataset
 
 # Local
+from ..estimate import BlockEstimate, EstimateOptions
 from ..registry import BlockRegistry
 from .block import Block
 
@@ -191,3 +192,19 @@ class FilterByValueBlock(Block):
             self.value,
             self.ctx.dataset_num_procs,
         )
+
+    def estimate(
+        self, samples: Dataset, rows: float, options: EstimateOptions
+    ) -> tuple[Dataset, BlockEstimate]:
+        if options.pilot:
+            return super().estimate(samples, rows, options)
+        # The filtered column usually comes from an LLM block that has not
+        # really run, so the sample is passed through as is
+        assumed_yield = options.assumed_yield(self.block_name)
+        return samples, BlockEstimate(
+            self.block_name,
+            type(self).__name__,
+            rows,
+            rows * assumed_yield,
+            assumed_yield=assumed_yield,
+        )
@@ -7,8 +7,10 @@ import logging
 from datasets import Dataset
 
 # Local
+from ..estimate import BlockEstimate, EstimateOptions
 from ..pipeline import _lookup_block_type
 from ..registry import BlockRegistry
+from ..utils.arrow import concatenate_and_compact
 from .block import Block
 
 logger = logging.getLogger(__name__)
@@ -52,6 +54,44 @@ class IterBlock(Block):
 
         for _ in range(num_iters):
             batch_generated = self.block.generate(samples)
-            generated_samples.extend(batch_generated)
+            generated_samples.append(self.ctx.spill_dataset(batch_generated))
 
-        return Dataset.from_list(generated_samples)
+        return self._concatenate(generated_samples)
+
+    async def agenerate(self, samples: Dataset) -> Dataset:
+        generated_samples = []
+        num_iters = self.num_iters
+
+        # Iterations run one after the other, as in generate, since the
+        # wrapped block may depend on the order it gets called in
+        for _ in range(num_iters):
+            batch_generated = await self.block.agenerate(samples)
+            generated_samples.append(self.ctx.spill_dataset(batch_generated))
+
+        return self._concatenate(generated_samples)
+
+    @staticmethod
+    def _concatenate(generated_samples) -> Dataset:
+        # Concatenating the Arrow tables of the iterations, rather than
+        # rebuilding them from their rows, keeps any spilled to disk there
+        generated_samples = [ds for ds in generated_samples if len(ds) > 0]
+        if not generated_samples:
+            return Dataset.from_list([])
+        return concatenate_and_compact(generated_samples)
+
+    def estimate(
+        self, samples: Dataset, rows: float, options: EstimateOptions
+    ) -> tuple[Dataset, BlockEstimate]:
+        # Every iteration sees the same input, so one is estimated and
+        # scaled up
+        output, estimate = self.block.estimate(samples, rows, options)
+        return output, BlockEstimate(
+            self.block_name,
+            type(self).__name__,
+            rows,
+            estimate.rows_out * self.num_iters,
+            llm_requests=estimate.llm_requests * self.num_iters,
+            prompt_tokens=estimate.prompt_tokens * self.num_iters,
+            max_completion_tokens=estimate.max_completion_tokens * self.num_iters,
+            assumed_yield=estimate.assumed_yield,
+        )
@@ -1,29 +1,67 @@
 # SPDX-License-Identifier: Apache-2.0
+# pylint: disable=too-many-lines
 
 # Standard
-from typing import Any, Dict
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, Dict, Optional
+import asyncio
+import contextlib
+import contextvars
+import functools
 import logging
-import re
+import math
 
 # Third Party
 from datasets import Dataset
+from jinja2 import Template
 from tqdm import tqdm
 import httpx
 import openai
+import pyarrow
+import pyarrow.compute as pc
 
 # Local
 # Import prompts to register default chat templates
 from .. import prompts as default_prompts  # pylint: disable=unused-import
+from ..autotune import AutoTuner
+from ..clientpool import ClientPool
+from ..estimate import BlockEstimate, EstimateOptions
+from ..profiling import current_block_profile
 from ..registry import BlockRegistry, PromptRegistry
+from ..response_cache import ResponseCache
 from ..utils import models
+from ..utils.arrow import concatenate_and_compact, dataset_to_table
 from .block import Block, BlockConfigParserError
+from .parsers import ParseStats, StreamedOutputs, parser_from_config
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_MAX_NUM_TOKENS = 4096
 
+# Outputs of a batch adding up to this many characters are parsed in chunks
+# of about PARSE_CHUNK_CHARS on the cpu_executor of the PipelineContext
+PARALLEL_PARSE_MIN_CHARS = 1 << 20
+PARSE_CHUNK_CHARS = 1 << 18
+
+
+def known_server_supports_batched(client) -> Optional[bool]:
+    """Whether the server of client was found to support batching, or None
+    if it has not been probed yet"""
+    if isinstance(client, ClientPool):
+        known = [known_server_supports_batched(replica) for replica in client.clients]
+        if None in known:
+            return None
+        return all(known)
+    return getattr(client, "server_supports_batched", None)
+
 
 def server_supports_batched(client, model_id: str) -> bool:
+    if isinstance(client, ClientPool):
+        # Requests may go to any replica, so every one of them has to support
+        # batching. The answer is cached on the client of each replica.
+        return all(
+            server_supports_batched(replica, model_id) for replica in client.clients
+        )
     supported = getattr(client, "server_supports_batched", None)
     if supported is not None:
         return supported
@@ -57,10 +95,125 @@ def server_supports_batched(client, model_id: str) -> bool:
     return supported
 
 
+@contextlib.contextmanager
+def _observe_request(ctx):
+    """Report the latency and outcome of an LLM request to the AutoTuner of
+    the PipelineContext and to the profile of the running block, if
+    auto-tuning or profiling are enabled
+    """
+    autotuner = getattr(ctx, "autotuner", None)
+    profile = current_block_profile()
+    with contextlib.ExitStack() as stack:
+        if isinstance(autotuner, AutoTuner):
+            stack.enter_context(autotuner.observe())
+        if profile is not None:
+            stack.enter_context(profile.llm_request())
+        yield
+
+
+def _dispatch(fn, requests: list, max_concurrency: int) -> list:
+    """
+    Call fn on every request, with up to max_concurrency calls running at
+    once on a pool of threads, and return the results in the order of the
+    requests. The threads run in a copy of the caller's context, so their
+    requests are still reported to the profile of the running block.
+    """
+    if max_concurrency <= 1 or len(requests) <= 1:
+        return [fn(request) for request in requests]
+    context = contextvars.copy_context()
+
+    def call(request):
+        return context.copy().run(fn, request)
+
+    executor = ThreadPoolExecutor(max_workers=min(max_concurrency, len(requests)))
+    try:
+        return list(executor.map(call, requests))
+    finally:
+        # Do not send the requests left once one of them failed
+        executor.shutdown(cancel_futures=True)
+
+
+def _max_concurrency(max_concurrency, block) -> Optional[int]:
+    if max_concurrency is None:
+        return None
+    if not isinstance(max_concurrency, int) or max_concurrency < 1:
+        raise BlockConfigParserError(
+            f"{type(block).__name__} {block.block_name} max_concurrency must be a positive integer"
+        )
+    return max_concurrency
+
+
+def _block_semaphore(max_concurrency):
+    """Caps the requests of one call of a block when it has a max_concurrency"""
+    if max_concurrency is None:
+        return contextlib.nullcontext()
+    return asyncio.Semaphore(max_concurrency)
+
+
+def _response_cache(ctx):
+    cache = getattr(ctx, "response_cache", None)
+    return cache if isinstance(cache, ResponseCache) else None
+
+
+def _lookup_responses(cache, model_id, requests, gen_kwargs):
+    """The cache keys of the requests, their cached completions, or None, and
+    the indexes of the requests without any
+    """
+    keys = cache.keys(model_id, requests, gen_kwargs)
+    completions = [cache.get(key) for key in keys]
+    missing = [i for i, cached in enumerate(completions) if cached is None]
+    return keys, completions, missing
+
+
+def _store_responses(cache, keys, completions, missing, generated) -> None:
+    for i, request_completions in zip(missing, generated):
+        completions[i] = request_completions
+        cache.put(keys[i], request_completions)
+
+
+def _cached_completions(ctx, model_id, requests, gen_kwargs, complete) -> list:
+    """Return the list of completions of every request, taking them from the
+    response cache of the PipelineContext when it has them and calling
+    complete with the list of the other requests
+    """
+    cache = _response_cache(ctx)
+    if cache is None:
+        return complete(requests)
+    keys, completions, missing = _lookup_responses(
+        cache, model_id, requests, gen_kwargs
+    )
+    if missing:
+        generated = complete([requests[i] for i in missing])
+        _store_responses(cache, keys, completions, missing, generated)
+    return completions
+
+
+async def _acached_completions(ctx, model_id, requests, gen_kwargs, acomplete) -> list:
+    """_cached_completions, awaiting acomplete for the requests not cached"""
+    cache = _response_cache(ctx)
+    if cache is None:
+        return await acomplete(requests)
+    keys, completions, missing = _lookup_responses(
+        cache, model_id, requests, gen_kwargs
+    )
+    if missing:
+        generated = await acomplete([requests[i] for i in missing])
+        _store_responses(cache, keys, completions, missing, generated)
+    return completions
+
+
 def template_from_struct_and_config(struct, config):
     # replace None with empty strings
     filtered_config = {k: (v if v is not None else "") for k, v in config.items()}
-    return PromptRegistry.template_from_string(struct.format(**filtered_config))
+    return _compile_template(struct.format(**filtered_config))
+
+
+# Many blocks, and every pipeline built from the same configs, share the same
+# prompts. Jinja templates are safe to render concurrently, so each prompt is
+# compiled once per process.
+@functools.lru_cache(maxsize=256)
+def _compile_template(source):
+    return PromptRegistry.template_from_string(source)
 
 
 def _resolve_model_id(model_id, ctx_model_id, block):
@@ -108,6 +261,8 @@ class LLMBlock(Block):
         gen_kwargs={},
         parser_kwargs={},
         batch_kwargs={},
+        max_concurrency=None,
+        stream_completions=False,
     ) -> None:
         super().__init__(ctx, pipe, block_name)
         self.block_config = self._load_config(config_path)
@@ -123,12 +278,30 @@ class LLMBlock(Block):
             self.model_id,
         )
         self.model_prompt = model_prompt
+        self.model_prompt_template = self._model_prompt_template()
         self.output_cols = output_cols
         self.batch_params = batch_kwargs
+        # The number of requests sent at once to a server that does not take
+        # a list of prompts, sequentially by default
+        self.max_concurrency = _max_concurrency(max_concurrency, self)
         max_num_token_override = ctx.max_num_tokens
         self.parser_name = parser_kwargs.get("parser_name", None)
         self.parsing_pattern = parser_kwargs.get("parsing_pattern", None)
         self.parser_cleanup_tags = parser_kwargs.get("parser_cleanup_tags", None)
+        # The patterns of the parser are compiled once, for every output
+        self.parser = parser_from_config(
+            block_name, self.block_config, self.output_cols, parser_kwargs
+        )
+        self.parse_stats = ParseStats()
+        # Streamed completions are cut short once the parser has every output
+        # column, which it can only tell from the end tags of a tag parser
+        # whose config has one_value_per_column set
+        self.stream_completions = bool(stream_completions)
+        if self.stream_completions and not self.parser.end_tags:
+            logger.warning(
+                f"Not streaming the completions of block {block_name}, as its parser can not tell when they are complete. Only blocks whose config sets one_value_per_column, with start and end tags for every output column, are streamed."
+            )
+            self.stream_completions = False
         # max_num_tokens should only be applicable to knowledge blocks
         # gen_knowledge if the full/simple pipeline's knowledge generation block
         if block_name != "gen_knowledge":
@@ -143,69 +316,42 @@ class LLMBlock(Block):
             temperature=0,
             max_tokens=DEFAULT_MAX_NUM_TOKENS,
         )
-        # Whether the LLM server supports a list of input prompts
-        # and supports the n parameter to generate n outputs per input
-        self.server_supports_batched = server_supports_batched(
-            self.ctx.client, self.model_id
-        )
+        self._server_supports_batched: Optional[bool] = None
+
+    @property
+    def server_supports_batched(self) -> bool:
+        """Whether the LLM server supports a list of input prompts and the n
+        parameter to generate n outputs per input. The server is only probed
+        the first time this is needed, so building a pipeline does not need
+        one."""
+        if self._server_supports_batched is None:
+            self._server_supports_batched = server_supports_batched(
+                self.ctx.client, self.model_id
+            )
+        return self._server_supports_batched
 
     def _parse(self, generated_string) -> dict:
-        matches = {}
-
-        if self.parser_name is not None and self.parser_name == "custom":
-            pattern = re.compile(self.parsing_pattern, re.DOTALL)
-            all_matches = pattern.findall(generated_string)
-            matches = {column_name: [] for column_name in self.output_cols}
-            if all_matches and isinstance(all_matches[0], tuple):
-                for match in all_matches:
-                    for column_name, value in zip(self.output_cols, match):
-                        value = value.strip()
-                        for clean_tag in self.parser_cleanup_tags:
-                            value = value.replace(clean_tag, "")
-                        matches[column_name].append(value)
-            else:
-                matches[self.output_cols[0]] = (
-                    [match.strip() for match in all_matches] if all_matches else []
-                )
-        else:
-            for start_tag, end_tag, output_col in zip(
-                self.block_config.get("start_tags", []),
-                self.block_config.get("end_tags", []),
-                self.output_cols,
-            ):
-                if not start_tag and not end_tag:
-                    matches[output_col] = [
-                        generated_string.strip() if generated_string else None
-                    ]
-                else:
-                    pattern = re.escape(start_tag) + r"(.*?)" + re.escape(end_tag)
-                    all_matches = re.findall(pattern, generated_string, re.DOTALL)
-                    matches[output_col] = (
-                        [match.strip() for match in all_matches] if all_matches else []
-                    )
-
-        return matches
+        return self.parser.parse(generated_string)
 
     # There are three cases to handle for self.model_prompt
     # 1. None - no model_prompt specified, look one up based on model family
     # 2. Non-empty string - the pipeline has specified a custom model prompt
     # 3. Empty string - the pipeline has specified that no model prompt is needed
+    def _model_prompt_template(self) -> Template:
+        if self.model_prompt is None:
+            return PromptRegistry.get_template(self.model_family)
+        if self.model_prompt:
+            return _compile_template(self.model_prompt)
+        # Our model prompt is an empty string, which we'll render
+        # verbatim without wrapping in the messages format
+        return PromptRegistry.get_template("blank")
+
     def _format_prompt(self, sample: Dict) -> str:
         prompt_templated_str = self.prompt_template.render(sample).strip()
 
-        model_prompt = None
-        if self.model_prompt is None:
-            model_prompt = PromptRegistry.get_template(self.model_family)
-        elif self.model_prompt:
-            model_prompt = PromptRegistry.template_from_string(self.model_prompt)
-        else:
-            # Our model prompt is an empty string, which we'll render
-            # verbatim without wrapping in the messages format
-            model_prompt = PromptRegistry.get_template("blank")
-
         messages = [{"role": "user", "content": prompt_templated_str}]
 
-        return model_prompt.render(
+        return self.model_prompt_template.render(
             messages=messages,
             prompt=prompt_templated_str,
             add_generation_prompt=True,
@@ -231,29 +377,145 @@ class LLMBlock(Block):
             gen_kwargs["max_tokens"] = int(gen_kwargs["max_tokens"])
         return gen_kwargs
 
+    def _format_prompts(self, samples) -> list:
+        return [self._format_prompt(sample) for sample in samples]
+
     def _generate(self, samples) -> list:
-        prompts = [self._format_prompt(sample) for sample in samples]
+        prompts = self._run_cpu_bound(self._format_prompts, samples)
         logger.debug(f"STARTING GENERATION FOR LLMBlock USING PROMPTS: {prompts}")
         logger.debug(f"Generation arguments: {self.gen_kwargs}")
-        if self.server_supports_batched:
+        completions = _cached_completions(
+            self.ctx, self.model_id, prompts, self._cache_kwargs(), self._complete
+        )
+        return [text for texts in completions for text in texts]
+
+    def _cache_kwargs(self) -> dict:
+        """The generation arguments the response cache keys requests with.
+        Streamed completions are cut short, so they are cached apart.
+        """
+        if self.stream_completions:
+            return {**self.gen_kwargs, "stream": True}
+        return self.gen_kwargs
+
+    def _create_completions(self, prompt, count) -> list:
+        """The texts of the count completions of a request for prompt, a
+        prompt or a list of them
+        """
+        if not self.stream_completions:
             response = self.ctx.client.completions.create(
-                prompt=prompts, **self.gen_kwargs
+                prompt=prompt, **self.gen_kwargs
             )
-            return [choice.text.strip() for choice in response.choices]
+            return [choice.text for choice in response.choices[:count]]
+        outputs = StreamedOutputs(self.parser, count)
+        stream = self.ctx.client.completions.create(
+            prompt=prompt, stream=True, **self.gen_kwargs
+        )
+        try:
+            for chunk in stream:
+                if self._add_chunk(outputs, chunk):
+                    # Closing the connection stops the server generating
+                    break
+        finally:
+            stream.close()
+        return outputs.texts
+
+    @staticmethod
+    def _add_chunk(outputs: StreamedOutputs, chunk) -> bool:
+        """Add the deltas of a streamed chunk, returning whether every
+        completion is complete
+        """
+        complete = False
+        for choice in chunk.choices:
+            complete = outputs.add(choice.index, choice.text)
+        return complete
+
+    async def _acreate_completions(self, client, prompt, count) -> list:
+        """_create_completions, with asyncio"""
+        if not self.stream_completions:
+            response = await client.completions.create(prompt=prompt, **self.gen_kwargs)
+            return [choice.text for choice in response.choices[:count]]
+        outputs = StreamedOutputs(self.parser, count)
+        stream = await client.completions.create(
+            prompt=prompt, stream=True, **self.gen_kwargs
+        )
+        try:
+            async for chunk in stream:
+                if self._add_chunk(outputs, chunk):
+                    break
+        finally:
+            await stream.close()
+        return outputs.texts
+
+    def _complete(self, prompts) -> list:
+        """The list of n completions of every prompt"""
+        n = self.gen_kwargs.get("n", 1)
+        if self.server_supports_batched:
+            with _observe_request(self.ctx):
+                texts = self._create_completions(prompts, len(prompts) * n)
+            texts = [text.strip() for text in texts]
+            return [texts[i : i + n] for i in range(0, len(texts), n)]
 
-        results = []
         progress_bar = tqdm(
             range(len(prompts)), desc=f"{self.block_name} Prompt Generation"
         )
-        for prompt in prompts:
+
+        def create_completion(prompt):
             logger.debug(f"CREATING COMPLETION FOR PROMPT: {prompt}")
-            for _ in range(self.gen_kwargs.get("n", 1)):
-                response = self.ctx.client.completions.create(
-                    prompt=prompt, **self.gen_kwargs
-                )
-                results.append(response.choices[0].text.strip())
-                progress_bar.update(1)
-        return results
+            with _observe_request(self.ctx):
+                [text] = self._create_completions(prompt, 1)
+            progress_bar.update(1)
+            return text.strip()
+
+        # The results are in the order of the requests, so outputs still line
+        # up with the n copies of each sample
+        texts = _dispatch(
+            create_completion,
+            [prompt for prompt in prompts for _ in range(n)],
+            self.max_concurrency or 1,
+        )
+        return [texts[i : i + n] for i in range(0, len(texts), n)]
+
+    async def _agenerate(self, samples) -> list:
+        prompts = await self._arun_cpu_bound(self._format_prompts, samples)
+        logger.debug(f"STARTING ASYNC GENERATION FOR LLMBlock USING PROMPTS: {prompts}")
+        logger.debug(f"Generation arguments: {self.gen_kwargs}")
+        completions = await _acached_completions(
+            self.ctx, self.model_id, prompts, self._cache_kwargs(), self._acomplete
+        )
+        return [text for texts in completions for text in texts]
+
+    async def _acomplete(self, prompts) -> list:
+        """_complete, with asyncio"""
+        n = self.gen_kwargs.get("n", 1)
+        client = self.ctx.get_async_client()
+        semaphore = self.ctx.request_semaphore()
+        if self.server_supports_batched:
+            async with semaphore:
+                with _observe_request(self.ctx):
+                    texts = await self._acreate_completions(
+                        client, prompts, len(prompts) * n
+                    )
+            texts = [text.strip() for text in texts]
+            return [texts[i : i + n] for i in range(0, len(texts), n)]
+
+        progress_bar = tqdm(
+            range(len(prompts)), desc=f"{self.block_name} Prompt Generation"
+        )
+        block_semaphore = _block_semaphore(self.max_concurrency)
+
+        async def create_completion(prompt):
+            async with block_semaphore, semaphore:
+                with _observe_request(self.ctx):
+                    [text] = await self._acreate_completions(client, prompt, 1)
+            progress_bar.update(1)
+            return text.strip()
+
+        # gather keeps the results in submission order, so outputs still line
+        # up with the n copies of each sample
+        texts = await asyncio.gather(
+            *(create_completion(prompt) for prompt in prompts for _ in range(n))
+        )
+        return [texts[i : i + n] for i in range(0, len(texts), n)]
 
     def generate(self, samples: Dataset) -> Dataset:
         """
@@ -266,6 +528,155 @@ class LLMBlock(Block):
         Returns:
             The parsed output after generation.
         """
+        # Validating, rendering and parsing are CPU-bound and run on the
+        # cpu_executor of the PipelineContext if there is one
+        valid_samples = self._run_cpu_bound(self._valid_samples, samples)
+        self._profile_validation(samples, valid_samples)
+
+        if len(valid_samples) == 0:
+            return Dataset.from_list([])
+
+        # generate the output
+
+        outputs = self._generate(valid_samples)
+        logger.debug("Generated outputs: %s", outputs)
+
+        chunks = self._parse_chunks(valid_samples, outputs)
+        if chunks is None:
+            parsed, empty_parses = self._run_cpu_bound(
+                self._parse_outputs, valid_samples, outputs
+            )
+        else:
+            futures = [
+                self.ctx.cpu_executor.submit(self._parse_outputs, *chunk)
+                for chunk in chunks
+            ]
+            parsed, empty_parses = self._join_parsed(
+                [future.result() for future in futures]
+            )
+        self._profile_parsing(len(outputs), empty_parses)
+        return parsed
+
+    async def agenerate(self, samples: Dataset) -> Dataset:
+        """
+        Generate the output from the block with asyncio, sending the requests
+        through the AsyncOpenAI client of the PipelineContext.
+
+        Args:
+            samples (Dataset): The samples used as input data
+
+        Returns:
+            The parsed output after generation.
+        """
+        valid_samples = await self._arun_cpu_bound(self._valid_samples, samples)
+        self._profile_validation(samples, valid_samples)
+
+        if len(valid_samples) == 0:
+            return Dataset.from_list([])
+
+        outputs = await self._agenerate(valid_samples)
+        logger.debug("Generated outputs: %s", outputs)
+
+        chunks = self._parse_chunks(valid_samples, outputs)
+        if chunks is None:
+            parsed, empty_parses = await self._arun_cpu_bound(
+                self._parse_outputs, valid_samples, outputs
+            )
+        else:
+            parsed, empty_parses = self._join_parsed(
+                await asyncio.gather(
+                    *(
+                        asyncio.wrap_future(
+                            self.ctx.cpu_executor.submit(self._parse_outputs, *chunk)
+                        )
+                        for chunk in chunks
+                    )
+                )
+            )
+        self._profile_parsing(len(outputs), empty_parses)
+        return parsed
+
+    def estimate(
+        self, samples: Dataset, rows: float, options: EstimateOptions
+    ) -> tuple[Dataset, BlockEstimate]:
+        """
+        Count the requests and tokens needed to run this block over `rows`
+        rows by rendering the prompts of a sample of them. Unless
+        options.pilot is set, the outputs are left empty, each completion
+        is assumed to parse into options.assumed_yield rows and a server that
+        has not been probed yet is assumed to support batching.
+        """
+        valid_samples = self._valid_samples(samples)
+        valid_rows = rows * len(valid_samples) / len(samples)
+        n = self.gen_kwargs.get("n", 1)
+        prompt_tokens = [
+            options.count_tokens(prompt)
+            for prompt in self._format_prompts(valid_samples)
+        ]
+        mean_prompt_tokens = (
+            sum(prompt_tokens) / len(prompt_tokens) if prompt_tokens else 0
+        )
+        batched = known_server_supports_batched(self.ctx.client)
+        if batched is None:
+            # A dry run does not probe the server and assumes it batches
+            batched = self.server_supports_batched if options.pilot else True
+        if batched:
+            # One request per batch, with the n completions of each prompt
+            # generated from a single read of it
+            batch_size = self.ctx.batch_size if self.ctx.batching_enabled else 0
+            llm_requests = math.ceil(valid_rows / batch_size) if batch_size else 1
+            prompt_reads = valid_rows
+        else:
+            llm_requests = prompt_reads = valid_rows * n
+        if not valid_samples:
+            llm_requests = 0
+
+        if options.pilot:
+            output = self.generate(samples)
+            rows_out = rows * len(output) / len(samples)
+            assumed_yield = None
+        else:
+            output = Dataset.from_list(
+                [
+                    {**sample, **{col: "" for col in self.output_cols}}
+                    for sample in valid_samples
+                    for _ in range(n)
+                ]
+            )
+            assumed_yield = options.assumed_yield(self.block_name)
+            rows_out = valid_rows * n * assumed_yield
+
+        return output, BlockEstimate(
+            self.block_name,
+            type(self).__name__,
+            rows,
+            rows_out,
+            llm_requests=llm_requests,
+            prompt_tokens=prompt_reads * mean_prompt_tokens,
+            max_completion_tokens=valid_rows * n * self.gen_kwargs["max_tokens"],
+            assumed_yield=assumed_yield,
+        )
+
+    @staticmethod
+    def _profile_validation(samples, valid_samples) -> None:
+        profile = current_block_profile()
+        if profile is not None:
+            profile.add_validation_failures(len(samples) - len(valid_samples))
+
+    def _profile_parsing(self, num_outputs: int, empty_parses: int) -> None:
+        self.parse_stats.record(num_outputs, empty_parses)
+        if empty_parses:
+            logger.debug(
+                "%d of %d outputs of block %s could not be parsed",
+                empty_parses,
+                num_outputs,
+                self.block_name,
+            )
+        profile = current_block_profile()
+        if profile is not None:
+            profile.add_empty_parses(empty_parses)
+
+    def _valid_samples(self, samples: Dataset) -> list:
         num_samples = self.batch_params.get("num_samples", None)
         logger.debug("Generating outputs for {} samples".format(len(samples)))
 
@@ -275,25 +686,47 @@ class LLMBlock(Block):
         # validate each sample
         # Log errors and remove invalid samples
         valid_samples = []
+        rows = samples.to_list()
+        valid = self._valid_rows(dataset_to_table(samples), rows)
 
-        for sample in samples:
-            if self._validate(self.prompt_template, sample):
+        for sample, is_valid in zip(rows, valid):
+            if is_valid:
                 valid_samples.append(sample)
             else:
                 logger.warning(
                     f"Sample failed validation: {sample}"
                 )  # Log details of the failed sample
 
-        samples = valid_samples
-
-        if len(samples) == 0:
-            return Dataset.from_list([])
-
-        # generate the output
+        return valid_samples
 
-        outputs = self._generate(samples)
-        logger.debug("Generated outputs: %s", outputs)
+    def _valid_rows(self, table: pyarrow.Table, rows: list) -> list:
+        """Whether each row has what the prompt template needs"""
+        return self._template_valid_rows(self.prompt_template, table, rows)
 
+    def _template_valid_rows(
+        self, prompt_template, table: pyarrow.Table, rows: list
+    ) -> list:
+        """
+        Whether each row has a value for every variable of the template,
+        checked on the columns of the whole table at once. Templates whose
+        variables can not be told without rendering them are rendered.
+        """
+        variables = PromptRegistry.template_variables(prompt_template)
+        if variables is None:
+            return [self._validate(prompt_template, row) for row in rows]
+        missing = sorted(variables.difference(table.column_names))
+        if missing:
+            logger.error(f"Missing keys: {missing}")
+            return [False] * len(rows)
+        valid = pyarrow.array([True] * len(rows))
+        for name in variables:
+            valid = pc.and_(valid, pc.is_valid(table.column(name)))
+        return valid.to_pylist()
+
+    def _parse_outputs(self, samples: list, outputs: list) -> tuple[Dataset, int]:
+        """Parse the outputs into new samples, also returning how many of
+        the outputs produced nothing when parsed
+        """
         num_parallel_samples = self.gen_kwargs.get("n", 1)
         extended_samples = []
 
@@ -304,13 +737,55 @@ class LLMBlock(Block):
             extended_samples.extend([item] * num_parallel_samples)
 
         new_data = []
-        for sample, output in zip(extended_samples, outputs):
-            parsed_outputs = self._parse(output)
+        empty_parses = 0
+        for sample, parsed_outputs in zip(
+            extended_samples, self.parser.parse_all(outputs)
+        ):
             max_length = max(len(value) for value in parsed_outputs.values())
+            num_rows = len(new_data)
             for values in zip(*(lst[:max_length] for lst in parsed_outputs.values())):
                 new_data.append({**sample, **dict(zip(parsed_outputs.keys(), values))})
+            if len(new_data) == num_rows:
+                empty_parses += 1
 
-        return Dataset.from_list(new_data)
+        return Dataset.from_list(new_data), empty_parses
+
+    def _parse_chunks(self, samples: list, outputs: list):
+        """
+        Split samples and their outputs into chunks of about
+        PARSE_CHUNK_CHARS characters of outputs, to be parsed concurrently on
+        the cpu_executor, or None when they are better parsed at once.
+        """
+        executor = getattr(self.ctx, "cpu_executor", None)
+        if not isinstance(executor, Executor):
+            return None
+        n = self.gen_kwargs.get("n", 1)
+        if not isinstance(n, int) or len(outputs) != len(samples) * n:
+            return None
+        lengths = [len(output or "") for output in outputs]
+        if sum(lengths) < PARALLEL_PARSE_MIN_CHARS:
+            return None
+        chunks = []
+        start = 0
+        chars = 0
+        for i in range(len(samples)):
+            chars += sum(lengths[i * n : (i + 1) * n])
+            if chars >= PARSE_CHUNK_CHARS or i == len(samples) - 1:
+                chunks.append(
+                    (samples[start : i + 1], outputs[start * n : (i + 1) * n])
+                )
+                start = i + 1
+                chars = 0
+        return chunks
+
+    @staticmethod
+    def _join_parsed(results: list) -> tuple[Dataset, int]:
+        """Join what _parse_outputs gave for each chunk, in order"""
+        datasets = [parsed for parsed, _ in results if len(parsed) > 0]
+        empty_parses = sum(empty for _, empty in results)
+        if not datasets:
+            return Dataset.from_list([]), empty_parses
+        return concatenate_and_compact(datasets), empty_parses
 
 
 # This is part of the public API.
@@ -330,6 +805,8 @@ class ConditionalLLMBlock(LLMBlock):
         gen_kwargs={},
         parser_kwargs={},
         batch_kwargs={},
+        max_concurrency=None,
+        stream_completions=False,
     ) -> None:
         if not config_paths:
             raise BlockConfigParserError(
@@ -352,6 +829,8 @@ class ConditionalLLMBlock(LLMBlock):
             gen_kwargs=gen_kwargs,
             parser_kwargs=parser_kwargs,
             batch_kwargs=batch_kwargs,
+            max_concurrency=max_concurrency,
+            stream_completions=stream_completions,
         )
         self.selector_column_name = selector_column_name
         self.prompt_template = {}
@@ -376,6 +855,35 @@ class ConditionalLLMBlock(LLMBlock):
         # Otherwise, use the sample to render the prompt without any selection
         return self.prompt_template.render(sample).strip()
 
+    def _valid_rows(self, table: pyarrow.Table, rows: list) -> list:
+        if not isinstance(self.prompt_template, dict):
+            return super()._valid_rows(table, rows)
+        if self.selector_column_name not in table.column_names:
+            logger.error(
+                f"ConditionalLLMBlock {self.block_name} missing key: {self.selector_column_name}"
+            )
+            return [False] * len(rows)
+        selectors = table.column(self.selector_column_name).to_pylist()
+        indices_by_key: Dict[Any, list] = {}
+        for i, config_key in enumerate(selectors):
+            indices_by_key.setdefault(config_key, []).append(i)
+        # Each row is checked against the template its selector picks
+        valid = [False] * len(rows)
+        for config_key, indices in indices_by_key.items():
+            if config_key not in self.prompt_template:
+                logger.error(
+                    f"ConditionalLLMBlock {self.block_name} selector key {config_key} not found in block config"
+                )
+                continue
+            key_valid = self._template_valid_rows(
+                self.prompt_template[config_key],
+                table.take(indices),
+                [rows[i] for i in indices],
+            )
+            for i, is_valid in zip(indices, key_valid):
+                valid[i] = is_valid
+        return valid
+
     def _validate(self, prompt_template: str, input_dict: Dict[str, Any]) -> bool:
         if isinstance(prompt_template, dict):
             if not self.selector_column_name in input_dict:
@@ -409,6 +917,8 @@ class LLMLogProbBlock(LLMBlock):
         gen_kwargs={},
         parser_kwargs={},
         batch_kwargs={},
+        max_concurrency=None,
+        stream_completions=False,
     ) -> None:
         super().__init__(
             ctx,
@@ -422,6 +932,8 @@ class LLMLogProbBlock(LLMBlock):
             gen_kwargs=gen_kwargs,
             parser_kwargs=parser_kwargs,
             batch_kwargs=batch_kwargs,
+            max_concurrency=max_concurrency,
+            stream_completions=stream_completions,
         )
 
     # def _generate_logprobs(self, samples, **gen_kwargs):
@@ -515,11 +1027,15 @@ class LLMMessagesBlock(Block):
         output_col,
         model_id=None,
         gen_kwargs={},
+        max_concurrency=None,
     ) -> None:
         super().__init__(ctx, pipe, block_name)
         self.model_id = _resolve_model_id(model_id, self.ctx.model_id, self)
         self.input_col = input_col
         self.output_col = output_col
+        # The number of chat completions requested at once, sequentially by
+        # default
+        self.max_concurrency = _max_concurrency(max_concurrency, self)
         self.gen_kwargs = self._gen_kwargs(
             gen_kwargs,
             model=self.model_id,
@@ -546,25 +1062,108 @@ class LLMMessagesBlock(Block):
         messages = samples[self.input_col]
         logger.debug("STARTING GENERATION FOR LLMMessagesBlock")
         logger.debug(f"Generation arguments: {self.gen_kwargs}")
-        results = []
+        completions = _cached_completions(
+            self.ctx, self.model_id, messages, self.gen_kwargs, self._complete
+        )
+        return self._outputs(completions)
+
+    def _complete(self, messages) -> list:
+        """The list of n completions of every list of messages"""
         progress_bar = tqdm(
-            range(len(samples)), desc=f"{self.block_name} Chat Completion Generation"
+            range(len(messages)), desc=f"{self.block_name} Chat Completion Generation"
         )
         n = self.gen_kwargs.get("n", 1)
-        for message in messages:
+
+        def create_chat_completion(message):
             logger.debug(f"CREATING CHAT COMPLETION FOR MESSAGE: {message}")
-            responses = self.ctx.client.chat.completions.create(
-                messages=message, **self.gen_kwargs
-            )
-            if n > 1:
-                results.append([choice.message.content for choice in responses.choices])
-            else:
-                results.append(responses.choices[0].message.content)
+            with _observe_request(self.ctx):
+                responses = self.ctx.client.chat.completions.create(
+                    messages=message, **self.gen_kwargs
+                )
+            progress_bar.update(n)
+            return [choice.message.content for choice in responses.choices]
+
+        return _dispatch(
+            create_chat_completion, list(messages), self.max_concurrency or 1
+        )
+
+    async def _agenerate(self, samples) -> list:
+        messages = samples[self.input_col]
+        logger.debug("STARTING ASYNC GENERATION FOR LLMMessagesBlock")
+        logger.debug(f"Generation arguments: {self.gen_kwargs}")
+        completions = await _acached_completions(
+            self.ctx, self.model_id, messages, self.gen_kwargs, self._acomplete
+        )
+        return self._outputs(completions)
+
+    async def _acomplete(self, messages) -> list:
+        """_complete, with asyncio"""
+        client = self.ctx.get_async_client()
+        semaphore = self.ctx.request_semaphore()
+        progress_bar = tqdm(
+            range(len(messages)), desc=f"{self.block_name} Chat Completion Generation"
+        )
+        n = self.gen_kwargs.get("n", 1)
+        block_semaphore = _block_semaphore(self.max_concurrency)
+
+        async def create_chat_completion(message):
+            async with block_semaphore, semaphore:
+                with _observe_request(self.ctx):
+                    responses = await client.chat.completions.create(
+                        messages=message, **self.gen_kwargs
+                    )
             progress_bar.update(n)
-        return results
+            return [choice.message.content for choice in responses.choices]
+
+        return list(
+            await asyncio.gather(
+                *(create_chat_completion(message) for message in messages)
+            )
+        )
+
+    def _outputs(self, completions) -> list:
+        # A single completion is returned as is, n of them as a list
+        if self.gen_kwargs.get("n", 1) > 1:
+            return completions
+        return [texts[0] for texts in completions]
 
     def generate(self, samples: Dataset) -> Dataset:
         outputs = self._generate(samples)
         logger.debug("Generated outputs: %s", outputs)
         samples = samples.add_column(self.output_col, outputs)
         return samples
+
+    def estimate(
+        self, samples: Dataset, rows: float, options: EstimateOptions
+    ) -> tuple[Dataset, BlockEstimate]:
+        """Count the requests and tokens needed to run this block over `rows`
+        rows from the messages of a sample of them
+        """
+        n = self.gen_kwargs.get("n", 1)
+        prompt_tokens = [
+            sum(
+                options.count_tokens(message.get("content") or "")
+                for message in messages
+            )
+            for messages in samples[self.input_col]
+        ]
+        if options.pilot:
+            output = self.generate(samples)
+        else:
+            output = samples.add_column(
+                self.output_col, [[""] * n if n > 1 else ""] * len(samples)
+            )
+        return output, BlockEstimate(
+            self.block_name,
+            type(self).__name__,
+            rows,
+            llm_requests=rows,
+            prompt_tokens=rows * sum(prompt_tokens) / len(prompt_tokens),
+            max_completion_tokens=rows * n * self.gen_kwargs["max_tokens"],
+        )
+
+    async def agenerate(self, samples: Dataset) -> Dataset:
+        outputs = await self._agenerate(samples)
+        logger.debug("Generated outputs: %s", outputs)
+        samples = samples.add_column(self.output_col, outputs)
+        return samples
@@ -0,0 +1,218 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional, Sequence
+import re
+import threading
+
+# Local
+from .block import BlockConfigParserError
+
+
+class OutputParser(ABC):
+    """
+    Turns the completions of an LLMBlock into the values of its output
+    columns. Every pattern is compiled once, when the parser is built, and
+    parse_all parses a whole batch of completions per call.
+    """
+
+    # The tags that may end the last value a completion needs, after which
+    # is_complete is worth checking. Parsers that can not tell when a
+    # completion has every value, such as those that may find several values
+    # for a column, have none.
+    end_tags: tuple[str, ...] = ()
+
+    @abstractmethod
+    def parse(self, output: str) -> Dict[str, List[Any]]:
+        """The values of each output column found in one completion"""
+
+    def is_complete(self, output: str) -> bool:  # pylint: disable=unused-argument
+        """Whether output already has a value for every output column"""
+        return False
+
+    def parse_all(self, outputs: Sequence[str]) -> List[Dict[str, List[Any]]]:
+        """parse, for each of the completions"""
+        parse = self.parse
+        return [parse(output) for output in outputs]
+
+
+class TagParser(OutputParser):
+    """
+    Take the text between the start and end tag of each output column, once
+    for every time the pair appears. An output column with neither tag gets
+    the whole completion.
+
+    Only when one_value_per_column is set, as the block config guarantees
+    every pair appears once, is a completion complete as soon as it has a
+    value for every output column.
+    """
+
+    def __init__(
+        self,
+        start_tags: Sequence[str],
+        end_tags: Sequence[str],
+        output_cols: Sequence[str],
+        one_value_per_column: bool = False,
+    ) -> None:
+        self._patterns: List[tuple[str, Optional[re.Pattern]]] = []
+        for start_tag, end_tag, output_col in zip(start_tags, end_tags, output_cols):
+            pattern = None
+            if start_tag or end_tag:
+                pattern = re.compile(
+                    re.escape(start_tag) + r"(.*?)" + re.escape(end_tag), re.DOTALL
+                )
+            self._patterns.append((output_col, pattern))
+        if (
+            one_value_per_column
+            and all(pattern is not None for _, pattern in self._patterns)
+            and all(end_tags)
+        ):
+            self.end_tags = tuple(dict.fromkeys(end_tags[: len(self._patterns)]))
+
+    def parse(self, output: str) -> Dict[str, List[Any]]:
+        matches: Dict[str, List[Any]] = {}
+        for output_col, pattern in self._patterns:
+            if pattern is None:
+                matches[output_col] = [output.strip() if output else None]
+            else:
+                matches[output_col] = [
+                    match.strip() for match in pattern.findall(output)
+                ]
+        return matches
+
+    def is_complete(self, output: str) -> bool:
+        return bool(self.end_tags) and all(
+            pattern.search(output) for _, pattern in self._patterns
+        )
+
+
+class RegexParser(OutputParser):
+    """
+    Find every match of a custom pattern. The groups of a pattern with
+    several of them go to the output columns in order, with the cleanup tags
+    removed from them. Otherwise the whole matches go to the first output
+    column.
+    """
+
+    def __init__(
+        self,
+        parsing_pattern: str,
+        output_cols: Sequence[str],
+        cleanup_tags: Optional[Sequence[str]] = None,
+    ) -> None:
+        self._pattern = re.compile(parsing_pattern, re.DOTALL)
+        self._output_cols = list(output_cols)
+        self._cleanup_tags = tuple(cleanup_tags or ())
+
+    def _clean(self, value: str) -> str:
+        value = value.strip()
+        for clean_tag in self._cleanup_tags:
+            value = value.replace(clean_tag, "")
+        return value
+
+    def parse(self, output: str) -> Dict[str, List[Any]]:
+        all_matches = self._pattern.findall(output)
+        matches: Dict[str, List[Any]] = {col: [] for col in self._output_cols}
+        if all_matches and isinstance(all_matches[0], tuple):
+            columns = [matches[col] for col in self._output_cols]
+            for match in all_matches:
+                for column, value in zip(columns, match):
+                    column.append(self._clean(value))
+        else:
+            matches[self._output_cols[0]] = [match.strip() for match in all_matches]
+        return matches
+
+
+def parser_from_config(
+    block_name: str,
+    block_config: Dict[str, Any],
+    output_cols: Sequence[str],
+    parser_kwargs: Dict[str, Any],
+) -> OutputParser:
+    """The parser an LLMBlock config and its parser_kwargs ask for"""
+    if parser_kwargs.get("parser_name") == "custom":
+        parsing_pattern = parser_kwargs.get("parsing_pattern")
+        if not parsing_pattern:
+            raise BlockConfigParserError(
+                f"LLMBlock {block_name} uses the custom parser but has no parsing_pattern"
+            )
+        return RegexParser(
+            parsing_pattern, output_cols, parser_kwargs.get("parser_cleanup_tags")
+        )
+    return TagParser(
+        block_config.get("start_tags", []),
+        block_config.get("end_tags", []),
+        output_cols,
+        bool(block_config.get("one_value_per_column", False)),
+    )
+
+
+class StreamedOutputs:
+    """
+    The completions of a streamed request, put together from their deltas.
+    Once the parser finds every output column in a completion, it is cut
+    after the end tag that completed it and further deltas are ignored, so
+    the stream can be closed when every completion is complete.
+    """
+
+    def __init__(self, parser: OutputParser, count: int) -> None:
+        self._parser = parser
+        self._texts = [""] * count
+        self._complete = [False] * count
+        self._remaining = count
+
+    def add(self, index: int, delta: Optional[str]) -> bool:
+        """Add a delta to completion index, returning whether every
+        completion is complete
+        """
+        if index >= len(self._texts) or self._complete[index] or not delta:
+            return self._remaining == 0
+        previous = self._texts[index]
+        text = previous + delta
+        for end_tag in self._parser.end_tags:
+            # Only an end tag overlapping the delta may complete the text
+            at = text.find(end_tag, max(0, len(previous) - len(end_tag) + 1))
+            while at != -1:
+                end = at + len(end_tag)
+                if self._parser.is_complete(text[:end]):
+                    self._texts[index] = text[:end]
+                    self._complete[index] = True
+                    self._remaining -= 1
+                    return self._remaining == 0
+                at = text.find(end_tag, at + 1)
+        self._texts[index] = text
+        return False
+
+    @property
+    def texts(self) -> List[str]:
+        return list(self._texts)
+
+
+class ParseStats:
+    """Counts the completions a block parsed, and those that gave no rows"""
+
+    def __init__(self) -> None:
+        self.outputs = 0
+        self.unparseable = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Blocks are pickled when parsing on a cpu_executor, whose workers
+        # only count what they parse themselves
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def record(self, outputs: int, unparseable: int) -> None:
+        with self._lock:
+            self.outputs += outputs
+            self.unparseable += unparseable
+
+    def as_dict(self) -> Dict[str, int]:
+        with self._lock:
+            return {"outputs": self.outputs, "unparseable": self.unparseable}
@@ -1,13 +1,21 @@
 # SPDX-License-Identifier: Apache-2.0
 
 # Standard
+from abc import abstractmethod
 import logging
 
 # Third Party
 from datasets import Dataset
+import pyarrow
+import pyarrow.compute as pc
 
 # First Party
 from instructlab.sdg.utils import pandas
+from instructlab.sdg.utils.arrow import (
+    dataset_from_table,
+    dataset_to_table,
+    table_to_dataset,
+)
 
 # Local
 from ..registry import BlockRegistry
@@ -16,6 +24,37 @@ from .block import Block
 logger = logging.getLogger(__name__)
 
 
+class ColumnTransformBlock(Block):
+    """
+    Base class of blocks that only rearrange the columns of their input,
+    computing every row from the same row of the input without any I/O.
+
+    Subclasses implement transform_table over the Arrow table of the
+    samples. Pipelines fuse consecutive column transforms into a single
+    pass over the table, so a subclass that overrides generate is run on
+    its own instead.
+    """
+
+    @abstractmethod
+    def transform_table(self, table: pyarrow.Table) -> pyarrow.Table:
+        """The columns of the output, computed from those of the input"""
+
+    def generate(self, samples: Dataset) -> Dataset:
+        table = self.transform_table(dataset_to_table(samples))
+        return dataset_from_table(
+            samples, table, (type(self).__name__, self.block_name)
+        )
+
+
+def _set_column(table: pyarrow.Table, name: str, column) -> pyarrow.Table:
+    """Replace the column in place if it exists, or else append it, like
+    Dataset.map does with the keys returned for each row
+    """
+    if name in table.column_names:
+        return table.set_column(table.column_names.index(name), name, column)
+    return table.append_column(name, column)
+
+
 # This is part of the public API.
 @BlockRegistry.register("SamplePopulatorBlock")
 class SamplePopulatorBlock(Block):
@@ -49,7 +88,7 @@ class SamplePopulatorBlock(Block):
 
 # This is part of the public API.
 @BlockRegistry.register("SelectorBlock")
-class SelectorBlock(Block):
+class SelectorBlock(ColumnTransformBlock):
     def __init__(
         self, ctx, pipe, block_name, choice_map, choice_col, output_col
     ) -> None:
@@ -67,19 +106,47 @@ class SelectorBlock(Block):
 
         return samples.map(select_choice, num_proc=num_proc)
 
-    def generate(self, samples: Dataset) -> Dataset:
-        return self._map_select_choice(
-            samples,
-            self.choice_map,
-            self.choice_col,
-            self.output_col,
-            self.ctx.dataset_num_procs,
+    def transform_table(self, table: pyarrow.Table) -> pyarrow.Table:
+        sources = list(dict.fromkeys(self.choice_map.values()))
+        if len({table.schema.field(col).type for col in sources}) > 1:
+            # The selected values need a common type, so leave it to
+            # Dataset.map to infer one
+            return dataset_to_table(
+                self._map_select_choice(
+                    table_to_dataset(table),
+                    self.choice_map,
+                    self.choice_col,
+                    self.output_col,
+                    self.ctx.dataset_num_procs,
+                )
+            )
+
+        choices = table.column(self.choice_col)
+        keys = pyarrow.array(list(self.choice_map)).cast(choices.type)
+        key_indices = pc.index_in(choices, value_set=keys)
+        if key_indices.null_count:
+            missing = pc.filter(choices, pc.is_null(key_indices))
+            raise KeyError(missing[0].as_py())
+        # Gather each row from the source column its choice maps to, with
+        # the source columns laid end to end
+        source_of_key = pyarrow.array(
+            [sources.index(col) for col in self.choice_map.values()], pyarrow.int64()
         )
+        num_rows = table.num_rows
+        positions = pc.add(
+            pc.multiply(pc.take(source_of_key, key_indices), num_rows),
+            pyarrow.array(range(num_rows), pyarrow.int64()),
+        )
+        values = pyarrow.chunked_array(
+            [chunk for col in sources for chunk in table.column(col).chunks],
+            table.schema.field(sources[0]).type,
+        )
+        return _set_column(table, self.output_col, values.take(positions))
 
 
 # This is part of the public API.
 @BlockRegistry.register("CombineColumnsBlock")
-class CombineColumnsBlock(Block):
+class CombineColumnsBlock(ColumnTransformBlock):
     def __init__(
         self, ctx, pipe, block_name, columns, output_col, separator="\n\n"
     ) -> None:
@@ -97,18 +164,29 @@ class CombineColumnsBlock(Block):
 
         return samples.map(combine, num_proc=num_proc)
 
-    def generate(self, samples: Dataset) -> Dataset:
-        return self._map_combine(
-            samples,
-            self.columns,
-            self.output_col,
-            self.separator,
-            self.ctx.dataset_num_procs,
-        )
+    def transform_table(self, table: pyarrow.Table) -> pyarrow.Table:
+        columns = [table.column(col) for col in self.columns]
+        if any(
+            not pyarrow.types.is_string(column.type) or column.null_count
+            for column in columns
+        ):
+            # Only plain strings can be joined, let str.join raise its
+            # usual error for anything else
+            return dataset_to_table(
+                self._map_combine(
+                    table_to_dataset(table),
+                    self.columns,
+                    self.output_col,
+                    self.separator,
+                    self.ctx.dataset_num_procs,
+                )
+            )
+        combined = pc.binary_join_element_wise(*columns, self.separator)
+        return _set_column(table, self.output_col, combined)
 
 
 @BlockRegistry.register("FlattenColumnsBlock")
-class FlattenColumnsBlock(Block):
+class FlattenColumnsBlock(ColumnTransformBlock):
     """Melt/transform a data from a wide format to a long format see pandas.melt for a description
 
     Args:
@@ -125,20 +203,41 @@ class FlattenColumnsBlock(Block):
         self.value_name = value_name
         self.var_name = var_name
 
-    def generate(self, samples: Dataset) -> Dataset:
-        df = samples.to_pandas()
-        id_cols = [col for col in samples.column_names if col not in self.var_cols]
-        flatten_df = df.melt(
+    def transform_table(self, table: pyarrow.Table) -> pyarrow.Table:
+        id_cols = [col for col in table.column_names if col not in self.var_cols]
+        values = [table.column(col) for col in self.var_cols]
+        if self.value_name in id_cols:
+            raise ValueError(
+                f"value_name ({self.value_name}) cannot match an element in the DataFrame columns."
+            )
+        if len({value.type for value in values}) > 1:
+            # pandas decides what type the mixed values end up with
+            return self._melt_with_pandas(table, id_cols)
+
+        # Like pandas.melt, the rows for the first column come first
+        var_name = self.var_name if self.var_name is not None else "variable"
+        id_table = table.select(id_cols)
+        return pyarrow.concat_tables(
+            [
+                id_table.append_column(
+                    var_name, pyarrow.array([col] * table.num_rows, pyarrow.string())
+                ).append_column(self.value_name, value)
+                for col, value in zip(self.var_cols, values)
+            ]
+        )
+
+    def _melt_with_pandas(self, table: pyarrow.Table, id_cols) -> pyarrow.Table:
+        flatten_df = table.to_pandas().melt(
             id_vars=id_cols,
             value_vars=self.var_cols,
             value_name=self.value_name,
             var_name=self.var_name,
         )
-        return pandas.dataset_from_pandas_dataframe(flatten_df)
+        return dataset_to_table(pandas.dataset_from_pandas_dataframe(flatten_df))
 
 
 @BlockRegistry.register("DuplicateColumnsBlock")
-class DuplicateColumnsBlock(Block):
+class DuplicateColumnsBlock(ColumnTransformBlock):
     def __init__(self, ctx, pipe, block_name: str, columns_map: dict) -> None:
         """Create duplicate of columns specified in column map.
 
@@ -148,16 +247,18 @@ class DuplicateColumnsBlock(Block):
         super().__init__(ctx, pipe, block_name)
         self.columns_map = columns_map
 
-    def generate(self, samples: Dataset):
-        for col_to_dup in self.columns_map:
-            samples = samples.add_column(
-                self.columns_map[col_to_dup], samples[col_to_dup]
-            )
-        return samples
+    def transform_table(self, table: pyarrow.Table) -> pyarrow.Table:
+        for col_to_dup, new_col in self.columns_map.items():
+            if new_col in table.column_names:
+                raise ValueError(
+                    f"Can't duplicate {col_to_dup} as {new_col}, the column already exists"
+                )
+            table = table.append_column(new_col, table.column(col_to_dup))
+        return table
 
 
 @BlockRegistry.register("RenameColumnsBlock")
-class RenameColumnsBlock(Block):
+class RenameColumnsBlock(ColumnTransformBlock):
     def __init__(self, ctx, pipe, block_name: str, columns_map: dict) -> None:
         """Rename dataset columns.
 
@@ -167,9 +268,19 @@ class RenameColumnsBlock(Block):
         self.columns_map = columns_map
         super().__init__(ctx, pipe, block_name)
 
-    def generate(self, samples: Dataset):
-        samples = samples.rename_columns(self.columns_map)
-        return samples
+    def transform_table(self, table: pyarrow.Table) -> pyarrow.Table:
+        # The same checks as Dataset.rename_columns
+        missing = set(self.columns_map) - set(table.column_names)
+        if missing:
+            raise ValueError(
+                f"Original column names {missing} not in the dataset. Current columns in the dataset: {table.column_names}"
+            )
+        new_names = [self.columns_map.get(col, col) for col in table.column_names]
+        if len(set(new_names)) != len(new_names):
+            raise ValueError(
+                f"New column names {list(self.columns_map.values())} already in the dataset. Please choose column names which are not already in the dataset. Current columns in the dataset: {table.column_names}"
+            )
+        return table.rename_columns(new_names)
 
 
 @BlockRegistry.register("SetToMajorityValueBlock")
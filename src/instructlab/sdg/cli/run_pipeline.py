@@ -2,6 +2,8 @@
 
 # Standard
 from pathlib import Path
+import json
+import logging
 import os
 
 # Third Party
@@ -9,9 +11,20 @@ from datasets import Dataset
 import openai
 
 # First Party
+from instructlab.sdg.autotune import AutoTuner
+from instructlab.sdg.clientpool import ClientPool
+from instructlab.sdg.estimate import measure_throughput
+from instructlab.sdg.hedging import HedgePolicy
 from instructlab.sdg.pipeline import Pipeline, PipelineContext
+from instructlab.sdg.profiling import PipelineProfiler
+from instructlab.sdg.ratelimit import RetryPolicy
+from instructlab.sdg.response_cache import SQLiteResponseCache
+from instructlab.sdg.utils.arrow import slice_dataset
 from instructlab.sdg.utils.json import jldump, jlload
 from instructlab.sdg.utils.logging import setup_logger
+from instructlab.sdg.workqueue import DEFAULT_SHARD_SIZE, WorkQueue, batch_shard_size
+
+logger = logging.getLogger(__name__)
 
 if __name__ == "__main__":
     # Standard
@@ -43,8 +56,35 @@ if __name__ == "__main__":
     parser.add_argument(
         "--endpoint-url",
         type=str,
-        default="http://localhost:8000/v1",
-        help="URL endpoint of an OpenAI-compatible API server running your teacher model.",
+        action="append",
+        help="URL endpoint of an OpenAI-compatible API server running your teacher model. Give it multiple times to spread the requests over several replicas of the teacher model. Defaults to http://localhost:8000/v1.",
+    )
+    parser.add_argument(
+        "--endpoint-weight",
+        type=float,
+        action="append",
+        help="With multiple --endpoint-url, the share of the requests each endpoint gets relative to the others, in the same order. Defaults to equal weights.",
+    )
+    parser.add_argument(
+        "--max-requests-per-second",
+        type=float,
+        help="The maximum number of requests per second sent to each endpoint.",
+    )
+    parser.add_argument(
+        "--max-tokens-per-minute",
+        type=float,
+        help="The maximum number of tokens per minute used on each endpoint, estimated from the prompts plus the max_tokens of every completion.",
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=RetryPolicy().max_retries,
+        help="The maximum number of times a request failing with a retryable error, such as a 429 or 503 status, is retried with a jittered backoff.",
+    )
+    parser.add_argument(
+        "--hedge-percentile",
+        type=float,
+        help="Send a duplicate of any temperature 0 request still running after this percentile of the latency of similar requests, to another endpoint if there is one, and use whichever answer arrives first.",
     )
     parser.add_argument(
         "--model-family",
@@ -65,6 +105,65 @@ if __name__ == "__main__":
         default="EMPTY",
         help="API key for the OpenAI-compatible API endpoint",
     )
+    parser.add_argument(
+        "--autotune",
+        action="store_true",
+        help="Adjust the batch size and number of concurrent batches at runtime based on the observed LLM latency and error rates.",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Write a JSON profile of every block, with its wall time, LLM wait time, row counts and memory use, next to the output file.",
+    )
+    parser.add_argument(
+        "--estimate",
+        action="store_true",
+        help="Instead of running the pipeline, print the number of LLM requests, prompt tokens and completion tokens every block would need, along with the LLM time projected from the measured throughput of the server, and write them next to the output file.",
+    )
+    parser.add_argument(
+        "--estimate-pilot-size",
+        type=int,
+        help="With --estimate, run the pipeline over this many input samples to measure the yield of every block instead of assuming it.",
+    )
+    parser.add_argument(
+        "--estimate-yield",
+        type=str,
+        action="append",
+        default=[],
+        metavar="BLOCK=FRACTION",
+        help="With --estimate, the fraction of rows a block keeps. Blocks not listed are assumed to keep every row. May be given multiple times.",
+    )
+    parser.add_argument(
+        "--estimate-tokenizer",
+        type=str,
+        help="With --estimate, the name or path of a Hugging Face tokenizer used to count prompt tokens. Without one, a token is assumed to be four characters.",
+    )
+    parser.add_argument(
+        "--work-queue",
+        type=str,
+        help="A directory shared with other workers running the same pipeline over the same input, such as on other hosts. The input is split into shards that every worker claims one at a time, and the outputs of the shards are kept in this directory until merged with --merge.",
+    )
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=DEFAULT_SHARD_SIZE,
+        help="With --work-queue, the number of input samples in a shard, rounded up to a whole number of batches.",
+    )
+    parser.add_argument(
+        "--merge",
+        action="store_true",
+        help="With --work-queue, instead of running the pipeline, write the outputs of every shard to the output file, in the order of the input. Fails if any shard is not done.",
+    )
+    parser.add_argument(
+        "--response-cache",
+        type=str,
+        help="A SQLite database the completions of the teacher model are kept in. Requests already in it, with the same prompt and generation arguments, reuse their completions instead of being sent again.",
+    )
+    parser.add_argument(
+        "--reuse-sampled-responses",
+        action="store_true",
+        help="With --response-cache, also reuse the completions of requests with a temperature above 0.",
+    )
     parser.add_argument(
         "--log-level",
         type=str,
@@ -74,17 +173,95 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
     setup_logger(args.log_level)
-    client = openai.OpenAI(base_url=args.endpoint_url, api_key=args.api_key)
+    endpoint_urls = args.endpoint_url or ["http://localhost:8000/v1"]
+    client = ClientPool.from_urls(
+        endpoint_urls,
+        api_key=args.api_key,
+        weights=args.endpoint_weight,
+        requests_per_second=args.max_requests_per_second,
+        tokens_per_minute=args.max_tokens_per_minute,
+        retry_policy=RetryPolicy(max_retries=args.max_retries),
+        hedge_policy=(
+            HedgePolicy(percentile=args.hedge_percentile)
+            if args.hedge_percentile
+            else None
+        ),
+    )
     # TODO: Remove num_instructions_to_generate hardcode of 30 here,
     # but first we need to remove it as a required parameter of the
     # PipelineContext generally.
     #
     # https://github.com/instructlab/sdg/issues/491
     pipeline_context = PipelineContext(client, args.model_family, args.model_id, 30)
+    if args.autotune:
+        pipeline_context.autotuner = AutoTuner()
+    if args.response_cache:
+        pipeline_context.response_cache = SQLiteResponseCache(
+            args.response_cache, reuse_sampled=args.reuse_sampled_responses
+        )
+    if args.profile:
+        pipeline_context.profiler = PipelineProfiler(
+            str(Path(args.output).absolute().with_suffix(".profile.json"))
+        )
     pipeline_path = Path(args.pipeline).absolute()
     pipeline = Pipeline.from_file(pipeline_context, pipeline_path)
     input_path = Path(args.input).absolute()
     input_ds = Dataset.from_list(jlload(str(input_path)))
-    output_ds = pipeline.generate(input_ds)
     output_path = Path(args.output).absolute()
-    jldump(output_ds, str(output_path))
+    if args.estimate:
+        tokenizer = None
+        if args.estimate_tokenizer:
+            # Third Party
+            from transformers import AutoTokenizer
+
+            tokenizer = AutoTokenizer.from_pretrained(args.estimate_tokenizer)
+        yields = {}
+        for block_yield in args.estimate_yield:
+            block_name, _, fraction = block_yield.partition("=")
+            yields[block_name] = float(fraction)
+        estimate = pipeline.estimate(
+            input_ds,
+            tokenizer=tokenizer,
+            yields=yields,
+            pilot_size=args.estimate_pilot_size,
+        )
+        # Without a model id or a reachable server the runtime can not be
+        # projected, but the request and token counts still are
+        throughput = None
+        if args.model_id:
+            try:
+                throughput = measure_throughput(client, args.model_id)
+            except openai.OpenAIError as err:
+                logger.warning(f"Could not measure the LLM server throughput: {err}")
+        print(estimate.format(throughput))
+        with open(
+            output_path.with_suffix(".estimate.json"), "w", encoding="utf-8"
+        ) as f:
+            json.dump(estimate.to_dict(throughput), f, indent=2)
+    elif args.work_queue:
+        work_queue = WorkQueue(args.work_queue)
+        if not args.merge:
+            # Checkpoints are kept in the work queue, so a worker taking over
+            # the shard of one that died resumes it
+            pipeline_context.checkpoint_dir = work_queue.checkpoint_dir
+            work_queue.plan(
+                [(input_path.name, len(input_ds))],
+                batch_shard_size(args.shard_size, pipeline_context.batch_size),
+            )
+            work_queue.run(
+                lambda shard: pipeline.generate(
+                    slice_dataset(input_ds, shard.start, shard.end), shard.shard_id
+                )
+            )
+            logger.info("Shards not done yet: %d", len(work_queue.pending()))
+        else:
+            work_queue.merge_input(input_path.name, str(output_path))
+    else:
+        output_ds = pipeline.generate(input_ds)
+        jldump(output_ds, str(output_path))
+        if client.hedge_policy is not None:
+            logger.info("Hedged requests: %s", client.hedge_policy.stats())
+        if pipeline_context.response_cache is not None:
+            logger.info("Cached responses: %s", pipeline_context.response_cache.stats())
+    if pipeline_context.profiler is not None:
+        pipeline_context.profiler.save()
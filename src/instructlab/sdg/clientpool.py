@@ -0,0 +1,609 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+from concurrent import futures
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Sequence, Union
+import asyncio
+import functools
+import logging
+import threading
+import time
+
+# Third Party
+from openai import AsyncOpenAI, OpenAI
+import openai
+
+# Local
+from .hedging import HedgePolicy
+from .ratelimit import RateLimiter, RetryPolicy, estimate_request_tokens
+
+logger = logging.getLogger(__name__)
+
+
+def is_replica_failure(err: Exception) -> bool:
+    """Whether an exception means the replica that served the request is in
+    trouble, rather than the request being bad
+    """
+    if isinstance(err, openai.APIConnectionError):
+        # Also covers timeouts
+        return True
+    return isinstance(err, openai.APIStatusError) and err.status_code >= 500
+
+
+class _PooledStream:
+    """
+    A streamed response, which keeps its replica counted as busy until it
+    has been read to the end or closed. Reading from it fails the replica
+    like a failed request would.
+    """
+
+    def __init__(self, stream, release) -> None:
+        self._stream = stream
+        self._release = release
+        self._released = False
+        self._iterator = None
+
+    def _done(self, failed: bool) -> None:
+        if not self._released:
+            self._released = True
+            self._release(failed)
+
+    def __iter__(self):
+        try:
+            yield from self._stream
+        except Exception as err:
+            self._done(is_replica_failure(err))
+            raise
+        finally:
+            self._done(False)
+
+    def __next__(self):
+        if self._iterator is None:
+            self._iterator = iter(self)
+        return next(self._iterator)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def close(self) -> None:
+        try:
+            self._stream.close()
+        finally:
+            self._done(False)
+
+
+class _AsyncPooledStream(_PooledStream):
+    """_PooledStream, for the streamed responses of an AsyncOpenAI client"""
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self._stream:
+                yield chunk
+        except Exception as err:
+            self._done(is_replica_failure(err))
+            raise
+        finally:
+            self._done(False)
+
+    async def __anext__(self):
+        if self._iterator is None:
+            self._iterator = aiter(self)
+        return await anext(self._iterator)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.close()
+
+    async def close(self) -> None:  # pylint: disable=invalid-overridden-method
+        try:
+            await self._stream.close()
+        finally:
+            self._done(False)
+
+
+class _Endpoint:  # pylint: disable=too-many-instance-attributes
+    """One replica of the teacher model, along with its load and health"""
+
+    def __init__(
+        self, client: OpenAI, weight: float, limiter: Optional[RateLimiter]
+    ) -> None:
+        self.client = client
+        self.weight = weight
+        self.limiter = limiter
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self._async_client: Optional[AsyncOpenAI] = None
+
+    @property
+    def base_url(self) -> str:
+        return str(self.client.base_url)
+
+    def async_client(self) -> AsyncOpenAI:
+        if self._async_client is None:
+            self._async_client = AsyncOpenAI(
+                api_key=self.client.api_key,
+                base_url=self.client.base_url,
+                timeout=self.client.timeout,
+                max_retries=self.client.max_retries,
+            )
+        return self._async_client
+
+    def load(self, tokens: int) -> tuple[float, float, float]:
+        # Replicas that can take the request without waiting for their rate
+        # limits first, then least outstanding requests. Ties, such as when
+        # requests are sent one at a time, go to the replica with the fewest
+        # requests so far, so traffic is still spread according to the
+        # weights.
+        delay = self.limiter.delay(tokens) if self.limiter is not None else 0.0
+        return (delay, self.outstanding / self.weight, self.requests / self.weight)
+
+    def reserve(self, tokens: int) -> float:
+        if self.limiter is None:
+            return 0.0
+        return self.limiter.reserve(tokens)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "base_url": self.base_url,
+            "weight": self.weight,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ejections": self.ejections,
+            "rate_limited_seconds": self.limiter.waited if self.limiter else 0.0,
+        }
+
+
+class _Completions:
+    """Stands in for client.completions and client.chat.completions"""
+
+    def __init__(self, pool: "ClientPool", resource: Sequence[str]) -> None:
+        self._pool = pool
+        self._resource = resource
+
+    def create(self, **kwargs):
+        return self._pool._create(self._resource, kwargs)
+
+
+class _AsyncCompletions:
+    """Stands in for the completions of an AsyncOpenAI client"""
+
+    def __init__(self, pool: "ClientPool", resource: Sequence[str]) -> None:
+        self._pool = pool
+        self._resource = resource
+
+    async def create(self, **kwargs):
+        return await self._pool._acreate(self._resource, kwargs)
+
+
+# This is part of the public API.
+class ClientPool:  # pylint: disable=too-many-instance-attributes
+    """
+    A pool of OpenAI clients, one for each replica of the teacher model, that
+    can be given to a PipelineContext in place of a single client.
+
+    Each request goes to the healthy replica with the fewest requests in
+    flight relative to its weight, preferring replicas whose rate limits
+    let it through without waiting. A replica that fails `max_failures`
+    requests in a row, with a connection error, a timeout or a 5xx status,
+    is ejected from the pool for `ejection_time` seconds. After the
+    ejection ends, a single further failure ejects it again.
+
+    Requests that fail in a way the retry_policy considers retryable are
+    sent again at once to a replica that has not been tried yet. Once every
+    replica has been tried, they are retried with a jittered backoff.
+    Requests rejected with any other status are raised at once, as every
+    replica would reject them.
+
+    Only client.completions and client.chat.completions are available, as
+    those are the only APIs the blocks use. A pool of a single client is
+    the way to rate limit or retry the requests to a single server.
+
+    Args:
+        clients: The client of every replica.
+        weights: The share of the requests each replica should get,
+            relative to the others. Defaults to equal weights.
+        max_failures: The number of consecutive failures after which a
+            replica is ejected.
+        ejection_time: The number of seconds an ejected replica gets no
+            requests, unless every replica is ejected.
+        requests_per_second: The maximum rate of requests sent to each
+            replica, or a list with the limit of every replica.
+        tokens_per_minute: The maximum rate of tokens used on each
+            replica, or a list with the limit of every replica. The tokens
+            of a request are estimated from its prompts plus max_tokens for
+            every completion.
+        retry_policy: How failed requests are retried. Defaults to a
+            RetryPolicy with its default settings.
+        hedge_policy: An optional HedgePolicy, to send a duplicate of the
+            requests that take longer than most to another replica.
+    """
+
+    DEFAULT_MAX_FAILURES = 3
+    DEFAULT_EJECTION_TIME = 30.0
+
+    def __init__(
+        self,
+        clients: Sequence[OpenAI],
+        weights: Optional[Sequence[float]] = None,
+        max_failures: int = DEFAULT_MAX_FAILURES,
+        ejection_time: float = DEFAULT_EJECTION_TIME,
+        requests_per_second: Union[None, float, Sequence[Optional[float]]] = None,
+        tokens_per_minute: Union[None, float, Sequence[Optional[float]]] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        hedge_policy: Optional[HedgePolicy] = None,
+    ) -> None:
+        if not clients:
+            raise ValueError("A ClientPool needs at least one client")
+        if weights is None:
+            weights = [1.0] * len(clients)
+        if len(weights) != len(clients):
+            raise ValueError("A ClientPool needs one weight for every client")
+        if any(weight <= 0 for weight in weights):
+            raise ValueError("The weights of a ClientPool must be positive")
+        limits = zip(
+            _per_client(requests_per_second, clients, "requests_per_second"),
+            _per_client(tokens_per_minute, clients, "tokens_per_minute"),
+        )
+        self.endpoints = [
+            _Endpoint(
+                client,
+                float(weight),
+                RateLimiter(*limit) if any(limit) else None,
+            )
+            for client, weight, limit in zip(clients, weights, limits)
+        ]
+        self.max_failures = max_failures
+        self.ejection_time = ejection_time
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.hedge_policy = hedge_policy
+        self._executor: Optional[futures.ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self.completions = _Completions(self, ("completions",))
+        self.chat = SimpleNamespace(
+            completions=_Completions(self, ("chat", "completions"))
+        )
+        self._async_view: Optional[AsyncClientPool] = None
+
+    @classmethod
+    def from_urls(
+        cls,
+        base_urls: Sequence[str],
+        api_key: str = "EMPTY",
+        weights: Optional[Sequence[float]] = None,
+        **kwargs,
+    ) -> "ClientPool":
+        """
+        Create a pool with an OpenAI client for each of base_urls. The other
+        keyword arguments are passed to ClientPool, unless they are one of
+        timeout or max_retries, which are passed to every client. Unless
+        given, max_retries is 0 so that retries are left to the pool.
+        """
+        client_kwargs = {
+            name: kwargs.pop(name)
+            for name in ("timeout", "max_retries")
+            if name in kwargs
+        }
+        client_kwargs.setdefault("max_retries", 0)
+        clients = [
+            OpenAI(base_url=base_url, api_key=api_key, **client_kwargs)
+            for base_url in base_urls
+        ]
+        return cls(clients, weights, **kwargs)
+
+    @property
+    def clients(self) -> List[OpenAI]:
+        return [endpoint.client for endpoint in self.endpoints]
+
+    def async_pool(self) -> "AsyncClientPool":
+        """The asyncio counterpart of this pool, sharing its replicas, load
+        and health
+        """
+        if self._async_view is None:
+            self._async_view = AsyncClientPool(self)
+        return self._async_view
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """The load and number of requests, failures and ejections of every
+        replica
+        """
+        with self._lock:
+            return [endpoint.to_dict() for endpoint in self.endpoints]
+
+    def _acquire(
+        self, tried: List[_Endpoint], tokens: int, avoid: Sequence[_Endpoint] = ()
+    ) -> _Endpoint:
+        with self._lock:
+            now = time.monotonic()
+            candidates = [
+                endpoint for endpoint in self.endpoints if endpoint not in tried
+            ]
+            healthy = [
+                endpoint for endpoint in candidates if endpoint.ejected_until <= now
+            ]
+            healthy = [
+                endpoint for endpoint in healthy if endpoint not in avoid
+            ] or healthy
+            if healthy:
+                endpoint = min(healthy, key=lambda endpoint: endpoint.load(tokens))
+            else:
+                # Every replica is ejected, so wait for none of them and use
+                # the one that will be back first
+                endpoint = min(candidates, key=lambda endpoint: endpoint.ejected_until)
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def _release(self, endpoint: _Endpoint, failed: bool) -> None:
+        with self._lock:
+            endpoint.outstanding -= 1
+            if not failed:
+                endpoint.consecutive_failures = 0
+                return
+            endpoint.failures += 1
+            endpoint.consecutive_failures += 1
+            now = time.monotonic()
+            if (
+                endpoint.consecutive_failures >= self.max_failures
+                and endpoint.ejected_until <= now
+            ):
+                endpoint.ejected_until = now + self.ejection_time
+                endpoint.ejections += 1
+                logger.warning(
+                    "Ejecting LLM server %s for %.0fs after %d consecutive failures",
+                    endpoint.base_url,
+                    self.ejection_time,
+                    endpoint.consecutive_failures,
+                )
+
+    def _retry(
+        self,
+        endpoint: _Endpoint,
+        tried: List[_Endpoint],
+        attempt: int,
+        err: Exception,
+    ) -> Optional[tuple[int, float]]:
+        """Record the failure of a request, and return the number of backoffs
+        so far and how long to wait before retrying it, or None if it should
+        not be retried
+        """
+        self._release(endpoint, is_replica_failure(err))
+        if not self.retry_policy.is_retryable(err):
+            return None
+        tried.append(endpoint)
+        if len(tried) < len(self.endpoints):
+            logger.warning(
+                "Request to LLM server %s failed, retrying on another server: %s",
+                endpoint.base_url,
+                err,
+            )
+            return attempt, 0.0
+        if attempt >= self.retry_policy.max_retries:
+            return None
+        # Every replica was tried, so back off and try them all again
+        tried.clear()
+        delay = self.retry_policy.backoff(attempt, err)
+        logger.warning(
+            "Request to LLM server %s failed, retrying in %.1fs: %s",
+            endpoint.base_url,
+            delay,
+            err,
+        )
+        return attempt + 1, delay
+
+    def _create(self, resource: Sequence[str], kwargs: Dict[str, Any]):
+        policy = self.hedge_policy
+        if policy is None or not policy.applies_to(kwargs):
+            return self._send(resource, kwargs)
+        kind = policy.request_kind(resource, kwargs)
+        delay = policy.delay(kind)
+        if delay is None:
+            return self._timed_send(kind, resource, kwargs)
+
+        # The thread sending a request can not be interrupted, so the request
+        # is sent from a thread of its own, which starts sending it at once,
+        # and only its hedge waits for one of the hedging threads
+        chosen: List[_Endpoint] = []
+        primary = _start_thread(self._timed_send, kind, resource, kwargs, chosen)
+        done, _ = futures.wait([primary], timeout=delay)
+        if done or not policy.try_hedge():
+            return primary.result()
+        hedge = self._hedge_executor().submit(
+            self._timed_send, kind, resource, kwargs, None, chosen
+        )
+        pending = {primary, hedge}
+        while pending:
+            done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    # A request already sent runs to completion, but its
+                    # response is dropped
+                    for other in pending:
+                        other.cancel()
+                    policy.record_win(future is hedge)
+                    return future.result()
+        return primary.result()
+
+    async def _acreate(self, resource: Sequence[str], kwargs: Dict[str, Any]):
+        policy = self.hedge_policy
+        if policy is None or not policy.applies_to(kwargs):
+            return await self._asend(resource, kwargs)
+        kind = policy.request_kind(resource, kwargs)
+        delay = policy.delay(kind)
+        if delay is None:
+            return await self._atimed_send(kind, resource, kwargs)
+
+        chosen: List[_Endpoint] = []
+        primary = asyncio.ensure_future(
+            self._atimed_send(kind, resource, kwargs, chosen)
+        )
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done or not policy.try_hedge():
+            return await primary
+        hedge = asyncio.ensure_future(
+            self._atimed_send(kind, resource, kwargs, None, chosen)
+        )
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        policy.record_win(task is hedge)
+                        return task.result()
+            return primary.result()
+        finally:
+            # Cancel the request that lost, or both if this one was cancelled
+            for task in (primary, hedge):
+                task.cancel()
+
+    def _hedge_executor(self) -> futures.ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = futures.ThreadPoolExecutor(
+                    max_workers=self.hedge_policy.max_workers,
+                    thread_name_prefix="sdg-hedge",
+                )
+            return self._executor
+
+    def _timed_send(self, kind, resource, kwargs, chosen=None, avoid=()):
+        start = time.monotonic()
+        response = self._send(resource, kwargs, chosen, avoid)
+        self.hedge_policy.record(kind, time.monotonic() - start)
+        return response
+
+    async def _atimed_send(self, kind, resource, kwargs, chosen=None, avoid=()):
+        start = time.monotonic()
+        response = await self._asend(resource, kwargs, chosen, avoid)
+        self.hedge_policy.record(kind, time.monotonic() - start)
+        return response
+
+    def _send(
+        self,
+        resource: Sequence[str],
+        kwargs: Dict[str, Any],
+        chosen: Optional[List[_Endpoint]] = None,
+        avoid: Sequence[_Endpoint] = (),
+    ):
+        """Send a request, retrying it as needed. The replica it is first
+        sent to is added to chosen, and replicas in avoid are only used if
+        there is no other healthy one.
+        """
+        tokens = estimate_request_tokens(kwargs)
+        tried: List[_Endpoint] = []
+        attempt = 0
+        while True:
+            endpoint = self._acquire(tried, tokens, avoid)
+            if chosen is not None:
+                chosen.append(endpoint)
+                chosen = None
+            time.sleep(endpoint.reserve(tokens))
+            create = functools.reduce(getattr, resource, endpoint.client).create
+            try:
+                response = create(**kwargs)
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                retry = self._retry(endpoint, tried, attempt, err)
+                if retry is None:
+                    raise
+                attempt, delay = retry
+                time.sleep(delay)
+                continue
+            if kwargs.get("stream"):
+                # The replica is busy until the stream has been read
+                return _PooledStream(
+                    response, functools.partial(self._release, endpoint)
+                )
+            self._release(endpoint, False)
+            return response
+
+    async def _asend(
+        self,
+        resource: Sequence[str],
+        kwargs: Dict[str, Any],
+        chosen: Optional[List[_Endpoint]] = None,
+        avoid: Sequence[_Endpoint] = (),
+    ):
+        tokens = estimate_request_tokens(kwargs)
+        tried: List[_Endpoint] = []
+        attempt = 0
+        while True:
+            endpoint = self._acquire(tried, tokens, avoid)
+            if chosen is not None:
+                chosen.append(endpoint)
+                chosen = None
+            create = functools.reduce(getattr, resource, endpoint.async_client()).create
+            try:
+                await asyncio.sleep(endpoint.reserve(tokens))
+                response = await create(**kwargs)
+            except asyncio.CancelledError:
+                self._release(endpoint, False)
+                raise
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                retry = self._retry(endpoint, tried, attempt, err)
+                if retry is None:
+                    raise
+                attempt, delay = retry
+                await asyncio.sleep(delay)
+                continue
+            if kwargs.get("stream"):
+                return _AsyncPooledStream(
+                    response, functools.partial(self._release, endpoint)
+                )
+            self._release(endpoint, False)
+            return response
+
+
+def _start_thread(fn, *args) -> futures.Future:
+    """Call fn in a new daemon thread, returning the future of its result"""
+    future: futures.Future = futures.Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(*args))
+        except BaseException as err:  # pylint: disable=broad-exception-caught
+            future.set_exception(err)
+
+    threading.Thread(target=run, name="sdg-request", daemon=True).start()
+    return future
+
+
+def _per_client(value, clients, name) -> list:
+    if value is None or isinstance(value, (int, float)):
+        return [value] * len(clients)
+    if len(value) != len(clients):
+        raise ValueError(f"A ClientPool needs one {name} for every client")
+    return list(value)
+
+
+# This is part of the public API.
+class AsyncClientPool:
+    """
+    The asyncio counterpart of a ClientPool, as returned by
+    ClientPool.async_pool and used by Pipeline.agenerate. It stands in for
+    an AsyncOpenAI client, and shares the replicas of the pool it was
+    created from.
+    """
+
+    def __init__(self, pool: ClientPool) -> None:
+        self.pool = pool
+        self.completions = _AsyncCompletions(pool, ("completions",))
+        self.chat = SimpleNamespace(
+            completions=_AsyncCompletions(pool, ("chat", "completions"))
+        )
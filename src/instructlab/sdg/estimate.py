@@ -0,0 +1,323 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+import logging
+import math
+import time
+
+# Third Party
+from tabulate import tabulate
+
+logger = logging.getLogger(__name__)
+
+# Used to approximate token counts when no tokenizer is given
+_CHARS_PER_TOKEN = 4
+
+
+class EstimateOptions:
+    """
+    Settings shared by every block while estimating a pipeline run.
+
+    Args:
+        tokenizer: Counts the tokens of rendered prompts. A Hugging Face
+            tokenizer, or any object with an encode method returning a list
+            of token ids. Without one, a token is assumed to be four
+            characters.
+        yields: The fraction of rows kept by a block, keyed by block name.
+            Used for filter blocks, whose input is not known before the
+            LLM blocks in front of them have run, and as the number of rows
+            each completion of an LLM block parses into. Defaults to 1.0.
+        pilot: Whether blocks really run over the sample, sending requests
+            to the LLM server, so that yields are measured instead of
+            assumed.
+        sample_size: The maximum number of rows each block looks at.
+    """
+
+    DEFAULT_SAMPLE_SIZE = 100
+
+    def __init__(
+        self,
+        tokenizer=None,
+        yields: Optional[Dict[str, float]] = None,
+        pilot: bool = False,
+        sample_size: int = DEFAULT_SAMPLE_SIZE,
+    ) -> None:
+        self.tokenizer = tokenizer
+        self.yields = yields or {}
+        self.pilot = pilot
+        self.sample_size = sample_size
+
+    def count_tokens(self, text: str) -> int:
+        if self.tokenizer is None:
+            return math.ceil(len(text) / _CHARS_PER_TOKEN)
+        return len(self.tokenizer.encode(text))
+
+    def assumed_yield(self, block_name: str) -> float:
+        return float(self.yields.get(block_name, 1.0))
+
+
+class BlockEstimate:  # pylint: disable=too-many-instance-attributes
+    """
+    What running a block over rows_in rows is expected to cost. Request and
+    token counts are projected from a sample, so they are not integers.
+    """
+
+    def __init__(
+        self,
+        block_name: str,
+        block_type: str,
+        rows_in: float,
+        rows_out: Optional[float] = None,
+        llm_requests: float = 0.0,
+        prompt_tokens: float = 0.0,
+        max_completion_tokens: float = 0.0,
+        assumed_yield: Optional[float] = None,
+        children: Optional[List["BlockEstimate"]] = None,
+    ) -> None:
+        self.block_name = block_name
+        self.block_type = block_type
+        self.rows_in = rows_in
+        self.rows_out = rows_in if rows_out is None else rows_out
+        self.llm_requests = llm_requests
+        self.prompt_tokens = prompt_tokens
+        self.max_completion_tokens = max_completion_tokens
+        self.assumed_yield = assumed_yield
+        self.children = children or []
+
+    @classmethod
+    def measured(cls, block, rows: float, sample_in: int, sample_out: int):
+        """The estimate of a block that sends no LLM requests, with a yield
+        measured by running it over a sample
+        """
+        return cls(
+            block.block_name,
+            type(block).__name__,
+            rows,
+            rows * sample_out / sample_in if sample_in else 0.0,
+        )
+
+    @classmethod
+    def combine(
+        cls,
+        block_name: str,
+        block_type: str,
+        rows_in: float,
+        rows_out: float,
+        children: List["BlockEstimate"],
+    ):
+        """The estimate of a group of blocks, totalling their requests"""
+        return cls(
+            block_name,
+            block_type,
+            rows_in,
+            rows_out,
+            llm_requests=sum(child.llm_requests for child in children),
+            prompt_tokens=sum(child.prompt_tokens for child in children),
+            max_completion_tokens=sum(
+                child.max_completion_tokens for child in children
+            ),
+            children=children,
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        estimate = {
+            "block_name": self.block_name,
+            "block_type": self.block_type,
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+            "llm_requests": self.llm_requests,
+            "prompt_tokens": self.prompt_tokens,
+            "max_completion_tokens": self.max_completion_tokens,
+            "assumed_yield": self.assumed_yield,
+        }
+        if self.children:
+            estimate["children"] = [child.to_dict() for child in self.children]
+        return estimate
+
+
+class ServerThroughput:
+    """
+    How fast the LLM server processes tokens with many requests in flight.
+
+    Args:
+        prompt_tokens_per_second: The rate at which prompts are read.
+        completion_tokens_per_second: The rate at which completions are
+            generated.
+    """
+
+    def __init__(
+        self, prompt_tokens_per_second: float, completion_tokens_per_second: float
+    ) -> None:
+        self.prompt_tokens_per_second = prompt_tokens_per_second
+        self.completion_tokens_per_second = completion_tokens_per_second
+
+    def to_dict(self) -> Dict[str, float]:
+        return {
+            "prompt_tokens_per_second": self.prompt_tokens_per_second,
+            "completion_tokens_per_second": self.completion_tokens_per_second,
+        }
+
+
+def measure_throughput(
+    client,
+    model_id: str,
+    concurrency: int = 8,
+    num_requests: int = 16,
+    prompt_tokens: int = 512,
+    max_tokens: int = 128,
+) -> ServerThroughput:
+    """
+    Measure the throughput of the LLM server by sending num_requests
+    requests, concurrency at a time. Long prompts with a single completion
+    token measure how fast prompts are read, and short prompts with long
+    completions how fast tokens are generated.
+    """
+
+    def run(prompt: str, request_max_tokens: int) -> tuple[int, int, float]:
+        def request(_):
+            response = client.completions.create(
+                model=model_id, prompt=prompt, max_tokens=request_max_tokens
+            )
+            usage = getattr(response, "usage", None)
+            if usage is None:
+                return prompt_tokens, request_max_tokens
+            return usage.prompt_tokens, usage.completion_tokens
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            usages = list(executor.map(request, range(num_requests)))
+        elapsed = max(time.monotonic() - start, 1e-6)
+        return (
+            sum(usage[0] for usage in usages),
+            sum(usage[1] for usage in usages),
+            elapsed,
+        )
+
+    read, _, read_elapsed = run("hello " * prompt_tokens, 1)
+    _, generated, generate_elapsed = run(
+        "Write a long story about a lighthouse keeper.", max_tokens
+    )
+    throughput = ServerThroughput(read / read_elapsed, generated / generate_elapsed)
+    logger.info(
+        "Measured LLM server throughput: %.0f prompt tokens/s, %.0f completion tokens/s",
+        throughput.prompt_tokens_per_second,
+        throughput.completion_tokens_per_second,
+    )
+    return throughput
+
+
+# This is part of the public API.
+class PipelineEstimate:
+    """
+    The predicted cost of running a pipeline over a dataset, as returned by
+    Pipeline.estimate.
+
+    Completion token counts assume every completion runs to max_tokens, so
+    they, and the runtime projected from them, are upper bounds.
+    """
+
+    def __init__(
+        self, pipeline: str, rows_in: int, blocks: List[BlockEstimate]
+    ) -> None:
+        self.pipeline = pipeline
+        self.rows_in = rows_in
+        self.blocks = blocks
+
+    @property
+    def rows_out(self) -> float:
+        return self.blocks[-1].rows_out if self.blocks else self.rows_in
+
+    @property
+    def llm_requests(self) -> float:
+        return sum(block.llm_requests for block in self.blocks)
+
+    @property
+    def prompt_tokens(self) -> float:
+        return sum(block.prompt_tokens for block in self.blocks)
+
+    @property
+    def max_completion_tokens(self) -> float:
+        return sum(block.max_completion_tokens for block in self.blocks)
+
+    def projected_runtime(self, throughput: ServerThroughput) -> float:
+        """The projected time in seconds spent waiting on the LLM server"""
+        runtime = 0.0
+        if throughput.prompt_tokens_per_second:
+            runtime += self.prompt_tokens / throughput.prompt_tokens_per_second
+        if throughput.completion_tokens_per_second:
+            runtime += (
+                self.max_completion_tokens / throughput.completion_tokens_per_second
+            )
+        return runtime
+
+    def to_dict(self, throughput: Optional[ServerThroughput] = None) -> Dict[str, Any]:
+        estimate = {
+            "pipeline": self.pipeline,
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+            "llm_requests": self.llm_requests,
+            "prompt_tokens": self.prompt_tokens,
+            "max_completion_tokens": self.max_completion_tokens,
+            "blocks": [block.to_dict() for block in self.blocks],
+        }
+        if throughput is not None:
+            estimate["throughput"] = throughput.to_dict()
+            estimate["projected_runtime"] = self.projected_runtime(throughput)
+        return estimate
+
+    def format(self, throughput: Optional[ServerThroughput] = None) -> str:
+        """A table of the estimate of every block, for people to read"""
+        rows = []
+
+        # Blocks inside branches and other groups are marked with a dash
+        # for every level of nesting
+        def add_rows(blocks, depth):
+            for block in blocks:
+                rows.append(
+                    [
+                        "- " * depth + block.block_name,
+                        block.block_type,
+                        round(block.rows_in),
+                        round(block.rows_out),
+                        math.ceil(block.llm_requests),
+                        round(block.prompt_tokens),
+                        round(block.max_completion_tokens),
+                        "" if block.assumed_yield is None else block.assumed_yield,
+                    ]
+                )
+                add_rows(block.children, depth + 1)
+
+        add_rows(self.blocks, 0)
+        rows.append(
+            [
+                "total",
+                "",
+                self.rows_in,
+                round(self.rows_out),
+                math.ceil(self.llm_requests),
+                round(self.prompt_tokens),
+                round(self.max_completion_tokens),
+                "",
+            ]
+        )
+        table = tabulate(
+            rows,
+            headers=[
+                "block",
+                "type",
+                "rows in",
+                "rows out",
+                "requests",
+                "prompt tokens",
+                "max completion tokens",
+                "assumed yield",
+            ],
+        )
+        lines = [f"Estimate for pipeline {self.pipeline}", table]
+        if throughput is not None:
+            lines.append(
+                f"Projected LLM time: at most {self.projected_runtime(throughput) / 3600:.2f} hours"
+            )
+        return "\n".join(lines)
@@ -113,6 +113,22 @@ def _create_mmlu_evaluation_task(task_name, eval_data_file_path, yaml_file_path)
         yaml.dump(task_yaml, yaml_file, default_flow_style=False)
 
 
+def eval_task_data_file(output_dir, task_name, date_suffix):
+    """The path of the mmlu dataset of task_name"""
+    return f"{output_dir}/node_datasets_{date_suffix}/mmlubench_{task_name}.jsonl"
+
+
+def write_eval_task(task_name, output_dir, date_suffix):
+    """Write the task yaml of the mmlu dataset of task_name"""
+    yaml_file_path = f"{output_dir}/node_datasets_{date_suffix}/{task_name}_task.yaml"
+    logger.info(f"Saving MMLU Task yaml {yaml_file_path}")
+    _create_mmlu_evaluation_task(
+        task_name=task_name,
+        eval_data_file_path=eval_task_data_file(output_dir, task_name, date_suffix),
+        yaml_file_path=yaml_file_path,
+    )
+
+
 def generate_eval_task_data(
     mmlubench_pipe, task_name, samples, output_dir, date_suffix
 ):
@@ -120,19 +136,11 @@ def generate_eval_task_data(
     if len(mmlubench_data):
         mmlubench_data = _post_process_mcq(mmlubench_data)
 
-    eval_data_file_path = (
-        f"{output_dir}/node_datasets_{date_suffix}/mmlubench_{task_name}.jsonl"
-    )
+    eval_data_file_path = eval_task_data_file(output_dir, task_name, date_suffix)
     logger.info(f"Saving MMLU Dataset {eval_data_file_path}")
     mmlubench_data.to_json(eval_data_file_path, orient="records", lines=True)
 
-    yaml_file_path = f"{output_dir}/node_datasets_{date_suffix}/{task_name}_task.yaml"
-    logger.info(f"Saving MMLU Task yaml {yaml_file_path}")
-    _create_mmlu_evaluation_task(
-        task_name=task_name,
-        eval_data_file_path=eval_data_file_path,
-        yaml_file_path=yaml_file_path,
-    )
+    write_eval_task(task_name, output_dir, date_suffix)
 
 
 def mmlubench_pipe_init(ctx):
@@ -1,14 +1,19 @@
 # SPDX-License-Identifier: Apache-2.0
+# pylint: disable=too-many-lines
 
 # Standard
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 from importlib import resources
 from pathlib import Path
-from typing import Optional
+from typing import Iterator, List, Optional
 import glob
 import json
 import logging
 import os
+import queue
+import shutil
+import threading
 import time
 import warnings
 
@@ -27,7 +32,13 @@ from instructlab.sdg.datamixing import (
     _get_question_hack,
     _get_response_hack,
 )
-from instructlab.sdg.eval_data import generate_eval_task_data, mmlubench_pipe_init
+from instructlab.sdg.eval_data import (
+    eval_task_data_file,
+    generate_eval_task_data,
+    mmlubench_pipe_init,
+    write_eval_task,
+)
+from instructlab.sdg.leaf_cache import LeafNodeCache
 from instructlab.sdg.pipeline import (
     FULL_PIPELINES_PACKAGE,
     LLAMA_PIPELINES_PKG,
@@ -35,12 +46,15 @@ from instructlab.sdg.pipeline import (
     Pipeline,
     PipelineContext,
 )
+from instructlab.sdg.profiling import PipelineProfiler
+from instructlab.sdg.response_cache import ResponseCache, SQLiteResponseCache
 from instructlab.sdg.utils import GenerateException
 from instructlab.sdg.utils.json import jldump, jlload
 from instructlab.sdg.utils.taxonomy import (
     leaf_node_to_samples,
     read_taxonomy_leaf_nodes,
 )
+from instructlab.sdg.workqueue import DEFAULT_SHARD_SIZE, WorkQueue, batch_shard_size
 
 logger = logging.getLogger(__name__)
 
@@ -218,6 +232,8 @@ def _context_init(
     batch_num_workers: Optional[int],
     batch_size: Optional[int],
     max_num_tokens: Optional[int] = DEFAULT_MAX_NUM_TOKENS,
+    profiler: Optional[PipelineProfiler] = None,
+    response_cache: Optional[ResponseCache] = None,
 ):
     extra_kwargs = {}
     if batch_size is not None:
@@ -232,6 +248,8 @@ def _context_init(
         checkpoint_dir=checkpoint_dir,
         save_freq=save_freq,
         max_num_tokens=max_num_tokens,
+        profiler=profiler,
+        response_cache=response_cache,
         **extra_kwargs,
     )
 
@@ -307,6 +325,196 @@ def _extract_leaf_node_path_and_type(sample):
     return leaf_node_path, leaf_node_type
 
 
+def _run_leaf_nodes(ctx, run_leaf_node, input_files, max_concurrent_leaf_nodes):
+    """
+    Call run_leaf_node with the input file of every leaf node. With
+    max_concurrent_leaf_nodes above 1, that many leaf nodes are processed at
+    once. Their batches then share one pool of ctx.batch_num_workers
+    threads, so many small leaf nodes keep the teacher busy without
+    multiplying the number of batches in flight.
+    """
+    if max_concurrent_leaf_nodes <= 1 or len(input_files) <= 1:
+        for input_file in input_files:
+            run_leaf_node(input_file)
+        return
+
+    logger.info(
+        "Processing %d leaf nodes, %d at a time",
+        len(input_files),
+        max_concurrent_leaf_nodes,
+    )
+    try:
+        with (
+            ThreadPoolExecutor(max_workers=ctx.batch_num_workers) as batch_executor,
+            ThreadPoolExecutor(
+                max_workers=max_concurrent_leaf_nodes, thread_name_prefix="sdg-leaf"
+            ) as leaf_executor,
+        ):
+            ctx.batch_executor = batch_executor
+            futures = [
+                leaf_executor.submit(run_leaf_node, input_file)
+                for input_file in input_files
+            ]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # Do not start any more leaf nodes after one failed
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        ctx.batch_executor = None
+
+
+def _leaf_node_pipe(pipes, leaf_node_type):
+    knowledge_pipe, freeform_skills_pipe, grounded_skills_pipe = pipes
+    if leaf_node_type == "knowledge":
+        return knowledge_pipe
+    if leaf_node_type == "grounded_skill":
+        return grounded_skills_pipe
+    return freeform_skills_pipe
+
+
+def _generate_leaf_node(
+    pipes, input_file, output_dir, leaf_node_cache=None
+) -> Optional[str]:
+    """
+    Generate data from the samples of one leaf node with the knowledge,
+    freeform skills or grounded skills pipeline in pipes, as fits the leaf
+    node. Returns the file the data was written to, or None if the pipeline
+    generated nothing.
+    """
+    logger.debug("Generating data from input file: %s", input_file)
+    samples = jlload(input_file)
+    if not samples:
+        raise GenerateException("Error: No samples found in input file {input_file}")
+    # For now we assume every sample in the file is the same type
+    first_sample = samples[0]
+    leaf_node_path, leaf_node_type = _extract_leaf_node_path_and_type(first_sample)
+    pipe = _leaf_node_pipe(pipes, leaf_node_type)
+
+    output_file = os.path.join(output_dir, os.path.basename(input_file))
+    cache_key = None
+    if leaf_node_cache is not None:
+        cache_key = leaf_node_cache.pipeline_key(pipe, input_file)
+        cached_file = leaf_node_cache.get("generated", cache_key)
+        if cached_file is not None:
+            if os.path.getsize(cached_file) == 0:
+                logger.warning("Empty generated dataset for input file: %s", input_file)
+                return None
+            shutil.copyfile(cached_file, output_file)
+            logger.info("Reused generated samples of %s", leaf_node_path)
+            return output_file
+
+    samples_ds = Dataset.from_list(samples)
+    logger.debug("Generating from samples: %s", samples_ds)
+
+    new_generated_data = pipe.generate(samples_ds, leaf_node_path)
+    if len(new_generated_data) == 0:
+        if leaf_node_cache is not None:
+            leaf_node_cache.put("generated", cache_key, None)
+        logger.warning("Empty generated dataset for input file: %s", input_file)
+        return None
+
+    jldump(new_generated_data, output_file)
+    if leaf_node_cache is not None:
+        leaf_node_cache.put("generated", cache_key, output_file)
+    logger.info("Generated %d samples", len(new_generated_data))
+    logger.debug("Generated data: %s", new_generated_data)
+    return output_file
+
+
+def _generate_leaf_node_eval(
+    mmlu_bench_pipe, input_file, output_dir, date_suffix, leaf_node_cache=None
+):
+    """Generate the mmlu eval task data of one leaf node, if it is knowledge"""
+    logger.debug("Generating eval data from input file: %s", input_file)
+    samples = jlload(input_file)
+    if not samples:
+        raise GenerateException("Error: No samples found in input file {input_file}")
+    samples_ds = Dataset.from_list(samples)
+    # For now we assume every sample in the file is the same type
+    first_sample = samples[0]
+    leaf_node_path, leaf_node_type = _extract_leaf_node_path_and_type(first_sample)
+    is_knowledge = False
+    if leaf_node_type == "knowledge":
+        is_knowledge = True
+
+    if not is_knowledge:
+        return
+    if leaf_node_cache is None:
+        generate_eval_task_data(
+            mmlu_bench_pipe,
+            leaf_node_path,
+            samples_ds,
+            output_dir,
+            date_suffix,
+        )
+        return
+
+    eval_file = eval_task_data_file(output_dir, leaf_node_path, date_suffix)
+    cache_key = leaf_node_cache.pipeline_key(mmlu_bench_pipe, input_file)
+    cached_file = leaf_node_cache.get("eval", cache_key)
+    if cached_file is not None:
+        os.makedirs(os.path.dirname(eval_file), exist_ok=True)
+        shutil.copyfile(cached_file, eval_file)
+        write_eval_task(leaf_node_path, output_dir, date_suffix)
+        return
+    generate_eval_task_data(
+        mmlu_bench_pipe,
+        leaf_node_path,
+        samples_ds,
+        output_dir,
+        date_suffix,
+    )
+    leaf_node_cache.put("eval", cache_key, eval_file)
+
+
+def _postprocess_leaf_node(mixer, input_file, use_legacy_pretraining_format):
+    """
+    Collect the generated data of one leaf node into the mixer, returning
+    it for the combined train files
+    """
+    logger.debug("Postprocessing generated taxonomy date in input file: %s", input_file)
+    samples = jlload(input_file)
+    if not samples:
+        raise GenerateException("Error: No samples found in input file {input_file}")
+    # For now we assume every sample in the file is the same type
+    first_sample = samples[0]
+    leaf_node_path, leaf_node_type = _extract_leaf_node_path_and_type(first_sample)
+    is_knowledge = False
+    if leaf_node_type == "knowledge":
+        is_knowledge = True
+
+    samples_ds = Dataset.from_list(samples)
+    logger.debug("Postprocessing from samples: %s", samples_ds)
+
+    mixer.collect(
+        leaf_node_path,
+        samples_ds,
+        is_knowledge,
+        use_legacy_pretraining_format,
+    )
+    return samples_ds
+
+
+def _write_postprocessed(
+    mixer, all_generated_data, output_dir, date_suffix, system_prompt
+):
+    """Write the combined train files and the recipes of all leaf nodes"""
+    output_file_messages = f"messages_{date_suffix}.jsonl"
+    output_file_train = f"train_{date_suffix}.jsonl"
+    _gen_train_data(
+        all_generated_data,
+        os.path.join(output_dir, output_file_train),
+        os.path.join(output_dir, output_file_messages),
+        system_prompt,
+    )
+
+    mixer.write_recipes()
+
+
 def preprocess_taxonomy(
     taxonomy_dir,
     output_dir,
@@ -317,6 +525,7 @@ def preprocess_taxonomy(
     yaml_rules: Optional[str] = None,
     test_output_file: Optional[str] = None,
     system_prompt: Optional[str] = None,
+    leaf_node_cache: Optional[LeafNodeCache] = None,
 ):
     """
     Preprocess a taxonomy into input samples suitable for use with
@@ -348,15 +557,49 @@ def preprocess_taxonomy(
         yaml_rules: Path to a custom YAML rules file for YAML linting.
         test_output_file: Path to write a file with generated test samples
         system_prompt: System prompt to use when generating test samples
+        leaf_node_cache: Reuse the samples of leaf nodes converted before from it,
+                         and add the samples of the others
 
     Returns:
         List[str]: The list of output sample files written to disk.
 
+    """
+    return list(
+        _preprocess_taxonomy(
+            taxonomy_dir,
+            output_dir,
+            chunk_word_count,
+            server_ctx_size,
+            taxonomy_base,
+            teacher_model_path,
+            yaml_rules,
+            test_output_file,
+            system_prompt,
+            leaf_node_cache,
+        )
+    )
+
+
+def _preprocess_taxonomy(
+    taxonomy_dir,
+    output_dir,
+    chunk_word_count,
+    server_ctx_size,
+    taxonomy_base,
+    teacher_model_path,
+    yaml_rules,
+    test_output_file,
+    system_prompt,
+    leaf_node_cache,
+) -> Iterator[str]:
+    """
+    Like preprocess_taxonomy, but yields the output sample file of every
+    leaf node as soon as it is written, so it can be generated from while
+    the next leaf node is converted.
     """
     logging.info("Converting taxonomy to samples")
     output_dir = Path(output_dir)
     output_dir.mkdir(exist_ok=True)
-    output_files = []
 
     if not (taxonomy_dir and os.path.exists(taxonomy_dir)):
         raise GenerateException(f"Error: taxonomy ({taxonomy_dir}) does not exist.")
@@ -376,6 +619,23 @@ def preprocess_taxonomy(
     all_samples = []
     for leaf_node in leaf_nodes.values():
         leaf_node_path = leaf_node[0]["taxonomy_path"].replace("->", "_")
+        output_file = output_dir.joinpath(f"{leaf_node_path}.jsonl")
+        cache_key = cached_file = None
+        if leaf_node_cache is not None:
+            cache_key = leaf_node_cache.preprocess_key(
+                leaf_node,
+                server_ctx_size,
+                chunk_word_count,
+                teacher_model_path,
+                docling_model_path,
+            )
+            cached_file = leaf_node_cache.get("preprocessed", cache_key)
+        if cached_file is not None:
+            shutil.copyfile(cached_file, output_file)
+            all_samples.extend(jlload(output_file))
+            yield str(output_file)
+            continue
+
         samples = leaf_node_to_samples(
             leaf_node,
             server_ctx_size,
@@ -390,10 +650,11 @@ def preprocess_taxonomy(
 
         logger.debug("Samples: %s", samples)
 
-        output_file = output_dir.joinpath(f"{leaf_node_path}.jsonl")
         all_samples.extend(samples)
         jldump(samples, output_file)
-        output_files.append(str(output_file))
+        if leaf_node_cache is not None:
+            leaf_node_cache.put("preprocessed", cache_key, output_file)
+        yield str(output_file)
 
     if test_output_file:
         _gen_test_data(
@@ -403,7 +664,51 @@ def preprocess_taxonomy(
         )
         logger.debug(f"Generating test data to: {test_output_file}")
     logger.info("Taxonomy converted to samples and written to %s", output_dir)
-    return output_files
+
+
+def _generate_shards(pipes, input_files, work_queue, shard_size):
+    """
+    Generate data from the shards of the leaf nodes in input_files that no
+    other worker of work_queue claimed, until none is left
+    """
+    samples = {
+        os.path.basename(input_file): jlload(input_file) for input_file in input_files
+    }
+    # Every worker must plan the same shards, whatever order it listed the
+    # input files in
+    work_queue.plan(
+        sorted((name, len(rows)) for name, rows in samples.items()), shard_size
+    )
+
+    def generate_shard(shard):
+        rows = samples[shard.input_name][shard.start : shard.end]
+        leaf_node_path, leaf_node_type = _extract_leaf_node_path_and_type(rows[0])
+        logger.debug("Generating data from %s of %s", shard.shard_id, leaf_node_path)
+        pipe = _leaf_node_pipe(pipes, leaf_node_type)
+        return pipe.generate(Dataset.from_list(rows), shard.shard_id)
+
+    processed = work_queue.run(generate_shard)
+    logger.info(
+        "Generated %d shards, %d not done yet", processed, len(work_queue.pending())
+    )
+
+
+def merge_taxonomy_shards(
+    work_queue_dir: str, output_dir: str, checkpoint_dir: Optional[str] = None
+) -> List[str]:
+    """
+    Merge the shards generated by the workers of a generate_taxonomy run
+    with a work_queue_dir into the files a run on a single host writes to
+    output_dir, and their checkpoints into checkpoint_dir. Raises a
+    GenerateException if any shard is not done.
+
+    Returns:
+        List[str]: The generated data files, one per leaf node that
+        generated any.
+    """
+    return WorkQueue(work_queue_dir).merge(
+        str(output_dir), checkpoint_dir, skip_empty=True
+    )
 
 
 def generate_taxonomy(
@@ -420,17 +725,51 @@ def generate_taxonomy(
     batch_size: Optional[int] = None,
     checkpoint_dir: Optional[str] = None,
     max_num_tokens: Optional[int] = DEFAULT_MAX_NUM_TOKENS,
+    profiler: Optional[PipelineProfiler] = None,
+    max_concurrent_leaf_nodes: int = 1,
+    leaf_node_cache: Optional[LeafNodeCache] = None,
+    response_cache: Optional[ResponseCache] = None,
+    work_queue_dir: Optional[str] = None,
+    shard_size: int = DEFAULT_SHARD_SIZE,
 ):
+    """
+    Generate data from every preprocessed leaf node in input_dir, writing it
+    to a file of the same name in output_dir.
+
+    With a work_queue_dir shared by several hosts, each running this with
+    the same input_dir, the leaf nodes are split into shards of shard_size
+    samples that the hosts claim one at a time. Checkpoints are kept in the
+    work queue, so a host taking over the shard of one that died resumes
+    it. The host that completes the last shard merges them into output_dir,
+    and its checkpoints into checkpoint_dir. merge_taxonomy_shards does the
+    same, should that host fail to. The shard size is rounded up to a whole
+    number of batches, so the rows are batched as on a single host. Shards
+    are generated one at a time and are not kept in a leaf_node_cache, so
+    neither that nor max_concurrent_leaf_nodes may be given with a
+    work_queue_dir.
+    """
+    work_queue = None
+    pipeline_checkpoint_dir = checkpoint_dir
+    if work_queue_dir is not None:
+        if max_concurrent_leaf_nodes != 1 or leaf_node_cache is not None:
+            raise GenerateException(
+                "Error: max_concurrent_leaf_nodes and leaf_node_cache are not supported with a work_queue_dir"
+            )
+        work_queue = WorkQueue(work_queue_dir)
+        if checkpoint_dir is not None:
+            pipeline_checkpoint_dir = work_queue.checkpoint_dir
     ctx = _context_init(
         client,
         model_family,
         model_id,
         num_instructions_to_generate,
-        checkpoint_dir,
+        pipeline_checkpoint_dir,
         1,  # save_freq
         batch_size=batch_size,
         batch_num_workers=num_cpus,
         max_num_tokens=max_num_tokens,
+        profiler=profiler,
+        response_cache=response_cache,
     )
 
     knowledge_pipe, freeform_skills_pipe, grounded_skills_pipe = _sdg_init(
@@ -446,37 +785,24 @@ def generate_taxonomy(
     output_dir = Path(output_dir)
     output_dir.mkdir(exist_ok=True)
 
-    empty_input_files = []
-    for input_file in input_files:
-        logger.debug("Generating data from input file: %s", input_file)
-        samples = jlload(input_file)
-        if not samples:
-            raise GenerateException(
-                "Error: No samples found in input file {input_file}"
-            )
-        # For now we assume every sample in the file is the same type
-        first_sample = samples[0]
-        leaf_node_path, leaf_node_type = _extract_leaf_node_path_and_type(first_sample)
-        if leaf_node_type == "knowledge":
-            pipe = knowledge_pipe
-        elif leaf_node_type == "grounded_skill":
-            pipe = grounded_skills_pipe
-        else:
-            pipe = freeform_skills_pipe
+    if work_queue is not None:
+        shard_size = batch_shard_size(shard_size, ctx.batch_size)
+        pipes = (knowledge_pipe, freeform_skills_pipe, grounded_skills_pipe)
+        _generate_shards(pipes, input_files, work_queue, shard_size)
+        # Merging is idempotent, so it does not matter if several hosts
+        # finish at once
+        if not work_queue.pending():
+            merge_taxonomy_shards(work_queue_dir, output_dir, checkpoint_dir)
+        return
 
-        samples_ds = Dataset.from_list(samples)
-        logger.debug("Generating from samples: %s", samples_ds)
+    empty_input_files = []
 
-        new_generated_data = pipe.generate(samples_ds, leaf_node_path)
-        if len(new_generated_data) == 0:
+    def generate_leaf_node(input_file):
+        pipes = (knowledge_pipe, freeform_skills_pipe, grounded_skills_pipe)
+        if _generate_leaf_node(pipes, input_file, output_dir, leaf_node_cache) is None:
             empty_input_files.append(input_file)
-            logger.warning("Empty generated dataset for input file: %s", input_file)
-            continue
 
-        output_file = os.path.join(output_dir, os.path.basename(input_file))
-        jldump(new_generated_data, output_file)
-        logger.info("Generated %d samples", len(new_generated_data))
-        logger.debug("Generated data: %s", new_generated_data)
+    _run_leaf_nodes(ctx, generate_leaf_node, input_files, max_concurrent_leaf_nodes)
 
     if len(empty_input_files) > 0:
         logger.warning(
@@ -497,6 +823,10 @@ def generate_taxonomy_eval(
     num_instructions_to_generate: Optional[int] = 30,
     batch_size: Optional[int] = None,
     max_num_tokens: Optional[int] = DEFAULT_MAX_NUM_TOKENS,
+    profiler: Optional[PipelineProfiler] = None,
+    max_concurrent_leaf_nodes: int = 1,
+    leaf_node_cache: Optional[LeafNodeCache] = None,
+    response_cache: Optional[ResponseCache] = None,
 ):
     ctx = _context_init(
         client,
@@ -508,6 +838,8 @@ def generate_taxonomy_eval(
         batch_size=batch_size,
         batch_num_workers=num_cpus,
         max_num_tokens=max_num_tokens,
+        profiler=profiler,
+        response_cache=response_cache,
     )
     mmlu_bench_pipe = mmlubench_pipe_init(ctx)
 
@@ -515,29 +847,14 @@ def generate_taxonomy_eval(
     output_dir = Path(output_dir)
     output_dir.mkdir(exist_ok=True)
 
-    for input_file in input_files:
-        logger.debug("Generating eval data from input file: %s", input_file)
-        samples = jlload(input_file)
-        if not samples:
-            raise GenerateException(
-                "Error: No samples found in input file {input_file}"
-            )
-        samples_ds = Dataset.from_list(samples)
-        # For now we assume every sample in the file is the same type
-        first_sample = samples[0]
-        leaf_node_path, leaf_node_type = _extract_leaf_node_path_and_type(first_sample)
-        is_knowledge = False
-        if leaf_node_type == "knowledge":
-            is_knowledge = True
-
-        if is_knowledge:
-            generate_eval_task_data(
-                mmlu_bench_pipe,
-                leaf_node_path,
-                samples_ds,
-                output_dir,
-                date_suffix,
-            )
+    def generate_leaf_node_eval(input_file):
+        _generate_leaf_node_eval(
+            mmlu_bench_pipe, input_file, output_dir, date_suffix, leaf_node_cache
+        )
+
+    _run_leaf_nodes(
+        ctx, generate_leaf_node_eval, input_files, max_concurrent_leaf_nodes
+    )
 
 
 def postprocess_taxonomy(
@@ -570,50 +887,20 @@ def postprocess_taxonomy(
         system_prompt,
     )
 
-    input_files = glob.glob(f"{input_dir}/*.jsonl")
+    # Leaf nodes are mixed in the order of their file names, which does not
+    # depend on the file system or on when they were generated
+    input_files = sorted(glob.glob(f"{input_dir}/*.jsonl"))
     output_dir = Path(output_dir)
     output_dir.mkdir(exist_ok=True)
 
-    output_file_messages = f"messages_{date_suffix}.jsonl"
-    output_file_train = f"train_{date_suffix}.jsonl"
-
-    all_generated_data = []
-    for input_file in input_files:
-        logger.debug(
-            "Postprocessing generated taxonomy date in input file: %s", input_file
-        )
-        samples = jlload(input_file)
-        if not samples:
-            raise GenerateException(
-                "Error: No samples found in input file {input_file}"
-            )
-        # For now we assume every sample in the file is the same type
-        first_sample = samples[0]
-        leaf_node_path, leaf_node_type = _extract_leaf_node_path_and_type(first_sample)
-        is_knowledge = False
-        if leaf_node_type == "knowledge":
-            is_knowledge = True
-
-        samples_ds = Dataset.from_list(samples)
-        logger.debug("Postprocessing from samples: %s", samples_ds)
-        all_generated_data.append(samples_ds)
-
-        mixer.collect(
-            leaf_node_path,
-            samples_ds,
-            is_knowledge,
-            use_legacy_pretraining_format,
-        )
-
-    _gen_train_data(
-        all_generated_data,
-        os.path.join(output_dir, output_file_train),
-        os.path.join(output_dir, output_file_messages),
-        system_prompt,
+    all_generated_data = [
+        _postprocess_leaf_node(mixer, input_file, use_legacy_pretraining_format)
+        for input_file in input_files
+    ]
+    _write_postprocessed(
+        mixer, all_generated_data, output_dir, date_suffix, system_prompt
     )
 
-    mixer.write_recipes()
-
 
 def mix_datasets(
     recipe_file: str,
@@ -628,6 +915,189 @@ def mix_datasets(
         logger.info("Not mixing empty recipe file: %s", recipe_file)
 
 
+def _stream_taxonomy(
+    client,
+    taxonomy,
+    preprocessed_dir,
+    generated_dir,
+    output_dir,
+    output_file_test,
+    date_suffix,
+    system_prompt,
+    use_legacy_pretraining_format,
+    model_family,
+    model_name,
+    num_cpus,
+    num_instructions_to_generate,
+    taxonomy_base,
+    console_output,
+    yaml_rules,
+    chunk_word_count,
+    server_ctx_size,
+    pipeline,
+    batch_size,
+    checkpoint_dir,
+    max_num_tokens,
+    profiler,
+    max_concurrent_leaf_nodes,
+    leaf_node_cache,
+    response_cache,
+):
+    """
+    Pass every leaf node through preprocessing, generation, eval generation
+    and postprocessing as soon as its inputs are ready, writing the same
+    files as preprocess_taxonomy, generate_taxonomy, generate_taxonomy_eval
+    and postprocess_taxonomy run one after the other.
+
+    Leaf nodes are converted one at a time in a thread of their own, so the
+    documents of the next leaf node are converted while the teacher
+    generates from the previous ones. Up to max_concurrent_leaf_nodes leaf
+    nodes are generated at a time, with their eval data generated alongside,
+    and the batches of all of them share one pool of num_cpus threads.
+    Once every leaf node is generated, they are postprocessed in this thread
+    in the same order as postprocess_taxonomy does.
+    """
+    ctx = _context_init(
+        client,
+        model_family,
+        model_name,
+        num_instructions_to_generate,
+        checkpoint_dir,
+        1,  # save_freq
+        batch_size=batch_size,
+        batch_num_workers=num_cpus,
+        max_num_tokens=max_num_tokens,
+        profiler=profiler,
+        response_cache=response_cache,
+    )
+    eval_ctx = _context_init(
+        client,
+        model_family,
+        model_name,
+        num_instructions_to_generate,
+        None,  # disable checkpoints for eval pipeline
+        1,  # save_freq
+        batch_size=batch_size,
+        batch_num_workers=num_cpus,
+        max_num_tokens=max_num_tokens,
+        profiler=profiler,
+        response_cache=response_cache,
+    )
+    pipes = _sdg_init(ctx, pipeline)
+    mmlu_bench_pipe = mmlubench_pipe_init(eval_ctx)
+    # Postprocessing maps in this process, as forking workers while other
+    # threads talk to the teacher risks deadlocks. The data of a single leaf
+    # node is small enough for that not to matter.
+    mixer = _mixer_init(
+        1, output_dir, date_suffix, pipes[0].auxiliary_inst, system_prompt
+    )
+    Path(generated_dir).mkdir(exist_ok=True)
+
+    if console_output:
+        logger.info(
+            "Synthesizing new instructions. If you aren't satisfied with the generated instructions, interrupt training (Ctrl-C) and try adjusting your YAML files. Adding more examples may help."
+        )
+
+    leaf_nodes: queue.Queue = queue.Queue()
+    stop = threading.Event()
+
+    def preprocess(generate_executor, eval_executor):
+        try:
+            for input_file in _preprocess_taxonomy(
+                taxonomy,
+                preprocessed_dir,
+                chunk_word_count,
+                server_ctx_size,
+                taxonomy_base,
+                model_name,
+                yaml_rules,
+                output_file_test,
+                system_prompt,
+                leaf_node_cache,
+            ):
+                if stop.is_set():
+                    return
+                leaf_nodes.put(
+                    (
+                        generate_executor.submit(
+                            _generate_leaf_node,
+                            pipes,
+                            input_file,
+                            generated_dir,
+                            leaf_node_cache,
+                        ),
+                        eval_executor.submit(
+                            _generate_leaf_node_eval,
+                            mmlu_bench_pipe,
+                            input_file,
+                            output_dir,
+                            date_suffix,
+                            leaf_node_cache,
+                        ),
+                    )
+                )
+        finally:
+            leaf_nodes.put(None)
+
+    generated_files = []
+    empty_leaf_nodes = 0
+    try:
+        with (
+            ThreadPoolExecutor(max_workers=ctx.batch_num_workers) as batch_executor,
+            ThreadPoolExecutor(
+                max_workers=max_concurrent_leaf_nodes, thread_name_prefix="sdg-leaf"
+            ) as generate_executor,
+            ThreadPoolExecutor(
+                max_workers=max_concurrent_leaf_nodes, thread_name_prefix="sdg-eval"
+            ) as eval_executor,
+            ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="sdg-preprocess"
+            ) as preprocess_executor,
+        ):
+            ctx.batch_executor = eval_ctx.batch_executor = batch_executor
+            preprocessed = preprocess_executor.submit(
+                preprocess, generate_executor, eval_executor
+            )
+
+            def result(future):
+                # Fail as soon as preprocessing does, rather than after
+                # generating every leaf node converted before it
+                done, _ = wait((future, preprocessed), return_when=FIRST_COMPLETED)
+                if preprocessed in done and preprocessed.exception() is not None:
+                    raise preprocessed.exception()
+                return future.result()
+
+            futures = []
+            try:
+                while (leaf_node := leaf_nodes.get()) is not None:
+                    futures.extend(leaf_node)
+                    generated_file = result(leaf_node[0])
+                    if generated_file is None:
+                        empty_leaf_nodes += 1
+                    else:
+                        generated_files.append(generated_file)
+                preprocessed.result()
+                for future in futures:
+                    future.result()
+            except BaseException:
+                stop.set()
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        ctx.batch_executor = eval_ctx.batch_executor = None
+
+    if empty_leaf_nodes:
+        logger.warning("%d leaf nodes generated no data", empty_leaf_nodes)
+    all_generated_data = [
+        _postprocess_leaf_node(mixer, generated_file, use_legacy_pretraining_format)
+        for generated_file in sorted(generated_files)
+    ]
+    _write_postprocessed(
+        mixer, all_generated_data, output_dir, date_suffix, system_prompt
+    )
+
+
 # This is part of the public API, and used by instructlab.
 # TODO - parameter removal needs to be done in sync with a CLI change.
 # to be removed: logger
@@ -651,6 +1121,12 @@ def generate_data(
     batch_size: Optional[int] = None,
     checkpoint_dir: Optional[str] = None,
     max_num_tokens: Optional[int] = DEFAULT_MAX_NUM_TOKENS,
+    profile: bool = False,
+    max_concurrent_leaf_nodes: int = 1,
+    overlap_phases: bool = False,
+    leaf_node_cache_dir: Optional[str] = None,
+    response_cache_path: Optional[str] = None,
+    reuse_sampled_responses: bool = False,
 ) -> None:
     """Generate data for training and testing a model.
 
@@ -667,6 +1143,24 @@ def generate_data(
                     "freeform_skills.yaml", and "grounded_skills.yaml".
         use_legacy_pretraining_format: Deprecated. This parameter will be removed in a future version.
             The new format simply sets unmask=True.
+        profile: Write a JSON profile of every pipeline block, with its wall time, LLM wait time,
+            row counts and memory use, to profile_<date>.json in the output directory once
+            generation is done. Memory use is measured for the whole process, so it includes
+            other blocks running at the same time, such as those of concurrent leaf nodes.
+        max_concurrent_leaf_nodes: The number of taxonomy leaf nodes generated at the same time.
+            Their batches share one pool of num_cpus threads. Every leaf node still gets its
+            own output file and checkpoint directory.
+        overlap_phases: Pass every leaf node on to generation, eval generation and postprocessing
+            as soon as it is preprocessed, instead of running each phase over every leaf node
+            before starting the next. Writes the same files.
+        leaf_node_cache_dir: A directory to keep what each leaf node generates in, across runs.
+            Leaf nodes whose qna.yaml, documents, pipeline configs and teacher model settings are
+            unchanged since a previous run reuse its output instead of being generated again.
+        response_cache_path: A SQLite database to keep the completions of the teacher model in,
+            across runs. Requests sent before, with the same prompt and generation arguments, reuse
+            their completions instead of being sent again.
+        reuse_sampled_responses: Also reuse the completions of requests with a temperature above 0.
+            Without it, only the completions of greedy requests are reused.
     """
     if use_legacy_pretraining_format:
         warnings.warn(
@@ -689,58 +1183,110 @@ def generate_data(
     output_file_test = output_dir.joinpath(f"test_{date_suffix}.jsonl")
     preprocessed_dir = output_dir.joinpath(f"preprocessed_{date_suffix}")
     generated_dir = output_dir.joinpath(f"generated_{date_suffix}")
+    profiler = None
+    if profile:
+        profiler = PipelineProfiler(
+            str(output_dir.joinpath(f"profile_{date_suffix}.json"))
+        )
+    leaf_node_cache = None
+    if leaf_node_cache_dir is not None:
+        leaf_node_cache = LeafNodeCache(leaf_node_cache_dir)
+    response_cache = None
+    if response_cache_path is not None:
+        response_cache = SQLiteResponseCache(
+            response_cache_path, reuse_sampled=reuse_sampled_responses
+        )
 
-    # This writes samples to disk in our output_dir and returns the
-    # list of files created
-    preprocess_taxonomy(
-        taxonomy,
-        output_dir=preprocessed_dir,
-        chunk_word_count=chunk_word_count,
-        server_ctx_size=server_ctx_size,
-        taxonomy_base=taxonomy_base,
-        teacher_model_path=model_name,
-        yaml_rules=yaml_rules,
-        test_output_file=output_file_test,
-        system_prompt=system_prompt,
-    )
+    if overlap_phases:
+        _stream_taxonomy(
+            client,
+            taxonomy,
+            preprocessed_dir,
+            generated_dir,
+            output_dir,
+            output_file_test,
+            date_suffix,
+            system_prompt=system_prompt,
+            use_legacy_pretraining_format=use_legacy_pretraining_format,
+            model_family=model_family,
+            model_name=model_name,
+            num_cpus=num_cpus,
+            num_instructions_to_generate=num_instructions_to_generate,
+            taxonomy_base=taxonomy_base,
+            console_output=console_output,
+            yaml_rules=yaml_rules,
+            chunk_word_count=chunk_word_count,
+            server_ctx_size=server_ctx_size,
+            pipeline=pipeline,
+            batch_size=batch_size,
+            checkpoint_dir=checkpoint_dir,
+            max_num_tokens=max_num_tokens,
+            profiler=profiler,
+            max_concurrent_leaf_nodes=max_concurrent_leaf_nodes,
+            leaf_node_cache=leaf_node_cache,
+            response_cache=response_cache,
+        )
+    else:
+        # This writes samples to disk in our output_dir and returns the
+        # list of files created
+        preprocess_taxonomy(
+            taxonomy,
+            output_dir=preprocessed_dir,
+            chunk_word_count=chunk_word_count,
+            server_ctx_size=server_ctx_size,
+            taxonomy_base=taxonomy_base,
+            teacher_model_path=model_name,
+            yaml_rules=yaml_rules,
+            test_output_file=output_file_test,
+            system_prompt=system_prompt,
+            leaf_node_cache=leaf_node_cache,
+        )
 
-    generate_taxonomy(
-        client,
-        input_dir=preprocessed_dir,
-        output_dir=generated_dir,
-        logger=logger,
-        model_family=model_family,
-        model_id=model_name,
-        num_cpus=num_cpus,
-        num_instructions_to_generate=num_instructions_to_generate,
-        console_output=console_output,
-        pipeline=pipeline,
-        batch_size=batch_size,
-        checkpoint_dir=checkpoint_dir,
-        max_num_tokens=max_num_tokens,
-    )
+        generate_taxonomy(
+            client,
+            input_dir=preprocessed_dir,
+            output_dir=generated_dir,
+            logger=logger,
+            model_family=model_family,
+            model_id=model_name,
+            num_cpus=num_cpus,
+            num_instructions_to_generate=num_instructions_to_generate,
+            console_output=console_output,
+            pipeline=pipeline,
+            batch_size=batch_size,
+            checkpoint_dir=checkpoint_dir,
+            max_num_tokens=max_num_tokens,
+            profiler=profiler,
+            max_concurrent_leaf_nodes=max_concurrent_leaf_nodes,
+            leaf_node_cache=leaf_node_cache,
+            response_cache=response_cache,
+        )
 
-    generate_taxonomy_eval(
-        input_dir=preprocessed_dir,
-        output_dir=output_dir,
-        date_suffix=date_suffix,
-        client=client,
-        model_family=model_family,
-        model_id=model_name,
-        num_cpus=num_cpus,
-        num_instructions_to_generate=num_instructions_to_generate,
-        batch_size=batch_size,
-        max_num_tokens=max_num_tokens,
-    )
+        generate_taxonomy_eval(
+            input_dir=preprocessed_dir,
+            output_dir=output_dir,
+            date_suffix=date_suffix,
+            client=client,
+            model_family=model_family,
+            model_id=model_name,
+            num_cpus=num_cpus,
+            num_instructions_to_generate=num_instructions_to_generate,
+            batch_size=batch_size,
+            max_num_tokens=max_num_tokens,
+            profiler=profiler,
+            max_concurrent_leaf_nodes=max_concurrent_leaf_nodes,
+            leaf_node_cache=leaf_node_cache,
+            response_cache=response_cache,
+        )
 
-    postprocess_taxonomy(
-        input_dir=generated_dir,
-        output_dir=output_dir,
-        date_suffix=date_suffix,
-        pipeline=pipeline,
-        system_prompt=system_prompt,
-        use_legacy_pretraining_format=use_legacy_pretraining_format,
-    )
+        postprocess_taxonomy(
+            input_dir=generated_dir,
+            output_dir=output_dir,
+            date_suffix=date_suffix,
+            pipeline=pipeline,
+            system_prompt=system_prompt,
+            use_legacy_pretraining_format=use_legacy_pretraining_format,
+        )
 
     mix_datasets(
         recipe_file=f"{output_dir}/skills_recipe_{date_suffix}.yaml",
@@ -753,5 +1299,26 @@ def generate_data(
         system_prompt=system_prompt,
     )
 
+    if leaf_node_cache is not None:
+        for kind, counts in leaf_node_cache.stats().items():
+            logger.info(
+                "Reused the %s data of %d of %d leaf nodes",
+                kind,
+                counts["hits"],
+                counts["hits"] + counts["misses"],
+            )
+    if response_cache is not None:
+        stats = response_cache.stats()
+        logger.info(
+            "Reused the completions of %d of %d cacheable requests (%.1f%%), %d requests sampled and were not cached",
+            stats["hits"],
+            stats["hits"] + stats["misses"],
+            stats["hit_rate"] * 100,
+            stats["uncached"],
+        )
+        response_cache.close()
+    if profiler is not None:
+        profiler.save()
+
     generate_duration = time.time() - generate_start
     logger.info(f"Generation took {generate_duration:.2f}s")
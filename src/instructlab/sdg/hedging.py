@@ -0,0 +1,132 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+from collections import deque
+from typing import Any, Deque, Dict, Hashable, Optional, Sequence
+import math
+import threading
+
+
+# This is part of the public API.
+class HedgePolicy:  # pylint: disable=too-many-instance-attributes
+    """
+    Sends a duplicate of an LLM request that is taking longer than most, to
+    cut the tail latency that holds up whole batches and blocks. Given to a
+    ClientPool, which sends the duplicate to another replica if it has one,
+    or over another connection to the same one otherwise. Whichever answer
+    arrives first is used, and the other request is cancelled.
+
+    Only requests with a temperature of 0 are hedged, unless hedge_sampled
+    is set, as a duplicate of a sampled request is not an equivalent
+    answer. That makes the evaluation and filtering blocks safe targets.
+
+    Args:
+        percentile: A request is hedged once it has been running for this
+            percentile of the latency of the previous requests like it,
+            meaning to the same API, with the same model, max_tokens, n and
+            number of prompts.
+        max_hedge_ratio: The maximum number of hedges, as a fraction of
+            all requests, so hedging never adds more than this much load.
+        min_samples: The number of requests like it that must have
+            completed before a request is hedged.
+        window: The number of latencies remembered for each kind of
+            request.
+        min_delay: The minimum number of seconds before hedging a request.
+        hedge_sampled: Also hedge requests with a temperature above 0.
+        max_workers: The maximum number of threads sending hedges for
+            requests made from threads. The requests themselves are sent
+            from threads of their own, so this only caps the hedges in
+            flight. Requests from asyncio need none.
+    """
+
+    def __init__(
+        self,
+        percentile: float = 95.0,
+        max_hedge_ratio: float = 0.05,
+        min_samples: int = 20,
+        window: int = 500,
+        min_delay: float = 0.0,
+        hedge_sampled: bool = False,
+        max_workers: int = 256,
+    ) -> None:
+        if not 0 < percentile <= 100:
+            raise ValueError("The hedging percentile must be in (0, 100]")
+        self.percentile = percentile
+        self.max_hedge_ratio = max_hedge_ratio
+        self.min_samples = min_samples
+        self.window = window
+        self.min_delay = min_delay
+        self.hedge_sampled = hedge_sampled
+        self.max_workers = max_workers
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._latencies: Dict[Hashable, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def applies_to(self, kwargs: Dict[str, Any]) -> bool:
+        """Whether a request with these arguments may be hedged"""
+        if kwargs.get("stream"):
+            return False
+        # The OpenAI API samples with a temperature of 1 by default
+        return self.hedge_sampled or float(kwargs.get("temperature", 1.0)) == 0
+
+    @staticmethod
+    def request_kind(resource: Sequence[str], kwargs: Dict[str, Any]) -> Hashable:
+        """What makes requests similar enough to compare their latency"""
+        prompt = kwargs.get("prompt")
+        return (
+            tuple(resource),
+            kwargs.get("model"),
+            kwargs.get("max_tokens"),
+            kwargs.get("n", 1),
+            len(prompt) if isinstance(prompt, list) else 1,
+        )
+
+    def delay(self, kind: Hashable) -> Optional[float]:
+        """How long to wait before hedging a request of this kind, or None
+        if there are not enough latencies to tell yet. Also counts the
+        request towards the hedge budget.
+        """
+        with self._lock:
+            self.requests += 1
+            latencies = self._latencies.get(kind)
+            if latencies is None or len(latencies) < self.min_samples:
+                return None
+            ordered = sorted(latencies)
+        rank = math.ceil(self.percentile / 100 * len(ordered)) - 1
+        return max(self.min_delay, ordered[rank])
+
+    def record(self, kind: Hashable, latency: float) -> None:
+        """Remember the latency of a request that completed"""
+        with self._lock:
+            latencies = self._latencies.get(kind)
+            if latencies is None:
+                latencies = self._latencies[kind] = deque(maxlen=self.window)
+            latencies.append(latency)
+
+    def try_hedge(self) -> bool:
+        """Take a hedge from the budget, if there is one left"""
+        with self._lock:
+            if self.hedges + 1 > self.max_hedge_ratio * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+    def record_win(self, hedge_won: bool) -> None:
+        if hedge_won:
+            with self._lock:
+                self.hedge_wins += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """How many requests were hedged, and how often the hedge won"""
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "hedge_ratio": self.hedges / self.requests if self.requests else 0.0,
+                "hedge_win_ratio": (
+                    self.hedge_wins / self.hedges if self.hedges else 0.0
+                ),
+            }
@@ -0,0 +1,185 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+from collections import Counter
+from importlib import metadata
+from typing import Any, Dict, Iterator, Optional
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Bump to invalidate every cached leaf node, when what is cached changes
+_CACHE_FORMAT = 1
+
+
+def _package_version() -> str:
+    try:
+        return metadata.version("instructlab-sdg")
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def _file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _referenced_config_paths(config: Any) -> Iterator[str]:
+    """Every path given as a config_path or in config_paths of the blocks of
+    a pipeline config, including blocks nested in other blocks
+    """
+    if isinstance(config, dict):
+        for key, value in config.items():
+            if key in ("config_path", "config_paths"):
+                yield from _strings(value)
+            else:
+                yield from _referenced_config_paths(value)
+    elif isinstance(config, list):
+        for value in config:
+            yield from _referenced_config_paths(value)
+
+
+def _strings(value: Any) -> Iterator[str]:
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            yield from _strings(item)
+
+
+def pipeline_fingerprint(pipe) -> str:
+    """
+    A digest of everything in a pipeline's configuration: its YAML file, its
+    parsed blocks and every block config file they load
+    """
+    digest = hashlib.sha256()
+    digest.update(_file_digest(pipe.config_path).encode())
+    digest.update(json.dumps(pipe.chained_blocks, sort_keys=True, default=str).encode())
+    config_dir = os.path.dirname(pipe.config_path)
+    for config_path in _referenced_config_paths(pipe.chained_blocks):
+        path = os.path.join(config_dir, config_path)
+        if os.path.isfile(path):
+            digest.update(config_path.encode())
+            digest.update(_file_digest(path).encode())
+    return digest.hexdigest()
+
+
+class LeafNodeCache:
+    """
+    A persistent, content-addressed store of what each phase of generate_data
+    produces from a taxonomy leaf node, so reruns only redo the leaf nodes,
+    pipelines or settings that changed.
+
+    Every entry is keyed by a digest of all of its inputs. The samples of a
+    leaf node are keyed by its qna.yaml contents, its documents and the
+    chunking settings. Generated and eval data are keyed by those samples,
+    the pipeline and block configs, and the teacher model settings. So a
+    changed document invalidates every phase of its leaf node, while a
+    changed pipeline keeps the converted documents.
+
+    Args:
+        cache_dir: The directory the entries are stored in. It is safe to
+            share between runs, and between processes writing at once.
+    """
+
+    def __init__(self, cache_dir: str) -> None:
+        self.cache_dir = cache_dir
+        self.hits: Counter = Counter()
+        self.misses: Counter = Counter()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(*parts: Any) -> str:
+        """A digest of the JSON of parts, salted with the package version"""
+        digest = hashlib.sha256()
+        for part in (_CACHE_FORMAT, _package_version()) + parts:
+            digest.update(json.dumps(part, sort_keys=True, default=str).encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def preprocess_key(
+        self,
+        leaf_node,
+        server_ctx_size,
+        chunk_word_count,
+        teacher_model_path,
+        docling_model_path,
+    ) -> str:
+        """The key of the samples of a leaf node, as read from the taxonomy"""
+        seeds = [
+            {k: v for k, v in seed.items() if k != "filepaths"} for seed in leaf_node
+        ]
+        documents = sorted(
+            _file_digest(str(path)) for path in leaf_node[0].get("filepaths") or []
+        )
+        return self.key(
+            "preprocess",
+            seeds,
+            documents,
+            server_ctx_size,
+            chunk_word_count,
+            teacher_model_path,
+            docling_model_path,
+        )
+
+    def pipeline_key(self, pipe, input_file: str) -> str:
+        """The key of what pipe generates from the samples in input_file"""
+        ctx = pipe.ctx
+        return self.key(
+            "generate",
+            _file_digest(input_file),
+            pipeline_fingerprint(pipe),
+            ctx.model_family,
+            ctx.model_id,
+            ctx.num_instructions_to_generate,
+            ctx.max_num_tokens,
+        )
+
+    def _path(self, kind: str, key: str) -> str:
+        return os.path.join(self.cache_dir, kind, key[:2], f"{key}.jsonl")
+
+    def get(self, kind: str, key: str) -> Optional[str]:
+        """The path of the cached file of kind with key, if there is one"""
+        path = self._path(kind, key)
+        found = os.path.isfile(path)
+        with self._lock:
+            (self.hits if found else self.misses)[kind] += 1
+        if found:
+            logger.debug("Reusing cached %s data %s", kind, path)
+            return path
+        return None
+
+    def put(self, kind: str, key: str, data_file: Optional[str]) -> None:
+        """Store a copy of data_file as the file of kind with key, or an
+        empty file if data_file is None
+        """
+        path = self._path(kind, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write and rename, so readers never see half an entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                if data_file is not None:
+                    with open(data_file, "rb") as f:
+                        shutil.copyfileobj(f, tmp)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """The number of hits and misses of each kind of file"""
+        with self._lock:
+            return {
+                kind: {"hits": self.hits[kind], "misses": self.misses[kind]}
+                for kind in sorted(set(self.hits) | set(self.misses))
+            }
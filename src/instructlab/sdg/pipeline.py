@@ -1,30 +1,54 @@
 # SPDX-License-Identifier: Apache-2.0
+# pylint: disable=too-many-lines
 
 # Standard
-from concurrent.futures import ThreadPoolExecutor
-from dataclasses import dataclass
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass, field
 from importlib import resources
-from typing import Dict, Iterable, List, Optional
+from typing import Dict, List, Optional, Union
+import asyncio
+import contextlib
 import logging
 import math
 import os.path
+import queue
+import threading
+import weakref
 
 # Third Party
 from datasets import Dataset, concatenate_datasets
-from openai import OpenAI
-import yaml
+from openai import AsyncOpenAI, OpenAI
 
 # First Party
+from instructlab.sdg.autotune import AutoTuner
 from instructlab.sdg.checkpointing import Checkpointer
+from instructlab.sdg.clientpool import AsyncClientPool, ClientPool
+from instructlab.sdg.estimate import BlockEstimate, EstimateOptions, PipelineEstimate
+from instructlab.sdg.profiling import PipelineProfiler
+from instructlab.sdg.response_cache import ResponseCache
 from instructlab.sdg.utils import pandas
+from instructlab.sdg.utils.arrow import (
+    MemoryBudget,
+    compact_dataset,
+    concatenate_and_compact,
+    dataset_from_table,
+    dataset_to_table,
+    slice_dataset,
+)
+from instructlab.sdg.utils.config import load_yaml
 
 # Local
 from .blocks import llmblock
 from .blocks.block import Block
+from .blocks.utilblocks import ColumnTransformBlock
 from .registry import BlockRegistry
 
 logger = logging.getLogger(__name__)
 
+# Guards the lazy creation of the MemoryBudget of a PipelineContext, which
+# may first be needed by several batches at once
+_memory_budget_lock = threading.Lock()
+
 
 # This is part of the public API.
 class EmptyDatasetError(Exception):
@@ -38,7 +62,11 @@ class PipelineContext:  # pylint: disable=too-many-instance-attributes
     A PipelineContext holds the common attributes needed between blocks in a
     pipeline
 
-    client: The OpenAI client handle.
+    client: The OpenAI client handle, or a ClientPool spreading the requests
+        over several replicas of the teacher model.
+    async_client: The AsyncOpenAI client handle used by Pipeline.agenerate. If
+        not given, one is created from the settings of client, or from the
+        ClientPool.
     model_id: The ID of the teacher model to be used for client calls.
     model_family: The family identifier for the model being updated.
     num_instructions_to_generate: The total number of instructions the user
@@ -50,6 +78,44 @@ class PipelineContext:  # pylint: disable=too-many-instance-attributes
     dataset_num_procs: The number of processes to use when performing parallel
        map operations on individual datasets.
     max_num_tokens: the maximum number of tokens to generate per sample.
+    streaming: When batching is enabled, stream each batch through the
+        block chain as soon as it leaves the previous block instead of
+        running every block over the whole dataset before starting the next.
+    stream_queue_size: The maximum number of batches waiting between each
+        pair of blocks when streaming.
+    max_concurrent_requests: The maximum number of LLM requests in flight at
+        once across all blocks and batches when using Pipeline.agenerate.
+    autotuner: An optional AutoTuner that adjusts the batch size and number of
+        concurrent batches at runtime based on the observed LLM latency,
+        throughput and error rates. It starts from batch_size and
+        batch_num_workers, unless it was given its own, and calibrates the
+        number of workers when neither sets one. It can not be combined
+        with streaming.
+    cpu_executor: An optional executor, typically a ProcessPoolExecutor, that
+        LLM blocks use for CPU-heavy work such as rendering prompts and
+        parsing outputs so it does not compete for the GIL with the threads
+        waiting on the network. Requests to the LLM server are always sent
+        from the main process.
+    profiler: An optional PipelineProfiler that records wall time, LLM wait
+        time, row counts and memory use for every block and batch. Its
+        save() writes the profile once the whole run is done, as
+        generate_data and the run_pipeline CLI do.
+    batch_executor: An optional executor that runs the batches of
+        multi-threaded batching, in place of a pool of batch_num_workers
+        threads created by every Pipeline.generate. Sharing one between
+        pipelines running at the same time caps the number of batches in
+        flight across all of them.
+    memory_budget: An optional number of bytes of intermediate Arrow data to
+        keep in memory. The outputs of blocks, the batches waiting to be
+        concatenated and the iterations of an IterBlock that would go past
+        it are spilled to Arrow IPC files and memory-mapped back, so memory
+        use stays flat as the number of documents grows.
+    spill_dir: The directory spilled data is written to, in a scratch
+        directory removed once the context is garbage collected. Defaults to
+        the system temporary directory.
+    response_cache: An optional ResponseCache that LLM blocks take the
+        completions of requests sent before from, instead of sending them
+        again, and that they add the completions of new requests to.
     """
 
     # The default batch size of 8 has been determined as a good default for
@@ -60,7 +126,16 @@ class PipelineContext:  # pylint: disable=too-many-instance-attributes
     # on individual datasets
     DEFAULT_DATASET_NUM_PROCS = 8
 
-    client: OpenAI
+    # The default number of batches that may queue up in front of each block
+    # when streaming. This bounds memory while still letting fast blocks run
+    # ahead of slow ones.
+    DEFAULT_STREAM_QUEUE_SIZE = 16
+
+    # The default number of LLM requests allowed in flight at once when
+    # running a pipeline with asyncio
+    DEFAULT_MAX_CONCURRENT_REQUESTS = 128
+
+    client: Union[OpenAI, ClientPool]
     model_family: Optional[str] = None
     model_id: Optional[str] = None
     num_instructions_to_generate: Optional[int] = None
@@ -70,6 +145,48 @@ class PipelineContext:  # pylint: disable=too-many-instance-attributes
     max_num_tokens: Optional[int] = llmblock.DEFAULT_MAX_NUM_TOKENS
     batch_size: int = DEFAULT_BATCH_SIZE
     batch_num_workers: Optional[int] = None
+    streaming: bool = False
+    stream_queue_size: int = DEFAULT_STREAM_QUEUE_SIZE
+    async_client: Optional[Union[AsyncOpenAI, AsyncClientPool]] = None
+    max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS
+    autotuner: Optional[AutoTuner] = None
+    cpu_executor: Optional[Executor] = None
+    profiler: Optional[PipelineProfiler] = None
+    batch_executor: Optional[Executor] = None
+    memory_budget: Optional[int] = None
+    spill_dir: Optional[str] = None
+    response_cache: Optional[ResponseCache] = None
+    _memory_budget: Optional[MemoryBudget] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+    _request_semaphores: weakref.WeakKeyDictionary = field(
+        default_factory=weakref.WeakKeyDictionary,
+        init=False,
+        repr=False,
+        compare=False,
+    )
+
+    def __getstate__(self):
+        # Blocks, and the context they hold, are pickled when work is sent to
+        # a cpu_executor in another process. The OpenAI clients (which hold
+        # an SSLContext) and everything holding locks can not be pickled, and
+        # the worker processes never talk to the LLM server, so leave them
+        # behind.
+        state = self.__dict__.copy()
+        state["client"] = None
+        state["async_client"] = None
+        state["autotuner"] = None
+        state["cpu_executor"] = None
+        state["profiler"] = None
+        state["batch_executor"] = None
+        state["_memory_budget"] = None
+        state["response_cache"] = None
+        del state["_request_semaphores"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._request_semaphores = weakref.WeakKeyDictionary()
 
     @property
     def batching_enabled(self) -> bool:
@@ -78,6 +195,51 @@ class PipelineContext:  # pylint: disable=too-many-instance-attributes
         """
         return self.batch_size > 0 and self.batch_num_workers != 1
 
+    @property
+    def streaming_enabled(self) -> bool:
+        """Streaming is only possible on top of batching"""
+        return self.streaming and self.batching_enabled
+
+    def spill_dataset(self, dataset: Dataset) -> Dataset:
+        """Return the dataset, spilled to disk if keeping it in memory would
+        go past the memory budget
+        """
+        if self.memory_budget is None:
+            return dataset
+        if self._memory_budget is None:
+            with _memory_budget_lock:
+                if self._memory_budget is None:
+                    self._memory_budget = MemoryBudget(
+                        self.memory_budget, self.spill_dir
+                    )
+        return self._memory_budget.keep(dataset)
+
+    def get_async_client(self) -> Union[AsyncOpenAI, AsyncClientPool]:
+        """Return the AsyncOpenAI client, creating one that talks to the same
+        server, or servers, as the synchronous client if none was given
+        """
+        if self.async_client is None and isinstance(self.client, ClientPool):
+            self.async_client = self.client.async_pool()
+        elif self.async_client is None:
+            self.async_client = AsyncOpenAI(
+                api_key=self.client.api_key,
+                base_url=self.client.base_url,
+                timeout=self.client.timeout,
+                max_retries=self.client.max_retries,
+            )
+        return self.async_client
+
+    def request_semaphore(self) -> asyncio.Semaphore:
+        """Return the semaphore capping in-flight LLM requests. There is one
+        per event loop, as asyncio primitives can not be shared across loops.
+        """
+        loop = asyncio.get_running_loop()
+        semaphore = self._request_semaphores.get(loop)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+            self._request_semaphores[loop] = semaphore
+        return semaphore
+
 
 # This is part of the public API.
 class PipelineBlockError(Exception):
@@ -127,6 +289,21 @@ class Pipeline:
         self.chained_blocks = chained_blocks
         # datamixing instructions for auxiliary data generated by this pipeline
         self.auxiliary_inst = auxiliary_inst
+        # the instantiated blocks, built on first use and shared by all batches
+        self._steps: Optional[list[_PipelineStep]] = None
+        self._steps_lock = threading.Lock()
+
+    def __getstate__(self):
+        # See PipelineContext.__getstate__. A copy of the pipeline in a worker
+        # process builds its own blocks if it ever needs them.
+        state = self.__dict__.copy()
+        state["_steps"] = None
+        del state["_steps_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._steps_lock = threading.Lock()
 
     @classmethod
     def from_file(cls, ctx, pipeline_yaml):
@@ -140,7 +317,9 @@ class Pipeline:
         dataset: the input dataset
         checkpoint_name: unique subdir name for the checkpoint within checkpoint_dir
         """
+        return self._run(dataset, checkpoint_name)
 
+    def _run(self, dataset, checkpoint_name) -> Dataset:
         # The checkpointer allows us to resume from where we left off
         # Saving the output of pipe instances along the way
         checkpoint_dir = None
@@ -156,6 +335,41 @@ class Pipeline:
             logger.info("Running pipeline single-threaded")
             return self._generate_single(dataset)
 
+        if self.ctx.autotuner is not None:
+            if self.ctx.streaming_enabled:
+                raise ValueError(
+                    "A PipelineContext can not use both an autotuner and streaming"
+                )
+            self.ctx.autotuner.seed(self.ctx.batch_size, self.ctx.batch_num_workers)
+            if not self.ctx.autotuner.calibrated:
+                self._calibrate_autotuner()
+
+        if self.ctx.streaming_enabled:
+            logger.info(
+                "Running pipeline with streaming batches. Using %s workers per block for batches of size %s",
+                self._stream_num_workers(),
+                self.ctx.batch_size,
+            )
+            output_splits = self._generate_streaming(dataset, checkpointer)
+            checkpointer.done()
+            if pre_generated_data:
+                output_splits.append(pre_generated_data)
+            if not output_splits:
+                return Dataset.from_list([])
+            return concatenate_and_compact(output_splits)
+
+        if self.ctx.autotuner is not None:
+            logger.info(
+                "Running pipeline with auto-tuned batching. Starting with %s workers for batches of size %s",
+                self.ctx.autotuner.num_workers,
+                self.ctx.autotuner.batch_size,
+            )
+            output_splits = self._generate_autotuned(dataset, checkpointer)
+            checkpointer.done()
+            if pre_generated_data:
+                output_splits.append(pre_generated_data)
+            return concatenate_and_compact(output_splits)
+
         # Otherwise, split the dataset into batches and run each batch as a
         # future in the thread pool
         logger.info(
@@ -165,7 +379,11 @@ class Pipeline:
         )
         input_splits = self._split_dataset(dataset)
         output_splits = []
-        with ThreadPoolExecutor(max_workers=self.ctx.batch_num_workers) as executor:
+        if self.ctx.batch_executor is not None:
+            batch_executor = contextlib.nullcontext(self.ctx.batch_executor)
+        else:
+            batch_executor = ThreadPoolExecutor(max_workers=self.ctx.batch_num_workers)
+        with batch_executor as executor:
             futures = [
                 executor.submit(self._generate_single, input_split)
                 for input_split in input_splits
@@ -180,64 +398,523 @@ class Pipeline:
         checkpointer.done()
         if pre_generated_data:
             output_splits.append(pre_generated_data)
-        return concatenate_datasets(output_splits)
+        return concatenate_and_compact(output_splits)
+
+    async def agenerate(self, dataset, checkpoint_name=None) -> Dataset:
+        """
+        Generate the dataset by running the pipeline steps with asyncio.
+
+        LLM blocks send their requests through the AsyncOpenAI client of the
+        PipelineContext, so concurrency is bounded by
+        PipelineContext.max_concurrent_requests instead of by the number of
+        worker threads. Blocks without a native async implementation run in
+        the default executor of the event loop.
+
+        dataset: the input dataset
+        checkpoint_name: unique subdir name for the checkpoint within checkpoint_dir
+        """
+        return await self._arun(dataset, checkpoint_name)
+
+    async def _arun(self, dataset, checkpoint_name) -> Dataset:
+        checkpoint_dir = None
+        if self.ctx.checkpoint_dir is not None and checkpoint_name is not None:
+            checkpoint_dir = os.path.join(self.ctx.checkpoint_dir, checkpoint_name)
+
+        checkpointer = Checkpointer(checkpoint_dir, self.ctx.save_freq)
+        dataset, pre_generated_data = checkpointer.load(dataset)
+
+        if not self.ctx.batching_enabled:
+            logger.info("Running pipeline with asyncio without batching")
+            return await self._agenerate_single(dataset)
+
+        logger.info(
+            "Running pipeline with asyncio. Using up to %s concurrent requests for batches of size %s",
+            self.ctx.max_concurrent_requests,
+            self.ctx.batch_size,
+        )
+
+        async def generate_split(input_split):
+            ds = await self._agenerate_single(input_split)
+            checkpointer.checkpoint(ds)
+            return ds
+
+        output_splits = await asyncio.gather(
+            *(generate_split(split) for split in self._split_dataset(dataset))
+        )
+        output_splits = list(output_splits)
+        checkpointer.done()
+        if pre_generated_data:
+            output_splits.append(pre_generated_data)
+        return concatenate_and_compact(output_splits)
+
+    def estimate(
+        self,
+        dataset,
+        tokenizer=None,
+        yields: Optional[Dict[str, float]] = None,
+        pilot_size: Optional[int] = None,
+        sample_size: int = EstimateOptions.DEFAULT_SAMPLE_SIZE,
+    ) -> PipelineEstimate:
+        """
+        Predict the number of LLM requests, prompt tokens and completion
+        tokens each block needs to process the dataset, and how many rows
+        each one produces, without running the pipeline.
+
+        Prompts are rendered with the real templates from a sample of the
+        rows. Columns generated by LLM blocks are left empty, so prompts
+        that include generated text are underestimated.
+
+        dataset: the input dataset
+        tokenizer: counts prompt tokens, see EstimateOptions
+        yields: the fraction of rows kept by a block, keyed by block name,
+            for filter blocks and for the rows parsed out of each completion
+            of an LLM block. Blocks not listed are assumed to keep every row.
+        pilot_size: when given, really run the pipeline over this many rows
+            and measure the yield of every block instead of assuming it
+        sample_size: the number of rows prompts are rendered from
+        """
+        options = EstimateOptions(
+            tokenizer,
+            yields,
+            pilot=pilot_size is not None,
+            sample_size=sample_size if pilot_size is None else pilot_size,
+        )
+        sample = compact_dataset(dataset)
+        sample = slice_dataset(sample, 0, min(len(sample), options.sample_size))
+        _, blocks = self._estimate_steps(
+            self._get_steps(), sample, float(len(dataset)), options
+        )
+        return PipelineEstimate(self._name, len(dataset), blocks)
 
     ## Implementation Details ##
 
+    def _estimate_steps(
+        self, steps, sample, rows, options
+    ) -> tuple[Dataset, list[BlockEstimate]]:
+        """Estimate a chain of steps over a sample of `rows` rows"""
+        estimates = []
+        # The blocks of a fused step are estimated one by one, so each has
+        # its own entry
+        for step in _unfused_steps(steps):
+            if rows == 0 or len(sample) == 0:
+                estimates.append(
+                    BlockEstimate(step.block_name, step.block_type.__name__, 0.0)
+                )
+                rows = 0.0
+                continue
+            try:
+                logger.info("Estimating block: %s", step.block_name)
+                sample, estimate = step.block.estimate(sample, rows, options)
+                sample = self._drop_columns(sample, step.drop_columns)
+                # Generated columns are empty unless this is a pilot run, so
+                # they would all look like duplicates
+                if step.drop_duplicates and options.pilot and len(sample):
+                    deduped = self._drop_duplicates(sample, cols=step.drop_duplicates)
+                    estimate.rows_out *= len(deduped) / len(sample)
+                    sample = deduped
+                if len(sample) > options.sample_size:
+                    sample = slice_dataset(
+                        compact_dataset(sample), 0, options.sample_size
+                    )
+            except Exception as err:
+                raise step.error(err) from err
+            estimates.append(estimate)
+            rows = estimate.rows_out
+        return sample, estimates
+
     def _generate_single(self, dataset) -> Dataset:
         """Generate a single dataset by running the pipeline steps."""
-        for block_prop in self.chained_blocks:
-            block, block_name, block_type = None, None, None
+        return self._run_steps(self._get_steps(), dataset)
+
+    def _run_steps(self, steps, dataset) -> Dataset:
+        """Run a chain of steps over the dataset, one block after the other"""
+        for step in steps:
             try:
-                # Parse and instantiate the block
-                block_name = block_prop["name"]
-                block_type = _lookup_block_type(block_prop["type"])
-                block_config = block_prop["config"]
-                drop_columns = block_prop.get("drop_columns", [])
-                drop_duplicates_cols = block_prop.get("drop_duplicates", False)
-                block = block_type(self.ctx, self, block_name, **block_config)
-                logger.info("Running block: %s", block_name)
+                logger.info("Running block: %s", step.block_name)
 
                 # Check if batching is enabled
                 if not self.ctx.batching_enabled:
                     logger.info(
                         "Batching disabled; processing block '%s' single-threaded.",
-                        block_name,
+                        step.block_name,
                     )
-                    dataset = block.generate(dataset)
+                    dataset = self._run_block(step, dataset)
+                elif len(dataset) <= self._batch_size():
+                    # Already a single batch, no need to split it again
+                    dataset = self._run_block(step, dataset)
                 else:
                     # Split the dataset into batches
                     input_splits = self._split_dataset(dataset)
                     # Process each batch in sequence
                     output_splits = [
-                        block.generate(input_split) for input_split in input_splits
+                        self.ctx.spill_dataset(self._run_block(step, input_split))
+                        for input_split in input_splits
                     ]
-                    # Combine the processed splits back into a single dataset
-                    dataset = concatenate_datasets(output_splits)
+                    # Combine the processed splits back into a single, compact
+                    # dataset at the block boundary
+                    dataset = concatenate_and_compact(output_splits)
 
                 # If the dataset is empty after processing, terminate early
                 if len(dataset) == 0:
                     return dataset
 
                 # Remove unnecessary columns if specified
-                drop_columns_in_ds = [
-                    e for e in drop_columns if e in dataset.column_names
-                ]
-                if drop_columns_in_ds:
-                    dataset = dataset.remove_columns(drop_columns_in_ds)
+                dataset = self._drop_columns(dataset, step.drop_columns)
 
                 # Drop duplicates if specified
-                if drop_duplicates_cols:
-                    dataset = self._drop_duplicates(dataset, cols=drop_duplicates_cols)
+                if step.drop_duplicates:
+                    dataset = self._drop_duplicates(dataset, cols=step.drop_duplicates)
+
+                dataset = self.ctx.spill_dataset(dataset)
 
             except Exception as err:
-                raise PipelineBlockError(
-                    exception=err,
-                    block=block,
-                    block_name=block_name,
-                    block_type=block_type,
-                ) from err
+                raise step.error(err) from err
+
+        return dataset
+
+    async def _agenerate_single(self, dataset) -> Dataset:
+        """Generate a single dataset by running the pipeline steps with asyncio."""
+        return await self._arun_steps(self._get_steps(), dataset)
+
+    async def _arun_steps(self, steps, dataset) -> Dataset:
+        for step in steps:
+            try:
+                logger.info("Running block: %s", step.block_name)
+
+                if not self.ctx.batching_enabled:
+                    dataset = await self._arun_block(step, dataset)
+                else:
+                    output_splits = await asyncio.gather(
+                        *(
+                            self._arun_block(step, input_split)
+                            for input_split in self._split_dataset(dataset)
+                        )
+                    )
+                    output_splits = [
+                        self.ctx.spill_dataset(split) for split in output_splits
+                    ]
+                    dataset = concatenate_and_compact(output_splits)
+
+                if len(dataset) == 0:
+                    return dataset
+
+                dataset = self._drop_columns(dataset, step.drop_columns)
+
+                if step.drop_duplicates:
+                    dataset = self._drop_duplicates(dataset, cols=step.drop_duplicates)
+
+                dataset = self.ctx.spill_dataset(dataset)
+
+            except Exception as err:
+                raise step.error(err) from err
+
+        return dataset
+
+    def _run_block(self, step, dataset) -> Dataset:
+        profiler = self.ctx.profiler
+        if profiler is None or isinstance(step.block, _FusedColumnsBlock):
+            # A fused step profiles each of the blocks it is made of
+            return step.block.generate(dataset)
+        with profiler.profile_block(
+            self._name, step.block_name, step.block_type.__name__, dataset
+        ) as profile:
+            dataset = step.block.generate(dataset)
+            profile.rows_out = len(dataset)
+        return dataset
+
+    async def _arun_block(self, step, dataset) -> Dataset:
+        profiler = self.ctx.profiler
+        if profiler is None or isinstance(step.block, _FusedColumnsBlock):
+            return await step.block.agenerate(dataset)
+        # Each batch runs as its own task, so the profile set here is only
+        # seen by the requests made for this batch
+        with profiler.profile_block(
+            self._name, step.block_name, step.block_type.__name__, dataset
+        ) as profile:
+            dataset = await step.block.agenerate(dataset)
+            profile.rows_out = len(dataset)
+        return dataset
+
+    @property
+    def _name(self) -> str:
+        return os.path.splitext(os.path.basename(self.config_path))[0]
+
+    def _get_steps(self) -> list["_PipelineStep"]:
+        """Return the blocks of this pipeline, instantiating them on first use.
+
+        Blocks are built once per Pipeline and shared by every batch and
+        worker thread, so parsing block configs, compiling prompt templates
+        and probing the LLM server only happens once.
+        """
+        steps = self._steps
+        if steps is None:
+            with self._steps_lock:
+                if self._steps is None:
+                    self._steps = self._fuse_steps(
+                        [
+                            self._build_step(block_prop)
+                            for block_prop in self.chained_blocks
+                        ]
+                    )
+                steps = self._steps
+        return steps
+
+    def _build_step(self, block_prop) -> "_PipelineStep":
+        block, block_name, block_type = None, None, None
+        try:
+            # Parse and instantiate the block
+            block_name = block_prop["name"]
+            if "branches" in block_prop:
+                block_type = _BranchGroup
+                block = _BranchGroup(
+                    self.ctx,
+                    self,
+                    block_name,
+                    branches=[
+                        (
+                            branch["name"],
+                            self._fuse_steps(
+                                [self._build_step(prop) for prop in branch["blocks"]]
+                            ),
+                        )
+                        for branch in block_prop["branches"]
+                    ],
+                    join=block_prop.get("join", _BranchGroup.JOIN_AND),
+                )
+            else:
+                block_type = _lookup_block_type(block_prop["type"])
+                block_config = block_prop["config"]
+                block = block_type(self.ctx, self, block_name, **block_config)
+            return _PipelineStep(
+                block=block,
+                block_name=block_name,
+                block_type=block_type,
+                drop_columns=block_prop.get("drop_columns", []),
+                drop_duplicates=block_prop.get("drop_duplicates", False),
+            )
+        except Exception as err:
+            raise PipelineBlockError(
+                exception=err,
+                block=block,
+                block_name=block_name,
+                block_type=block_type,
+            ) from err
 
+    def _fuse_steps(self, steps) -> list["_PipelineStep"]:
+        """
+        Replace every run of consecutive column transform blocks with a
+        single step that applies them all in one pass over the Arrow table.
+        A block that drops duplicates ends its run, since that needs the
+        rows it produced.
+        """
+        fused: list[_PipelineStep] = []
+        run: list[_PipelineStep] = []
+
+        def end_run():
+            if len(run) > 1:
+                block = _FusedColumnsBlock(
+                    self.ctx,
+                    self,
+                    "+".join(step.block_name for step in run),
+                    list(run),
+                )
+                fused.append(
+                    _PipelineStep(
+                        block=block,
+                        block_name=block.block_name,
+                        block_type=_FusedColumnsBlock,
+                        drop_columns=[],
+                        drop_duplicates=run[-1].drop_duplicates,
+                    )
+                )
+            else:
+                fused.extend(run)
+            run.clear()
+
+        for step in steps:
+            if _FusedColumnsBlock.can_fuse(step.block):
+                run.append(step)
+                if step.drop_duplicates:
+                    end_run()
+            else:
+                end_run()
+                fused.append(step)
+        end_run()
+        return fused
+
+    def _generate_streaming(self, dataset, checkpointer) -> list[Dataset]:
+        """Stream batches through the block chain.
+
+        Every block gets its own pool of worker threads fed by a bounded
+        queue. As soon as a worker finishes a batch, the output is re-split
+        into batches and handed to the next block, so a slow batch in one
+        block no longer holds up every other batch at that block boundary.
+
+        Each input batch is tracked until all of the batches derived from it
+        have left the last block. At that point its output is checkpointed
+        and, once everything is done, the outputs are returned in the same
+        order the non-streaming execution would have produced them.
+        """
+        stages = self._get_steps()
+        input_splits = self._split_dataset(dataset)
+        if not stages:
+            return input_splits
+
+        state = _StreamState(checkpointer)
+        num_workers = self._stream_num_workers()
+        queues: list[queue.Queue] = [
+            queue.Queue(maxsize=self.ctx.stream_queue_size) for _ in stages
+        ]
+        workers = []
+        for stage_idx, stage in enumerate(stages):
+            is_last = stage_idx == len(stages) - 1
+            out_queue = None if is_last else queues[stage_idx + 1]
+            stage_workers = [
+                threading.Thread(
+                    target=self._stream_worker,
+                    args=(stage_idx, stage, queues[stage_idx], out_queue, state),
+                    name=f"sdg-stream-{stage.block_name}-{i}",
+                    daemon=True,
+                )
+                for i in range(num_workers)
+            ]
+            for worker in stage_workers:
+                worker.start()
+            workers.append(stage_workers)
+
+        # Feed the first block. The bounded queue blocks us here when the
+        # chain is saturated, which keeps the number of live batches bounded.
+        for root, input_split in enumerate(input_splits):
+            if state.stopped.is_set():
+                break
+            state.start(root)
+            queues[0].put(((root,), root, input_split))
+
+        # Shut the stages down in order so every batch in flight drains
+        for stage_idx, stage_workers in enumerate(workers):
+            for _ in stage_workers:
+                queues[stage_idx].put(_STREAM_DONE)
+            for worker in stage_workers:
+                worker.join()
+
+        if state.error is not None:
+            raise state.error
+        return state.ordered_results()
+
+    def _stream_worker(self, stage_idx, stage, in_queue, out_queue, state) -> None:
+        while True:
+            item = in_queue.get()
+            if item is _STREAM_DONE:
+                return
+            # After a failure we keep draining our queue so that upstream
+            # workers blocked on a full queue can finish and shut down
+            if state.stopped.is_set():
+                continue
+            key, root, dataset = item
+            try:
+                logger.debug("Running block %s on batch %s", stage.block_name, key)
+                dataset = self._run_block(stage, dataset)
+                if len(dataset) > 0:
+                    dataset = self._drop_columns(dataset, stage.drop_columns)
+                    if stage.drop_duplicates:
+                        dataset = state.drop_seen(
+                            stage_idx, root, dataset, stage.drop_duplicates
+                        )
+                # Batches between blocks and finished batches waiting on the
+                # rest of their root count against the memory budget
+                dataset = self.ctx.spill_dataset(dataset)
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                state.fail(stage.error(err))
+                continue
+
+            if out_queue is None:
+                state.finish(root, key, dataset)
+                continue
+
+            children = self._split_dataset(dataset) if len(dataset) > 0 else []
+            # Account for the children before handing them off so the root
+            # can not be considered finished while they are still in flight
+            state.fork(root, len(children))
+            for child_idx, child in enumerate(children):
+                out_queue.put((key + (child_idx,), root, child))
+
+    def _generate_autotuned(self, dataset, checkpointer) -> list[Dataset]:
+        """Run batches in a thread pool whose batch size and number of
+        concurrent batches follow the AutoTuner of the PipelineContext.
+
+        Batches are cut from the dataset one at a time, with the batch size
+        the tuner asks for at that moment, and only submitted while fewer
+        batches than the tuner's current number of workers are running. They
+        run on the batch_executor of the PipelineContext if there is one.
+        """
+        autotuner = self.ctx.autotuner
+        running = 0
+        running_changed = threading.Condition()
+
+        def batch_done(_):
+            nonlocal running
+            with running_changed:
+                running -= 1
+                running_changed.notify_all()
+
+        futures = []
+        if self.ctx.batch_executor is not None:
+            batch_executor = contextlib.nullcontext(self.ctx.batch_executor)
+        else:
+            batch_executor = ThreadPoolExecutor(max_workers=autotuner.max_workers)
+        with batch_executor as executor:
+            start = 0
+            while start < len(dataset):
+                with running_changed:
+                    while running >= autotuner.num_workers:
+                        running_changed.wait()
+                    running += 1
+                end = min(start + autotuner.batch_size, len(dataset))
+                future = executor.submit(
+                    self._generate_single, slice_dataset(dataset, start, end)
+                )
+                future.add_done_callback(batch_done)
+                futures.append(future)
+                start = end
+
+            output_splits = []
+            for future in futures:
+                ds = future.result()
+                output_splits.append(ds)
+                checkpointer.checkpoint(ds)
+        return output_splits
+
+    def _calibrate_autotuner(self) -> None:
+        model_id = self.ctx.model_id
+        if self.ctx.client is None or not model_id:
+            logger.info("Skipping auto-tuning calibration, no client or model id")
+            self.ctx.autotuner.calibrated = True
+            return
+
+        def probe():
+            self.ctx.client.completions.create(
+                model=model_id, prompt="test", max_tokens=1
+            )
+
+        self.ctx.autotuner.calibrate(probe)
+
+    def _batch_size(self) -> int:
+        if self.ctx.autotuner is not None:
+            self.ctx.autotuner.seed(self.ctx.batch_size, self.ctx.batch_num_workers)
+            return self.ctx.autotuner.batch_size
+        return self.ctx.batch_size
+
+    def _stream_num_workers(self) -> int:
+        if self.ctx.batch_num_workers:
+            return self.ctx.batch_num_workers
+        # Same default as concurrent.futures.ThreadPoolExecutor
+        return min(32, (os.cpu_count() or 1) + 4)
+
+    @staticmethod
+    def _drop_columns(dataset, drop_columns):
+        drop_columns_in_ds = [e for e in drop_columns if e in dataset.column_names]
+        if drop_columns_in_ds:
+            dataset = dataset.remove_columns(drop_columns_in_ds)
         return dataset
 
     def _drop_duplicates(self, dataset, cols):
@@ -251,38 +928,344 @@ class Pipeline:
         return ds
 
     def _split_dataset(self, dataset: Dataset) -> list[Dataset]:
-        """Split the dataset into smaller batches."""
+        """Split the dataset into smaller batches.
+
+        The batches are zero-copy slices of the underlying Arrow table, so
+        the dataset is compacted first to get rid of any indices mapping.
+        """
         assert (
             self.ctx.batch_size is not None
         ), "Programming Error: Should not call _split_dataset if batching disabled"
+        dataset = compact_dataset(dataset)
         total_size = len(dataset)
-        num_batches = math.ceil(total_size / self.ctx.batch_size)
-        batches = [
-            dataset.select(self._get_batch_indices(i, total_size))
-            for i in range(num_batches)
-        ]
+        batch_size = self._batch_size()
+        num_batches = math.ceil(total_size / batch_size)
+        batches = []
+        for i in range(num_batches):
+            indices = self._get_batch_indices(i, total_size, batch_size)
+            batches.append(slice_dataset(dataset, indices.start, indices.stop))
         return batches
 
-    def _get_batch_indices(self, batch_index: int, total_size: int) -> Iterable[int]:
+    def _get_batch_indices(
+        self, batch_index: int, total_size: int, batch_size: Optional[int] = None
+    ) -> range:
         assert (
             self.ctx.batch_size is not None
         ), "Programming Error: Should not call _get_batch_indices if batching disabled"
+        if batch_size is None:
+            batch_size = self.ctx.batch_size
         return range(
             # Start index offset by the batch size
-            batch_index * self.ctx.batch_size,
+            batch_index * batch_size,
             # End index is the next batch offset or the end of the dataset
-            min((batch_index + 1) * self.ctx.batch_size, total_size),
+            min((batch_index + 1) * batch_size, total_size),
+        )
+
+
+# Sentinel telling a streaming worker that its input queue is exhausted
+_STREAM_DONE = object()
+
+
+class _PipelineStep:
+    """An instantiated block in a pipeline, along with its per-block options"""
+
+    def __init__(
+        self, block, block_name, block_type, drop_columns, drop_duplicates
+    ) -> None:
+        self.block = block
+        self.block_name = block_name
+        self.block_type = block_type
+        self.drop_columns = drop_columns
+        self.drop_duplicates = drop_duplicates
+
+    def error(self, exception: Exception) -> PipelineBlockError:
+        return PipelineBlockError(
+            exception=exception,
+            block=self.block,
+            block_name=self.block_name,
+            block_type=self.block_type,
         )
 
 
+class _FusedColumnsBlock(Block):
+    """
+    Applies the column transforms of several consecutive steps, along with
+    their drop_columns, to the Arrow table of the samples and builds a
+    single dataset from the result.
+    """
+
+    def __init__(self, ctx, pipe, block_name, steps) -> None:
+        super().__init__(ctx, pipe, block_name)
+        self.steps = steps
+
+    @staticmethod
+    def can_fuse(block) -> bool:
+        # A subclass that overrides generate may do more than transform_table
+        return (
+            isinstance(block, ColumnTransformBlock)
+            and type(block).generate is ColumnTransformBlock.generate
+        )
+
+    def generate(self, samples: Dataset) -> Dataset:
+        table = dataset_to_table(samples)
+        for step in self.steps:
+            with self._profile_step(step, table) as profile:
+                try:
+                    table = step.block.transform_table(table)
+                except Exception as err:
+                    raise step.error(err) from err
+                drop_columns = set(step.drop_columns)
+                if table.num_rows and drop_columns & set(table.column_names):
+                    table = table.select(
+                        [col for col in table.column_names if col not in drop_columns]
+                    )
+                if profile is not None:
+                    profile.rows_out = table.num_rows
+            # Stop where running the steps one by one would have stopped
+            if table.num_rows == 0:
+                break
+        return dataset_from_table(
+            samples, table, (type(self).__name__, self.block_name)
+        )
+
+    @contextlib.contextmanager
+    def _profile_step(self, step, table):
+        """Profile one of the fused blocks under its own name and type"""
+        profiler = getattr(self.ctx, "profiler", None)
+        if not isinstance(profiler, PipelineProfiler):
+            yield None
+            return
+        with profiler.profile_block(
+            self.pipe._name,  # pylint: disable=protected-access
+            step.block_name,
+            step.block_type.__name__,
+            table,
+        ) as profile:
+            yield profile
+
+
+def _unfused_steps(steps) -> list["_PipelineStep"]:
+    """The steps, with every fused step replaced by the steps it fused"""
+    unfused = []
+    for step in steps:
+        if isinstance(step.block, _FusedColumnsBlock):
+            unfused.extend(step.block.steps)
+        else:
+            unfused.append(step)
+    return unfused
+
+
+class _BranchGroup(Block):
+    """
+    Runs several chains of blocks concurrently over the same rows and joins
+    their outputs back together.
+
+    With an "and" join, a row is kept if it made it through every branch,
+    and it gains the new columns each branch added to it. Columns of the
+    input dropped by any branch are dropped. Each branch may filter rows,
+    but must produce at most one row per input row.
+    """
+
+    JOIN_AND = "and"
+
+    def __init__(self, ctx, pipe, block_name, branches, join=JOIN_AND) -> None:
+        super().__init__(ctx, pipe, block_name)
+        if join != self.JOIN_AND:
+            raise PipelineConfigParserError(
+                f"Unknown join {join} for branches of {block_name}"
+            )
+        if len(branches) < 2:
+            raise PipelineConfigParserError(
+                f"Branches of {block_name} need at least two branches"
+            )
+        self.branches = branches
+        self.join = join
+        # Nested branch groups each get their own row id column
+        self._row_id_col = f"__{block_name}_row_id"
+
+    def generate(self, samples: Dataset) -> Dataset:
+        samples = samples.add_column(self._row_id_col, list(range(len(samples))))
+        # pylint: disable=protected-access
+        with ThreadPoolExecutor(max_workers=len(self.branches)) as executor:
+            futures = [
+                executor.submit(self.pipe._run_steps, steps, samples)
+                for _, steps in self.branches
+            ]
+            outputs = [future.result() for future in futures]
+        return self._join(samples, outputs)
+
+    async def agenerate(self, samples: Dataset) -> Dataset:
+        samples = samples.add_column(self._row_id_col, list(range(len(samples))))
+        # pylint: disable=protected-access
+        outputs = await asyncio.gather(
+            *(self.pipe._arun_steps(steps, samples) for _, steps in self.branches)
+        )
+        return self._join(samples, list(outputs))
+
+    def estimate(
+        self, samples: Dataset, rows: float, options: EstimateOptions
+    ) -> tuple[Dataset, BlockEstimate]:
+        samples = samples.add_column(self._row_id_col, list(range(len(samples))))
+        outputs = []
+        children = []
+        rows_out = rows
+        for branch_name, steps in self.branches:
+            # pylint: disable=protected-access
+            output, estimates = self.pipe._estimate_steps(steps, samples, rows, options)
+            branch_rows = estimates[-1].rows_out if estimates else rows
+            outputs.append(output)
+            children.append(
+                BlockEstimate.combine(
+                    branch_name, "branch", rows, branch_rows, estimates
+                )
+            )
+            # Assumes the branches keep or drop rows independently of each
+            # other
+            rows_out *= branch_rows / rows
+        joined = self._join(samples, outputs)
+        if options.pilot:
+            rows_out = rows * len(joined) / len(samples)
+        return joined, BlockEstimate.combine(
+            self.block_name, type(self).__name__, rows, rows_out, children
+        )
+
+    def _join(self, samples: Dataset, outputs: list[Dataset]) -> Dataset:
+        input_cols = set(samples.column_names)
+        kept_ids: Optional[set] = None
+        dropped_cols: set = set()
+        new_cols: Dict[str, str] = {}
+        positions_by_branch = []
+        for (branch_name, _), output in zip(self.branches, outputs):
+            if len(output) == 0:
+                return Dataset.from_list([])
+            if self._row_id_col not in output.column_names:
+                raise ValueError(
+                    f"Branch {branch_name} of {self.block_name} dropped the {self._row_id_col} column"
+                )
+            positions: Dict[int, int] = {}
+            for position, row_id in enumerate(output[self._row_id_col]):
+                if row_id in positions:
+                    raise ValueError(
+                        f"Branch {branch_name} of {self.block_name} produced more than one row for the same input row, which can not be joined"
+                    )
+                positions[row_id] = position
+            positions_by_branch.append(positions)
+            kept_ids = set(positions) if kept_ids is None else kept_ids & set(positions)
+            dropped_cols |= input_cols - set(output.column_names)
+            for col in output.column_names:
+                if col in input_cols:
+                    continue
+                if col in new_cols:
+                    raise ValueError(
+                        f"Branches {new_cols[col]} and {branch_name} of {self.block_name} both add the {col} column"
+                    )
+                new_cols[col] = branch_name
+
+        # Row ids are the positions of the rows in the input
+        row_ids = sorted(kept_ids)
+        if not row_ids:
+            return Dataset.from_list([])
+        parts = [samples.select(row_ids)]
+        for (branch_name, _), output, positions in zip(
+            self.branches, outputs, positions_by_branch
+        ):
+            cols = [col for col, branch in new_cols.items() if branch == branch_name]
+            if cols:
+                parts.append(
+                    output.select_columns(cols).select(
+                        [positions[row_id] for row_id in row_ids]
+                    )
+                )
+        joined = compact_dataset(
+            concatenate_datasets([compact_dataset(part) for part in parts], axis=1)
+        )
+        return joined.remove_columns(
+            [self._row_id_col] + sorted(dropped_cols - {self._row_id_col})
+        )
+
+
+class _StreamState:  # pylint: disable=too-many-instance-attributes
+    """Bookkeeping shared by all workers of a streaming pipeline run"""
+
+    def __init__(self, checkpointer: Checkpointer) -> None:
+        self.stopped = threading.Event()
+        self.error: Optional[PipelineBlockError] = None
+        self._checkpointer = checkpointer
+        self._lock = threading.Lock()
+        # Number of batches derived from each input batch still in flight
+        self._pending: Dict[int, int] = {}
+        self._results: Dict[int, list] = {}
+        self._done: Dict[int, Dataset] = {}
+        # drop_duplicates keys already seen, per block and input batch
+        self._seen: Dict[tuple, set] = {}
+
+    def start(self, root: int) -> None:
+        with self._lock:
+            self._pending[root] = 1
+            self._results[root] = []
+
+    def fork(self, root: int, num_children: int) -> None:
+        with self._lock:
+            self._pending[root] += num_children - 1
+            self._maybe_complete(root)
+
+    def finish(self, root: int, key: tuple, dataset: Dataset) -> None:
+        with self._lock:
+            if len(dataset) > 0:
+                self._results[root].append((key, dataset))
+            self._pending[root] -= 1
+            self._maybe_complete(root)
+
+    def fail(self, error: PipelineBlockError) -> None:
+        with self._lock:
+            if self.error is None:
+                self.error = error
+            self.stopped.set()
+
+    def drop_seen(self, step_idx: int, root: int, dataset: Dataset, cols) -> Dataset:
+        """Drop rows whose drop_duplicates columns were already seen for this
+        input batch. Batches arrive in completion order, so which of several
+        duplicates is kept may differ from a non-streaming run.
+        """
+        keys = [tuple(row[col] for col in cols) for row in dataset.select_columns(cols)]
+        keep = []
+        with self._lock:
+            seen = self._seen.setdefault((step_idx, root), set())
+            for idx, key in enumerate(keys):
+                if key not in seen:
+                    seen.add(key)
+                    keep.append(idx)
+        if len(keep) == len(keys):
+            return dataset
+        return dataset.select(keep)
+
+    def ordered_results(self) -> list[Dataset]:
+        return [self._done[root] for root in sorted(self._done)]
+
+    def _maybe_complete(self, root: int) -> None:
+        if self._pending[root] > 0:
+            return
+        splits = [ds for _, ds in sorted(self._results.pop(root), key=lambda r: r[0])]
+        dataset = concatenate_and_compact(splits) if splits else Dataset.from_list([])
+        self._done[root] = dataset
+        self._checkpointer.checkpoint(dataset)
+
+
 def _lookup_block_type(block_type):
+    # Importing a block module registers its blocks. These two are not
+    # imported by this module otherwise, and iterblock imports this module,
+    # so it can not happen at the top of it.
+    # pylint: disable=import-outside-toplevel,unused-import
+    # Local
+    from .blocks import filterblock, iterblock
+
     block_types = BlockRegistry.get_registry()
     if not block_type in block_types:
         raise PipelineConfigParserError(f"Unknown block type {block_type}")
     return block_types[block_type]
 
 
-_PIPELINE_CONFIG_PARSER_MAJOR = 1
+_PIPELINE_CONFIG_PARSER_MAJOR = 2
 _PIPELINE_CONFIG_PARSER_MINOR = 0
 
 
@@ -292,8 +1275,7 @@ class PipelineConfigParserError(Exception):
 
 
 def _parse_pipeline_config_file(pipeline_yaml):
-    with open(pipeline_yaml, "r", encoding="utf-8") as pipeline_file:
-        content = yaml.safe_load(pipeline_file)
+    content = load_yaml(pipeline_yaml)
 
     version = content["version"]
     major, minor = map(int, version.split("."))
@@ -312,6 +1294,11 @@ def _parse_pipeline_config_file(pipeline_yaml):
             "The pipeline config file contains no 'blocks' section"
         )
 
+    if major < 2 and any("branches" in block for block in content["blocks"]):
+        raise PipelineConfigParserError(
+            "Branches require version 2.0 of the pipeline config file format"
+        )
+
     auxiliary_inst = None
     if "datamixing" in content and "auxiliary_instructions" in content["datamixing"]:
         auxiliary_inst = content["datamixing"]["auxiliary_instructions"]
@@ -0,0 +1,220 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+import contextvars
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+# Third Party
+from datasets import Dataset
+import pyarrow
+
+try:
+    # Standard
+    import resource
+except ImportError:  # pragma: no cover - not available on Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+_current_block_profile: contextvars.ContextVar[Optional["BlockProfile"]] = (
+    contextvars.ContextVar("sdg_block_profile", default=None)
+)
+
+
+def current_block_profile() -> Optional["BlockProfile"]:
+    """The BlockProfile of the block currently running in this thread or
+    asyncio task, if profiling is enabled
+    """
+    return _current_block_profile.get()
+
+
+def _peak_rss() -> int:
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class BlockProfile:  # pylint: disable=too-many-instance-attributes
+    """
+    What happened while one block processed one batch.
+
+    arrow_bytes_delta and peak_rss_delta are measured for the whole process,
+    so while other batches or leaf nodes run at the same time they include
+    the memory those allocate too.
+    """
+
+    def __init__(self, pipeline: str, block_name: str, block_type: str) -> None:
+        self.pipeline = pipeline
+        self.block_name = block_name
+        self.block_type = block_type
+        self.rows_in = 0
+        self.rows_out = 0
+        self.wall_time = 0.0
+        self.llm_time = 0.0
+        self.llm_requests = 0
+        self.validation_failures = 0
+        self.empty_parses = 0
+        self.arrow_bytes_delta = 0
+        self.peak_rss_delta = 0
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._in_flight_since = 0.0
+
+    @contextmanager
+    def llm_request(self):
+        """
+        Time an LLM request made by the block. Concurrent requests are
+        counted once, so llm_time is the wall time during which at least one
+        request was in flight and the rest of wall_time was spent locally.
+        """
+        with self._lock:
+            if self._in_flight == 0:
+                self._in_flight_since = time.monotonic()
+            self._in_flight += 1
+            self.llm_requests += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                if self._in_flight == 0:
+                    self.llm_time += time.monotonic() - self._in_flight_since
+
+    def add_validation_failures(self, count: int) -> None:
+        with self._lock:
+            self.validation_failures += count
+
+    def add_empty_parses(self, count: int) -> None:
+        with self._lock:
+            self.empty_parses += count
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "pipeline": self.pipeline,
+            "block_name": self.block_name,
+            "block_type": self.block_type,
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+            "wall_time": self.wall_time,
+            "llm_time": self.llm_time,
+            "cpu_time": max(0.0, self.wall_time - self.llm_time),
+            "llm_requests": self.llm_requests,
+            "validation_failures": self.validation_failures,
+            "empty_parses": self.empty_parses,
+            "arrow_bytes_delta": self.arrow_bytes_delta,
+            "peak_rss_delta": self.peak_rss_delta,
+        }
+
+
+# This is part of the public API.
+class PipelineProfiler:
+    """
+    Collects a BlockProfile for every block and batch run by the pipelines
+    sharing a PipelineContext, and writes them out as JSON.
+
+    The profile has one entry per block with the totals across all of its
+    batches, ordered by wall time, followed by the individual records.
+
+    Args:
+        path: Where save() writes the JSON profile.
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._records: List[BlockProfile] = []
+
+    @contextmanager
+    def profile_block(
+        self, pipeline: str, block_name: str, block_type: str, dataset: Dataset
+    ):
+        """Profile one block running over one batch. The caller must set
+        rows_out on the yielded BlockProfile.
+        """
+        profile = BlockProfile(pipeline, block_name, block_type)
+        profile.rows_in = len(dataset)
+        token = _current_block_profile.set(profile)
+        arrow_bytes = pyarrow.total_allocated_bytes()
+        peak_rss = _peak_rss()
+        start = time.monotonic()
+        try:
+            yield profile
+        finally:
+            profile.wall_time = time.monotonic() - start
+            profile.arrow_bytes_delta = pyarrow.total_allocated_bytes() - arrow_bytes
+            profile.peak_rss_delta = _peak_rss() - peak_rss
+            _current_block_profile.reset(token)
+            with self._lock:
+                self._records.append(profile)
+
+    @property
+    def records(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [record.to_dict() for record in self._records]
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """The totals of every block across all of its batches"""
+        totals: Dict[tuple, Dict[str, Any]] = {}
+        for record in self.records:
+            key = (record["pipeline"], record["block_name"])
+            total = totals.get(key)
+            if total is None:
+                total = totals[key] = {
+                    "pipeline": record["pipeline"],
+                    "block_name": record["block_name"],
+                    "block_type": record["block_type"],
+                    "batches": 0,
+                    "rows_in": 0,
+                    "rows_out": 0,
+                    "wall_time": 0.0,
+                    "llm_time": 0.0,
+                    "cpu_time": 0.0,
+                    "llm_requests": 0,
+                    "validation_failures": 0,
+                    "empty_parses": 0,
+                    "max_arrow_bytes_delta": 0,
+                    "max_peak_rss_delta": 0,
+                }
+            total["batches"] += 1
+            for field in (
+                "rows_in",
+                "rows_out",
+                "wall_time",
+                "llm_time",
+                "cpu_time",
+                "llm_requests",
+                "validation_failures",
+                "empty_parses",
+            ):
+                total[field] += record[field]
+            total["max_arrow_bytes_delta"] = max(
+                total["max_arrow_bytes_delta"], record["arrow_bytes_delta"]
+            )
+            total["max_peak_rss_delta"] = max(
+                total["max_peak_rss_delta"], record["peak_rss_delta"]
+            )
+        for total in totals.values():
+            total["yield"] = (
+                total["rows_out"] / total["rows_in"] if total["rows_in"] else None
+            )
+        return sorted(totals.values(), key=lambda t: t["wall_time"], reverse=True)
+
+    def save(self, path: Optional[str] = None) -> None:
+        """Write the profile collected so far as JSON. This rewrites the whole
+        file, so it is meant to be called once, at the end of a run."""
+        path = path or self.path
+        if path is None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"blocks": self.summary(), "records": self.records}, f, indent=2)
+        logger.info(f"Saved pipeline profile to {path}")
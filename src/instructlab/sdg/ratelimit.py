@@ -0,0 +1,191 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+from typing import Any, Dict, Optional, Sequence
+import random
+import threading
+import time
+
+# Third Party
+import openai
+
+# Local
+from .estimate import EstimateOptions
+
+# The status codes that mean a request may succeed if it is sent again
+RETRYABLE_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504)
+
+
+def estimate_request_tokens(kwargs: Dict[str, Any]) -> int:
+    """
+    Estimate the number of tokens a completion or chat completion request
+    uses, from its rendered prompts or messages plus the max_tokens of every
+    completion it asks for
+    """
+    options = EstimateOptions()
+    if "messages" in kwargs:
+        prompts = [
+            " ".join(
+                str(message.get("content") or "") for message in kwargs["messages"]
+            )
+        ]
+    else:
+        prompt = kwargs.get("prompt", "")
+        prompts = prompt if isinstance(prompt, list) else [prompt]
+    prompt_tokens = sum(options.count_tokens(str(prompt)) for prompt in prompts)
+    completions = len(prompts) * (kwargs.get("n") or 1)
+    return prompt_tokens + completions * (kwargs.get("max_tokens") or 0)
+
+
+class _TokenBucket:
+    """
+    A token bucket refilled at `rate` per second up to `capacity`. Callers
+    reserve what they need up front and are told how long to wait for it,
+    so waiting never spins and reservations are served in order.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float, now: float) -> float:
+        """How long a reservation of amount would have to wait"""
+        self._refill(now)
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def reserve(self, amount: float, now: float) -> float:
+        """Take amount from the bucket, returning how long to wait for it"""
+        wait = self.delay(amount, now)
+        self.level -= amount
+        return wait
+
+
+# This is part of the public API.
+class RateLimiter:
+    """
+    Limits the rate of requests sent to one LLM server, and the rate of
+    tokens they use. Each limit allows bursts of up to one second's worth.
+
+    Requests over the limit are held back in the thread or asyncio task
+    that sends them. As the blocks send requests from the worker threads
+    processing batches, a saturated limit slows down the whole pipeline,
+    rather than piling up requests the server would reject.
+
+    Args:
+        requests_per_second: The maximum number of requests per second.
+        tokens_per_minute: The maximum number of tokens per minute, counting
+            the estimated tokens of the prompts plus max_tokens for every
+            completion.
+    """
+
+    def __init__(
+        self,
+        requests_per_second: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+    ) -> None:
+        self.requests_per_second = requests_per_second
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = None
+        if requests_per_second:
+            self._requests = _TokenBucket(
+                requests_per_second, max(1.0, requests_per_second)
+            )
+        self._tokens = None
+        if tokens_per_minute:
+            self._tokens = _TokenBucket(tokens_per_minute / 60, tokens_per_minute / 60)
+        self._lock = threading.Lock()
+        self.waited = 0.0
+
+    def delay(self, tokens: int) -> float:
+        """How long a request using tokens would have to wait right now"""
+        with self._lock:
+            now = time.monotonic()
+            return max(
+                (
+                    bucket.delay(amount, now)
+                    for bucket, amount in ((self._requests, 1), (self._tokens, tokens))
+                    if bucket is not None
+                ),
+                default=0.0,
+            )
+
+    def reserve(self, tokens: int) -> float:
+        """Reserve the budget of a request using tokens, returning how many
+        seconds to wait before sending it
+        """
+        with self._lock:
+            now = time.monotonic()
+            wait = max(
+                (
+                    bucket.reserve(amount, now)
+                    for bucket, amount in ((self._requests, 1), (self._tokens, tokens))
+                    if bucket is not None
+                ),
+                default=0.0,
+            )
+            self.waited += wait
+            return wait
+
+
+# This is part of the public API.
+class RetryPolicy:
+    """
+    How requests that fail with a connection error, a timeout or one of
+    `retryable_status_codes` are retried. Other errors are raised at once,
+    as sending the same request again would fail the same way.
+
+    Retries wait for an exponential backoff with full jitter, so that many
+    workers throttled at the same time do not come back at the same time.
+    A Retry-After header sent by the server is honored, up to max_delay.
+
+    Args:
+        max_retries: The maximum number of retries of a request.
+        initial_delay: The upper bound of the first backoff, in seconds.
+        max_delay: The upper bound of every backoff, in seconds.
+        retryable_status_codes: The HTTP status codes worth retrying.
+    """
+
+    def __init__(
+        self,
+        max_retries: int = 5,
+        initial_delay: float = 1.0,
+        max_delay: float = 60.0,
+        retryable_status_codes: Sequence[int] = RETRYABLE_STATUS_CODES,
+    ) -> None:
+        self.max_retries = max_retries
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.retryable_status_codes = tuple(retryable_status_codes)
+
+    def is_retryable(self, err: Exception) -> bool:
+        if isinstance(err, openai.APIConnectionError):
+            # Also covers timeouts
+            return True
+        return (
+            isinstance(err, openai.APIStatusError)
+            and err.status_code in self.retryable_status_codes
+        )
+
+    def backoff(self, attempt: int, err: Optional[Exception] = None) -> float:
+        """The number of seconds to wait before retry number attempt"""
+        delay = random.uniform(0, min(self.max_delay, self.initial_delay * 2**attempt))
+        retry_after = _retry_after(err)
+        if retry_after is not None:
+            delay = max(delay, min(self.max_delay, retry_after))
+        return delay
+
+
+def _retry_after(err: Optional[Exception]) -> Optional[float]:
+    response = getattr(err, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
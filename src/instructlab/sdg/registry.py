@@ -1,9 +1,10 @@
 # Standard
-from typing import Dict
+from typing import Dict, FrozenSet, Optional
+import functools
 import logging
 
 # Third Party
-from jinja2 import Environment, StrictUndefined, Template
+from jinja2 import Environment, StrictUndefined, Template, meta, nodes
 
 logger = logging.getLogger(__name__)
 
@@ -42,11 +43,24 @@ class BlockRegistry:
         return cls._registry
 
 
+class _PicklableTemplate(Template):
+    """A Jinja2 Template that can be sent to worker processes. Compiled
+    templates can not be pickled, so they are recompiled from their source
+    on the other side instead.
+    """
+
+    source: str
+
+    def __reduce__(self):
+        return (PromptRegistry.template_from_string, (self.source,))
+
+
 class PromptRegistry:
     """Registry for managing Jinja2 prompt templates."""
 
     _registry: Dict[str, Template] = {}
     _template_env: Environment = Environment(undefined=StrictUndefined)
+    _template_env.template_class = _PicklableTemplate
 
     @classmethod
     def register(cls, *names: str):
@@ -104,4 +118,36 @@ class PromptRegistry:
         Returns:
             Jinja Template
         """
-        return cls._template_env.from_string(template_str)
+        template = cls._template_env.from_string(template_str)
+        template.source = template_str
+        return template
+
+    @classmethod
+    def template_variables(cls, template: Template) -> Optional[FrozenSet[str]]:
+        """
+        The variables of a template, when all it takes for a sample to render
+        is for every one of them to be set. Templates whose control
+        structures, filters or attribute lookups could still fail, or not
+        need every variable, return None, and only rendering tells.
+
+        Args:
+            template: A template created by template_from_string
+
+        Returns:
+            The names of the variables, or None
+        """
+        source = getattr(template, "source", None)
+        if source is None:
+            return None
+        return _template_variables(cls._template_env, source)
+
+
+@functools.lru_cache(maxsize=256)
+def _template_variables(env: Environment, source: str) -> Optional[FrozenSet[str]]:
+    ast = env.parse(source)
+    for node in ast.body:
+        if not isinstance(node, nodes.Output):
+            return None
+        if not all(isinstance(n, (nodes.TemplateData, nodes.Name)) for n in node.nodes):
+            return None
+    return frozenset(meta.find_undeclared_variables(ast))
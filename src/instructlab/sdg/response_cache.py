@@ -0,0 +1,256 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+from abc import ABC, abstractmethod
+from collections import Counter
+from typing import Any, Dict, List, Optional, Sequence
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Bump to invalidate every cached response, when what is cached changes
+_CACHE_FORMAT = 1
+
+DEFAULT_MAX_SIZE = 1 << 30
+
+
+def _normalize_gen_kwargs(gen_kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    """The generation arguments that change a completion, in a canonical
+    form, so 0 and 0.0 or an unset and a None argument give the same key
+    """
+    normalized = {}
+    for name, value in gen_kwargs.items():
+        if name == "model" or value is None:
+            continue
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        normalized[name] = value
+    return normalized
+
+
+def is_sampled(gen_kwargs: Dict[str, Any]) -> bool:
+    """Whether requests with gen_kwargs sample their completions, so sending
+    the same one twice is expected to give different completions. OpenAI
+    servers default to a temperature of 1.
+    """
+    return float(gen_kwargs.get("temperature", 1.0)) > 0
+
+
+# This is part of the public API.
+class ResponseCache(ABC):
+    """
+    Completions of the teacher model that LLM blocks reuse instead of sending
+    the same request again, such as when rerunning a pipeline after a crash
+    or after editing one of its later blocks.
+
+    A request is keyed by the model id, the rendered prompt or chat
+    messages, and the generation arguments, including n. Each entry holds
+    the n completions of one request.
+
+    Requests that sample, with a temperature above 0, are not cached unless
+    reuse_sampled is set, since a pipeline may send the same request several
+    times to get different completions. With reuse_sampled, identical
+    requests of a batch are told apart by their order in the batch, and
+    identical batches, such as the iterations of an IterBlock, by the order
+    they are sent in. The completions still differ within a run, and a rerun
+    that batches its requests the same way replays them, whatever order its
+    batches are sent in concurrently.
+
+    Subclasses store the entries, by implementing _load and _store.
+
+    Args:
+        reuse_sampled: Reuse the completions of requests that sample.
+    """
+
+    def __init__(self, reuse_sampled: bool = False) -> None:
+        self.reuse_sampled = reuse_sampled
+        self.hits = 0
+        self.misses = 0
+        self.uncached = 0
+        self._occurrences: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def key(
+        self, model_id: Optional[str], request: Any, gen_kwargs: Dict[str, Any]
+    ) -> Optional[str]:
+        """The key of a request, which is a prompt or a list of chat messages,
+        or None if it should not be cached
+        """
+        return self.keys(model_id, [request], gen_kwargs)[0]
+
+    def keys(
+        self,
+        model_id: Optional[str],
+        requests: Sequence[Any],
+        gen_kwargs: Dict[str, Any],
+    ) -> List[Optional[str]]:
+        """The keys of a batch of requests, sent with the same gen_kwargs"""
+        sampled = is_sampled(gen_kwargs)
+        if sampled and not self.reuse_sampled:
+            with self._lock:
+                self.uncached += len(requests)
+            return [None] * len(requests)
+        normalized = _normalize_gen_kwargs(gen_kwargs)
+        keys = []
+        for request in requests:
+            digest = hashlib.sha256()
+            for part in (_CACHE_FORMAT, model_id, request, normalized):
+                digest.update(json.dumps(part, sort_keys=True, default=str).encode())
+                digest.update(b"\0")
+            keys.append(digest.hexdigest())
+        if not sampled:
+            return keys
+        batch = hashlib.sha256("".join(keys).encode()).hexdigest()
+        with self._lock:
+            repeat = self._occurrences[batch]
+            self._occurrences[batch] += 1
+        occurrences: Counter = Counter()
+        for i, key in enumerate(keys):
+            keys[i] = hashlib.sha256(
+                f"{key}:{batch}:{repeat}:{occurrences[key]}".encode()
+            ).hexdigest()
+            occurrences[key] += 1
+        return keys
+
+    def get(self, key: Optional[str]) -> Optional[List[str]]:
+        """The cached completions of the request with key, if any"""
+        if key is None:
+            return None
+        completions = self._load(key)
+        with self._lock:
+            if completions is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return completions
+
+    def put(self, key: Optional[str], completions: List[str]) -> None:
+        """Cache the completions of the request with key"""
+        if key is not None:
+            self._store(key, completions)
+
+    def stats(self) -> Dict[str, Any]:
+        """The number of hits and misses of the cache, the number of requests
+        that were not cached because they sample, and the hit rate
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "uncached": self.uncached,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    @abstractmethod
+    def _load(self, key: str) -> Optional[List[str]]:
+        """The stored completions of key, if any"""
+
+    @abstractmethod
+    def _store(self, key: str, completions: List[str]) -> None:
+        """Store the completions of key"""
+
+
+# This is part of the public API.
+class SQLiteResponseCache(ResponseCache):
+    """
+    A ResponseCache kept in a SQLite database, which may be shared between
+    runs and between the processes of a run.
+
+    Once the completions stored take more than max_size bytes, the least
+    recently used entries are evicted. The size is tracked by each process
+    and checked against the database when it goes past max_size, so
+    processes sharing a database may go over it by what the others added
+    since.
+
+    Args:
+        path: The database file.
+        max_size: The number of bytes of completions to keep.
+        reuse_sampled: Reuse the completions of requests that sample.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_size: int = DEFAULT_MAX_SIZE,
+        reuse_sampled: bool = False,
+    ) -> None:
+        super().__init__(reuse_sampled)
+        self.path = path
+        self.max_size = max_size
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        # Blocks look up their requests from several threads, which take
+        # turns on the one connection
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(
+            path, timeout=60, check_same_thread=False, isolation_level=None
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " completions TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)"
+        )
+        self._size = self._total_size()
+
+    def _total_size(self) -> int:
+        return self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    def _load(self, key: str) -> Optional[List[str]]:
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT completions FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                "UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+        return json.loads(row[0])
+
+    def _store(self, key: str, completions: List[str]) -> None:
+        value = json.dumps(completions)
+        size = len(value.encode())
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            self._size += size
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self) -> None:
+        self._size = self._total_size()
+        excess = self._size - self.max_size
+        if excess <= 0:
+            return
+        evicted = []
+        for key, size in self._db.execute(
+            "SELECT key, size FROM responses ORDER BY last_used"
+        ):
+            if excess <= 0:
+                break
+            evicted.append((key,))
+            excess -= size
+            self._size -= size
+        self._db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        logger.debug("Evicted %d responses from %s", len(evicted), self.path)
+
+    def close(self) -> None:
+        with self._db_lock:
+            self._db.close()
@@ -0,0 +1,217 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+from typing import List, Optional
+import contextlib
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+import weakref
+
+# Third Party
+from datasets import Dataset, concatenate_datasets
+from datasets.fingerprint import Hasher, generate_random_fingerprint
+from datasets.table import ConcatenationTable, InMemoryTable, MemoryMappedTable, Table
+import pyarrow
+
+# pylint: disable=protected-access
+
+logger = logging.getLogger(__name__)
+
+
+def _is_plain(dataset: Dataset) -> bool:
+    """Whether the dataset is a bare Arrow table we can rebuild around a new
+    table without losing an indices mapping, formatting or search indexes
+    """
+    return (
+        dataset._indices is None
+        and dataset.format["type"] is None
+        and not dataset.list_indexes()
+    )
+
+
+def _in_memory(table: Table) -> bool:
+    if isinstance(table, ConcatenationTable):
+        return all(
+            isinstance(block, InMemoryTable)
+            for row_blocks in table.blocks
+            for block in row_blocks
+        )
+    return isinstance(table, InMemoryTable)
+
+
+def slice_dataset(dataset: Dataset, start: int, end: int) -> Dataset:
+    """
+    Return rows [start, end) of the dataset as a zero-copy view of the
+    underlying Arrow table, without building an indices mapping.
+    """
+    if not _is_plain(dataset):
+        return dataset.select(range(start, end))
+    return Dataset(
+        dataset.data.slice(start, end - start),
+        info=dataset.info,
+        split=dataset.split,
+        fingerprint=Hasher.hash((dataset._fingerprint, start, end)),
+    )
+
+
+def compact_dataset(dataset: Dataset) -> Dataset:
+    """
+    Materialize any indices mapping and merge the many small record batches
+    left behind by concatenating per-batch outputs into one contiguous
+    record batch, so that slicing and iterating over the result stays cheap.
+    """
+    # Memory-mapped tables are left alone, compacting them would read them
+    # into memory
+    if (
+        dataset.format["type"] is not None
+        or dataset.list_indexes()
+        or not _in_memory(dataset.data)
+    ):
+        return dataset
+    table = dataset.data.table
+    if dataset._indices is not None:
+        table = table.take(dataset._indices.column(0))
+    elif all(column.num_chunks <= 1 for column in table.columns):
+        return dataset
+    return Dataset(
+        InMemoryTable(table.combine_chunks()),
+        info=dataset.info,
+        split=dataset.split,
+        fingerprint=Hasher.hash((dataset._fingerprint, "compact")),
+    )
+
+
+def concatenate_and_compact(datasets: List[Dataset]) -> Dataset:
+    """Concatenate the outputs of several batches into one compact dataset"""
+    if len(datasets) == 1:
+        return compact_dataset(datasets[0])
+    return compact_dataset(concatenate_datasets(datasets))
+
+
+def dataset_to_table(dataset: Dataset) -> pyarrow.Table:
+    """The rows of the dataset as a pyarrow Table, applying any indices
+    mapping
+    """
+    table = dataset.data.table
+    if dataset._indices is not None:
+        table = table.take(dataset._indices.column(0))
+    return table
+
+
+def table_to_dataset(table: pyarrow.Table) -> Dataset:
+    """Wrap a table in a dataset without hashing its contents for a
+    fingerprint
+    """
+    return Dataset(InMemoryTable(table), fingerprint=generate_random_fingerprint())
+
+
+def dataset_from_table(dataset: Dataset, table: pyarrow.Table, transform) -> Dataset:
+    """
+    Wrap a table computed from the rows of a dataset in a new dataset.
+    Features are taken from the table schema, and the fingerprint is derived
+    from the one of the input dataset and a description of the transform.
+    """
+    return Dataset(
+        InMemoryTable(table),
+        split=dataset.split,
+        fingerprint=Hasher.hash((dataset._fingerprint, transform)),
+    )
+
+
+def _remove_spilled(path: str) -> None:
+    # The scratch directory may be gone already
+    with contextlib.suppress(OSError):
+        os.remove(path)
+
+
+class MemoryBudget:
+    """
+    Caps the number of bytes of Arrow data held in memory by the datasets
+    passed to keep(). Once a dataset would take the total past the budget,
+    it is written to an Arrow IPC file in a scratch directory and memory
+    mapped back, so its pages are read from disk on demand and can be
+    evicted by the OS instead of adding to the RSS of the process.
+
+    A kept dataset counts against the budget until it is garbage collected.
+    A spilled file is removed once no dataset maps it any more. The scratch
+    directory is a new directory inside spill_dir, or the system temporary
+    directory, and is removed with everything spilled to it once the
+    MemoryBudget is garbage collected, or at exit.
+
+    Args:
+        budget: The maximum number of bytes kept in memory.
+        spill_dir: Where to create the scratch directory.
+    """
+
+    def __init__(self, budget: int, spill_dir: Optional[str] = None) -> None:
+        self.budget = budget
+        self.spill_dir = spill_dir
+        self.in_memory = 0
+        self.spilled = 0
+        self._scratch_dir: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def keep(self, dataset: Dataset) -> Dataset:
+        """Return the dataset, or a memory-mapped copy of it if it does not
+        fit in the budget
+        """
+        table = dataset.data
+        # Only plain in-memory tables are spilled, anything else is either on
+        # disk already or can not be rebuilt around a new table
+        if not _in_memory(table) or not _is_plain(dataset) or len(dataset) == 0:
+            return dataset
+        nbytes = table.nbytes
+        with self._lock:
+            fits = self.in_memory + nbytes <= self.budget
+            if fits:
+                self.in_memory += nbytes
+        if fits:
+            weakref.finalize(dataset, self._release, nbytes)
+            return dataset
+        return self._spill(dataset)
+
+    def _release(self, nbytes: int) -> None:
+        with self._lock:
+            self.in_memory -= nbytes
+
+    def _spill(self, dataset: Dataset) -> Dataset:
+        table = dataset_to_table(dataset)
+        path = os.path.join(self.scratch_dir, f"{uuid.uuid4().hex}.arrow")
+        with pyarrow.OSFile(path, "wb") as sink:
+            with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+        with self._lock:
+            self.spilled += table.nbytes
+        logger.debug("Spilled %d rows, %d bytes, to %s", len(table), table.nbytes, path)
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # The buffers of the table, and of every table sliced or derived from
+        # it without copying, keep the mapping alive, so the file is removed
+        # once no dataset reads from it any more
+        weakref.finalize(mapped, _remove_spilled, path)
+        table = pyarrow.ipc.open_stream(pyarrow.py_buffer(mapped)).read_all()
+        return Dataset(
+            MemoryMappedTable(table, path),
+            info=dataset.info,
+            split=dataset.split,
+            fingerprint=Hasher.hash((dataset._fingerprint, "spill", path)),
+        )
+
+    @property
+    def scratch_dir(self) -> str:
+        with self._lock:
+            if self._scratch_dir is None:
+                if self.spill_dir is not None:
+                    os.makedirs(self.spill_dir, exist_ok=True)
+                self._scratch_dir = tempfile.mkdtemp(
+                    prefix="sdg-spill-", dir=self.spill_dir
+                )
+                weakref.finalize(
+                    self, shutil.rmtree, self._scratch_dir, ignore_errors=True
+                )
+            return self._scratch_dir
@@ -0,0 +1,57 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+from typing import Any, Dict, Tuple
+import copy
+import os
+import threading
+
+# Third Party
+import yaml
+
+try:
+    # Third Party
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:
+    # Third Party
+    from yaml import SafeLoader as _SafeLoader  # type: ignore[assignment]
+
+# Parsed YAML files, keyed by resolved path, along with the modification
+# time and size of the file they were parsed from
+_yaml_cache: Dict[str, Tuple[Tuple[int, int], Any]] = {}
+_yaml_cache_lock = threading.Lock()
+
+
+def load_yaml(path: str) -> Any:
+    """
+    Load a YAML config file, parsing it only the first time it is loaded or
+    when it changed since then.
+
+    Pipeline and block configs are loaded every time a pipeline is created,
+    so this cache is shared by the whole process. Each call returns its own
+    copy of the parsed content, which callers are free to modify.
+
+    Args:
+        path: The path to the YAML file.
+
+    Returns:
+        The parsed content of the file.
+    """
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    with _yaml_cache_lock:
+        cached = _yaml_cache.get(path)
+    if cached is None or cached[0] != version:
+        with open(path, "r", encoding="utf-8") as config_file:
+            content = yaml.load(config_file, Loader=_SafeLoader)
+        cached = (version, content)
+        with _yaml_cache_lock:
+            _yaml_cache[path] = cached
+    return copy.deepcopy(cached[1])
+
+
+def clear_yaml_cache() -> None:
+    """Forget every parsed YAML file"""
+    with _yaml_cache_lock:
+        _yaml_cache.clear()
@@ -0,0 +1,342 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, List, Optional, Sequence, Tuple
+import json
+import logging
+import math
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+# First Party
+from instructlab.sdg.utils import GenerateException
+from instructlab.sdg.utils.json import jldump
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SHARD_SIZE = 100
+DEFAULT_LEASE_TIMEOUT = 600.0
+
+
+def batch_shard_size(shard_size: int, batch_size: Optional[int]) -> int:
+    """shard_size rounded up to a whole number of batches of batch_size, so
+    the rows of every shard are batched as they are on a single host
+    """
+    if not batch_size:
+        return shard_size
+    return math.ceil(shard_size / batch_size) * batch_size
+
+
+@dataclass(frozen=True)
+class Shard:
+    """A range of rows of one input of a WorkQueue"""
+
+    input_name: str
+    index: int
+    start: int
+    end: int
+
+    @property
+    def shard_id(self) -> str:
+        return f"{self.input_name}.{self.index:05d}"
+
+
+# This is part of the public API.
+class WorkQueue:
+    """
+    Spreads the rows of a set of inputs over workers on several hosts that
+    share a directory, such as one on a network filesystem.
+
+    The inputs are split into shards of up to shard_size rows, each of which
+    a single worker claims by creating its lock file, processes, and
+    completes by renaming its output into place. A worker keeps touching the
+    lock files of the shards it works on, and a lock file left untouched for
+    lease_timeout seconds, by a worker that died, may be claimed by another.
+    Once every shard is done, merge() concatenates the outputs of each input
+    in order, giving what processing the whole input in one run would.
+
+    The directory holds:
+
+    - plan.json: The inputs, their number of rows and the shard size.
+    - claims/<shard_id>.lock: The worker processing a shard.
+    - outputs/<shard_id>.jsonl: The output of a finished shard.
+    - checkpoints/<shard_id>/: Pipeline checkpoints of a shard, so the
+      worker that takes over a shard from a dead one resumes it.
+
+    Args:
+        queue_dir: The shared directory.
+        worker_id: The name of this worker in lock files. Defaults to the
+            host name and process id.
+        lease_timeout: The number of seconds after which the claim of a
+            worker that stopped touching its lock file expires.
+    """
+
+    def __init__(
+        self,
+        queue_dir: str,
+        worker_id: Optional[str] = None,
+        lease_timeout: float = DEFAULT_LEASE_TIMEOUT,
+    ) -> None:
+        self.queue_dir = queue_dir
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_timeout = lease_timeout
+        self.checkpoint_dir = os.path.join(queue_dir, "checkpoints")
+        self._plan_path = os.path.join(queue_dir, "plan.json")
+        self._claims_dir = os.path.join(queue_dir, "claims")
+        self._outputs_dir = os.path.join(queue_dir, "outputs")
+
+    def plan(self, inputs: Sequence[Tuple[str, int]], shard_size: int) -> List[Shard]:
+        """
+        Split inputs, given as (name, number of rows) pairs, into shards,
+        unless another worker already did. Every worker of a queue must plan
+        the same inputs.
+        """
+        if shard_size < 1:
+            raise ValueError("The shard size must be at least 1")
+        plan = {
+            "shard_size": shard_size,
+            "inputs": [[name, num_rows] for name, num_rows in inputs],
+        }
+        if len({name for name, _ in plan["inputs"]}) != len(plan["inputs"]):
+            raise ValueError("The inputs of a work queue must have unique names")
+        for path in (self.queue_dir, self._claims_dir, self._outputs_dir):
+            os.makedirs(path, exist_ok=True)
+        # Linking fails if the plan exists, so the first worker's plan wins
+        # even when several start at once
+        tmp_path = self._write_tmp(self.queue_dir, json.dumps(plan))
+        try:
+            os.link(tmp_path, self._plan_path)
+            logger.info("Planned work queue %s", self.queue_dir)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(tmp_path)
+        if self._load_plan() != plan:
+            raise GenerateException(
+                f"Error: work queue {self.queue_dir} was planned for other inputs"
+            )
+        return self.shards()
+
+    def _load_plan(self) -> Any:
+        try:
+            with open(self._plan_path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError as err:
+            raise GenerateException(
+                f"Error: work queue {self.queue_dir} has not been planned"
+            ) from err
+
+    def shards(self) -> List[Shard]:
+        """Every shard of the queue, in input and row order"""
+        plan = self._load_plan()
+        shard_size = plan["shard_size"]
+        return [
+            Shard(name, index, start, min(start + shard_size, num_rows))
+            for name, num_rows in plan["inputs"]
+            for index, start in enumerate(range(0, num_rows, shard_size))
+        ]
+
+    def input_names(self) -> List[str]:
+        return [name for name, _ in self._load_plan()["inputs"]]
+
+    def _claim_path(self, shard: Shard) -> str:
+        return os.path.join(self._claims_dir, f"{shard.shard_id}.lock")
+
+    def _output_path(self, shard: Shard) -> str:
+        return os.path.join(self._outputs_dir, f"{shard.shard_id}.jsonl")
+
+    @staticmethod
+    def _write_tmp(directory: str, content: str) -> str:
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(content)
+        return tmp_path
+
+    def is_done(self, shard: Shard) -> bool:
+        return os.path.exists(self._output_path(shard))
+
+    def pending(self) -> List[Shard]:
+        """The shards not done yet, claimed or not"""
+        return [shard for shard in self.shards() if not self.is_done(shard)]
+
+    def _is_stale(self, claim_path: str) -> bool:
+        try:
+            return time.time() - os.path.getmtime(claim_path) > self.lease_timeout
+        except FileNotFoundError:
+            return False
+
+    def _try_claim(self, shard: Shard) -> bool:
+        claim_path = self._claim_path(shard)
+        if self._is_stale(claim_path):
+            # Renaming succeeds for a single worker. Check the claim is still
+            # stale afterwards, in case it was renewed in the meantime.
+            stale_path = f"{claim_path}.{self.worker_id}.stale"
+            try:
+                os.rename(claim_path, stale_path)
+            except FileNotFoundError:
+                return False
+            if not self._is_stale(stale_path):
+                os.rename(stale_path, claim_path)
+                return False
+            logger.warning("Taking over expired claim of shard %s", shard.shard_id)
+            os.unlink(stale_path)
+        try:
+            fd = os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"worker_id": self.worker_id, "claimed": time.time()}, f)
+        return True
+
+    def claim(self) -> Optional[Shard]:
+        """Claim the first shard that is neither done nor claimed, if any"""
+        for shard in self.shards():
+            if self.is_done(shard) or not self._try_claim(shard):
+                continue
+            # It may have been completed between the two checks
+            if self.is_done(shard):
+                self.release(shard)
+                continue
+            return shard
+        return None
+
+    def release(self, shard: Shard) -> None:
+        """Give up a claimed shard, so another worker can take it"""
+        try:
+            os.unlink(self._claim_path(shard))
+        except FileNotFoundError:
+            pass
+
+    def complete(self, shard: Shard, rows: Iterable[Any]) -> None:
+        """Write the output of a claimed shard and release it"""
+        fd, tmp_path = tempfile.mkstemp(dir=self._outputs_dir, suffix=".tmp")
+        os.close(fd)
+        try:
+            jldump(rows, tmp_path)
+            os.replace(tmp_path, self._output_path(shard))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.release(shard)
+
+    @contextmanager
+    def _heartbeat(self, shard: Shard):
+        stopped = threading.Event()
+        claim_path = self._claim_path(shard)
+
+        def renew():
+            while not stopped.wait(self.lease_timeout / 4):
+                try:
+                    os.utime(claim_path)
+                except FileNotFoundError:
+                    logger.warning("Lost the claim of shard %s", shard.shard_id)
+                    return
+
+        thread = threading.Thread(target=renew, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+    def run(self, process: Callable[[Shard], Iterable[Any]]) -> int:
+        """
+        Claim, process and complete shards until none is left to claim,
+        returning how many this worker processed. process is given a shard
+        and returns the rows of its output.
+        """
+        processed = 0
+        while (shard := self.claim()) is not None:
+            logger.info(
+                "Processing shard %s, rows %d to %d of %s",
+                shard.shard_id,
+                shard.start,
+                shard.end,
+                shard.input_name,
+            )
+            try:
+                with self._heartbeat(shard):
+                    rows = process(shard)
+                self.complete(shard, rows)
+            except BaseException:
+                self.release(shard)
+                raise
+            processed += 1
+        return processed
+
+    def merge_input(
+        self,
+        input_name: str,
+        output_file: str,
+        checkpoint_dir: Optional[str] = None,
+        skip_empty: bool = False,
+    ) -> bool:
+        """
+        Concatenate the outputs of the shards of an input into output_file,
+        and copy their checkpoints into checkpoint_dir. Returns whether
+        output_file was written, which it is not for an empty output with
+        skip_empty.
+        """
+        shards = [shard for shard in self.shards() if shard.input_name == input_name]
+        missing = [shard.shard_id for shard in shards if not self.is_done(shard)]
+        if missing:
+            raise GenerateException(
+                f"Error: shards {', '.join(missing)} of {input_name} are not done"
+            )
+        if checkpoint_dir is not None:
+            for shard in shards:
+                shard_checkpoints = os.path.join(self.checkpoint_dir, shard.shard_id)
+                if os.path.isdir(shard_checkpoints):
+                    shutil.copytree(
+                        shard_checkpoints, checkpoint_dir, dirs_exist_ok=True
+                    )
+        if skip_empty and all(
+            os.path.getsize(self._output_path(shard)) == 0 for shard in shards
+        ):
+            return False
+        output_dir = os.path.dirname(os.path.abspath(output_file))
+        os.makedirs(output_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=output_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                for shard in shards:
+                    with open(self._output_path(shard), "rb") as f:
+                        shutil.copyfileobj(f, out)
+            os.replace(tmp_path, output_file)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return True
+
+    def merge(
+        self,
+        output_dir: str,
+        checkpoint_dir: Optional[str] = None,
+        skip_empty: bool = False,
+    ) -> List[str]:
+        """
+        Merge the shards of every input into output_dir, under the name of
+        the input, and their checkpoints into a subdirectory of
+        checkpoint_dir named after the input without its extension. Returns
+        the files written.
+        """
+        output_files = []
+        for input_name in self.input_names():
+            output_file = os.path.join(output_dir, input_name)
+            input_checkpoint_dir = None
+            if checkpoint_dir is not None:
+                input_checkpoint_dir = os.path.join(
+                    checkpoint_dir, os.path.splitext(input_name)[0]
+                )
+            if self.merge_input(
+                input_name, output_file, input_checkpoint_dir, skip_empty
+            ):
+                output_files.append(output_file)
+        return output_files
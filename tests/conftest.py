@@ -48,6 +48,11 @@ def get_threaded_ctx(**kwargs) -> PipelineContext:
     return get_ctx(**kwargs)
 
 
+def get_streaming_ctx(**kwargs) -> PipelineContext:
+    kwargs["streaming"] = True
+    return get_threaded_ctx(**kwargs)
+
+
 @pytest.fixture
 def single_threaded_ctx() -> PipelineContext:
     return get_single_threaded_ctx()
@@ -67,3 +72,8 @@ def taxonomy_dir(tmp_path):
 @pytest.fixture
 def threaded_ctx() -> PipelineContext:
     return get_threaded_ctx()
+
+
+@pytest.fixture
+def streaming_ctx() -> PipelineContext:
+    return get_streaming_ctx()
@@ -9,3 +9,20 @@ import sys
 def test_sdg_imports(testdata_path: pathlib.Path):
     script = testdata_path / "leanimports.py"
     subprocess.check_call([sys.executable, str(script)], text=True)
+
+
+def test_sdg_pipeline_imports(testdata_path: pathlib.Path):
+    script = testdata_path / "leanpipelineimports.py"
+    subprocess.check_call([sys.executable, str(script)], text=True)
+
+
+def test_sdg_import_time(testdata_path: pathlib.Path):
+    sys.path.insert(0, str(testdata_path))
+    try:
+        # Third Party
+        from importtime import STATEMENTS, import_time
+    finally:
+        sys.path.remove(str(testdata_path))
+    pipeline = import_time(STATEMENTS["pipeline"], runs=3)
+    generate_data = import_time(STATEMENTS["generate_data"], runs=3)
+    assert pipeline < generate_data
@@ -0,0 +1,148 @@
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+A stub OpenAI-compatible LLM server for tests that need real HTTP requests
+"""
+
+# Standard
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+
+
+class StubLLMServer:
+    """
+    Serves /v1/completions and /v1/chat/completions on a local port from a
+    background thread, answering every prompt with `text`. Streamed requests
+    get a chunk for every choice.
+
+    Args:
+        text: The text of every completion.
+        supports_batched: Whether a list of prompts, and n, are answered
+            with a choice for every completion. Otherwise, like
+            llama-cpp-python, there is a single choice.
+        delay: The number of seconds to wait before answering.
+    """
+
+    def __init__(self, text="stub", supports_batched=True, delay=0.0):
+        self.text = text
+        self.supports_batched = supports_batched
+        self.delay = delay
+        self.requests = []
+        self._failures = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = threading.Thread(target=self._server.serve_forever)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}/v1"
+
+    def fail(self, status, count=1, headers=None):
+        """Answer the next count requests with an error status"""
+        with self._lock:
+            self._failures.extend([(status, headers or {})] * count)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def _respond(self, path, body):
+        with self._lock:
+            self.requests.append(body)
+            failure = self._failures.pop(0) if self._failures else None
+        if self.delay:
+            time.sleep(self.delay)
+        if failure is not None:
+            status, headers = failure
+            return status, headers, {"error": {"message": "stub failure"}}
+        n = body.get("n", 1)
+        if path.endswith("/chat/completions"):
+            choices = [
+                {
+                    "index": i,
+                    "message": {"role": "assistant", "content": self.text},
+                    "finish_reason": "stop",
+                }
+                for i in range(n)
+            ]
+            return 200, {}, _completion("chat.completion", body, choices)
+        prompts = body["prompt"] if isinstance(body["prompt"], list) else [None]
+        if not self.supports_batched:
+            prompts, n = prompts[:1], 1
+        choices = [
+            {"index": i, "text": self.text, "finish_reason": "stop", "logprobs": None}
+            for i in range(len(prompts) * n)
+        ]
+        return 200, {}, _completion("text_completion", body, choices)
+
+
+def _completion(kind, body, choices):
+    return {
+        "id": "stub",
+        "object": kind,
+        "created": 0,
+        "model": body.get("model", "stub"),
+        "choices": choices,
+        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+    }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):  # pylint: disable=invalid-name
+        self._send(404, {}, {"error": {"message": "not found"}})
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        status, headers, payload = self.server.stub._respond(self.path, body)
+        if body.get("stream") and status == 200:
+            self._stream(payload)
+        else:
+            self._send(status, headers, payload)
+
+    def _stream(self, payload):
+        # Every choice is sent as a chunk of its own, as server-sent events
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        try:
+            for choice in payload["choices"]:
+                if "message" in choice:
+                    choice = {
+                        "index": choice["index"],
+                        "delta": choice["message"],
+                        "finish_reason": choice["finish_reason"],
+                    }
+                    chunk = dict(payload, object="chat.completion.chunk")
+                else:
+                    chunk = dict(payload)
+                chunk["choices"] = [choice]
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closed the stream before reading all of it
+            pass
+        self.close_connection = True
+
+    def _send(self, status, headers, payload):
+        content = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
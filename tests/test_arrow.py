@@ -0,0 +1,113 @@
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Unit tests for the Arrow dataset helpers used to batch pipeline runs
+"""
+
+# Standard
+import gc
+import os
+
+# Third Party
+from datasets import Dataset, concatenate_datasets
+from datasets.table import InMemoryTable, MemoryMappedTable
+
+# First Party
+from instructlab.sdg.utils.arrow import (
+    MemoryBudget,
+    compact_dataset,
+    concatenate_and_compact,
+    slice_dataset,
+)
+
+
+def _num_chunks(dataset):
+    return dataset.data.table.column(0).num_chunks
+
+
+def test_slice_dataset_is_zero_copy():
+    dataset = Dataset.from_dict({"foo": list(range(10))})
+    sliced = slice_dataset(dataset, 2, 5)
+    assert sliced["foo"] == [2, 3, 4]
+    assert sliced._indices is None
+    # The slice shares its buffers with the original table
+    parent = dataset.data.table.column(0).chunk(0).buffers()[1]
+    child = sliced.data.table.column(0).chunk(0).buffers()[1]
+    assert child.address == parent.address
+
+
+def test_slice_dataset_with_indices_mapping():
+    dataset = Dataset.from_dict({"foo": list(range(10))}).select([9, 7, 5, 3, 1])
+    assert slice_dataset(dataset, 1, 3)["foo"] == [7, 5]
+
+
+def test_compact_dataset_flattens_indices():
+    dataset = Dataset.from_dict({"foo": list(range(10))}).select([9, 7, 5])
+    compacted = compact_dataset(dataset)
+    assert compacted._indices is None
+    assert compacted["foo"] == [9, 7, 5]
+
+
+def test_concatenate_and_compact_merges_record_batches():
+    dataset = Dataset.from_dict({"foo": list(range(10))})
+    splits = [slice_dataset(dataset, i, i + 2) for i in range(0, 10, 2)]
+    assert _num_chunks(concatenate_datasets(splits)) == 5
+    combined = concatenate_and_compact(splits)
+    assert _num_chunks(combined) == 1
+    assert combined["foo"] == list(range(10))
+
+
+def test_compact_dataset_keeps_formatting():
+    dataset = Dataset.from_dict({"foo": list(range(4))}).with_format("numpy")
+    assert compact_dataset(dataset) is dataset
+
+
+def test_memory_budget_spills_past_budget(tmp_path):
+    budget = MemoryBudget(100, str(tmp_path))
+    first = budget.keep(Dataset.from_dict({"foo": list(range(10))}))
+    assert isinstance(first.data, InMemoryTable)
+    assert budget.in_memory == 80
+    # The second one does not fit next to the first
+    second = budget.keep(Dataset.from_dict({"foo": list(range(10, 20))}))
+    assert isinstance(second.data, MemoryMappedTable)
+    assert second["foo"] == list(range(10, 20))
+    assert budget.spilled == 80
+    assert len(os.listdir(budget.scratch_dir)) == 1
+    # Memory-mapped datasets do not count against the budget, and the first
+    # one stops counting once it is gone
+    assert budget.keep(second) is second
+    del first
+    gc.collect()
+    assert budget.in_memory == 0
+    third = budget.keep(Dataset.from_dict({"foo": list(range(5))}))
+    assert budget.in_memory == 40
+    assert third["foo"] == list(range(5))
+
+
+def test_memory_budget_removes_scratch_dir(tmp_path):
+    budget = MemoryBudget(0, str(tmp_path))
+    spilled = budget.keep(Dataset.from_dict({"foo": ["a", "b"]}).select([1]))
+    assert spilled["foo"] == ["b"]
+    scratch_dir = budget.scratch_dir
+    del budget
+    gc.collect()
+    assert not os.path.exists(scratch_dir)
+    # The mapped pages stay readable
+    assert spilled["foo"] == ["b"]
+
+
+def test_memory_budget_removes_unmapped_spill_files(tmp_path):
+    budget = MemoryBudget(0, str(tmp_path))
+    spilled = budget.keep(Dataset.from_dict({"foo": list(range(10))}))
+    (path,) = [f["filename"] for f in spilled.cache_files]
+    # Datasets derived from a spilled one still map its file
+    derived = slice_dataset(spilled, 2, 5).rename_column("foo", "bar")
+    derived = concatenate_datasets([derived, derived])
+    del spilled
+    gc.collect()
+    assert os.path.exists(path)
+    assert derived["bar"] == [2, 3, 4, 2, 3, 4]
+    del derived
+    gc.collect()
+    assert not os.path.exists(path)
+    assert os.path.exists(budget.scratch_dir)
@@ -0,0 +1,116 @@
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Unit tests for the pipeline auto-tuner
+"""
+
+# Standard
+from unittest.mock import MagicMock
+import time
+
+# Third Party
+import httpx
+import openai
+import pytest
+
+# First Party
+from instructlab.sdg.autotune import AutoTuner, is_throttled
+
+
+def _status_error(status_code):
+    request = httpx.Request("POST", "http://localhost/v1/completions")
+    response = httpx.Response(status_code, request=request)
+    return openai.APIStatusError("error", response=response, body=None)
+
+
+def test_additive_increase():
+    tuner = AutoTuner(batch_size=4, num_workers=2, batch_size_step=2, window=4)
+    for _ in range(4):
+        tuner.record_request(0.1)
+    assert tuner.num_workers == 3
+    assert tuner.batch_size == 6
+
+
+def test_multiplicative_decrease_on_throttling():
+    tuner = AutoTuner(batch_size=16, num_workers=8, window=4)
+    for _ in range(3):
+        tuner.record_request(0.1)
+    tuner.record_request(0.1, error=True, throttled=True)
+    assert tuner.num_workers == 4
+    assert tuner.batch_size == 8
+
+
+def test_decrease_workers_when_latency_grows():
+    tuner = AutoTuner(batch_size=8, num_workers=4, window=2, latency_tolerance=2.0)
+    tuner.record_request(0.1)
+    tuner.record_request(0.1)
+    assert tuner.num_workers == 5
+    tuner.record_request(1.0)
+    tuner.record_request(1.0)
+    assert tuner.num_workers == 4
+    assert tuner.batch_size == 9
+
+
+def test_bounds_are_respected():
+    tuner = AutoTuner(
+        batch_size=2, num_workers=1, min_batch_size=2, min_workers=1, window=1
+    )
+    tuner.record_request(0.1, error=True)
+    assert tuner.num_workers == 1
+    assert tuner.batch_size == 2
+    tuner = AutoTuner(batch_size=4, num_workers=2, max_batch_size=4, max_workers=2)
+    tuner.window = 1
+    tuner.record_request(0.1)
+    assert tuner.num_workers == 2
+    assert tuner.batch_size == 4
+
+
+def test_observe_records_failures():
+    tuner = AutoTuner(batch_size=16, num_workers=8, window=1)
+    with pytest.raises(openai.APIStatusError):
+        with tuner.observe():
+            raise _status_error(429)
+    assert tuner.num_workers == 4
+
+
+def test_is_throttled():
+    assert is_throttled(_status_error(429))
+    assert is_throttled(_status_error(503))
+    assert not is_throttled(_status_error(400))
+    assert not is_throttled(ValueError())
+
+
+def test_calibrate_picks_highest_concurrency_within_tolerance():
+    tuner = AutoTuner(max_workers=16, probe_requests=1)
+    probe = MagicMock(side_effect=lambda: time.sleep(0.01))
+    tuner.calibrate(probe)
+    assert tuner.calibrated
+    # Constant latency means every concurrency level up to the max is fine
+    assert tuner.num_workers == 16
+    assert probe.call_count == 1 + 2 + 4 + 8 + 16
+
+
+def test_calibrate_keeps_given_workers():
+    tuner = AutoTuner(max_workers=16, probe_requests=1)
+    tuner.seed(4, 2)
+    probe = MagicMock(side_effect=lambda: time.sleep(0.01))
+    tuner.calibrate(probe)
+    assert tuner.baseline_latency is not None
+    assert tuner.num_workers == 2
+    assert probe.call_count == 1
+
+
+def test_seed_fills_what_the_tuner_was_not_given():
+    tuner = AutoTuner(batch_size=16)
+    assert (tuner.batch_size, tuner.num_workers) == (16, 4)
+    tuner.seed(2, 6)
+    assert (tuner.batch_size, tuner.num_workers) == (16, 6)
+    tuner.seed(3, 3)
+    assert (tuner.batch_size, tuner.num_workers) == (16, 6)
+
+
+def test_calibrate_keeps_defaults_on_failure():
+    tuner = AutoTuner(num_workers=3, probe_requests=1)
+    tuner.calibrate(MagicMock(side_effect=RuntimeError("down")))
+    assert tuner.calibrated
+    assert tuner.num_workers == 3
@@ -0,0 +1,186 @@
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Unit tests for spreading LLM requests over several replicas of the teacher
+model
+"""
+
+# Standard
+from unittest.mock import patch
+import asyncio
+import threading
+import time
+
+# Third Party
+from datasets import Dataset
+import openai
+import pytest
+
+# First Party
+from instructlab.sdg import ClientPool, LLMBlock, LLMMessagesBlock, RetryPolicy
+from instructlab.sdg.blocks.llmblock import server_supports_batched
+
+# Local
+from .conftest import get_ctx
+from .stubserver import StubLLMServer
+
+
+@pytest.fixture
+def servers():
+    with StubLLMServer("one") as one, StubLLMServer("two") as two:
+        yield one, two
+
+
+def _pool(servers, **kwargs):
+    return ClientPool.from_urls(
+        [server.base_url for server in servers], max_retries=0, **kwargs
+    )
+
+
+def _complete(pool, prompt="hello"):
+    response = pool.completions.create(model="test-model", prompt=prompt)
+    return response.choices[0].text
+
+
+def test_requests_are_spread_by_weight(servers):
+    pool = _pool(servers, weights=[1, 3])
+    texts = [_complete(pool) for _ in range(8)]
+    assert texts.count("one") == 2
+    assert texts.count("two") == 6
+    assert [endpoint["requests"] for endpoint in pool.stats()] == [2, 6]
+
+
+def test_requests_go_to_the_least_loaded_replica(servers):
+    one, two = servers
+    one.delay = 0.5
+    pool = _pool(servers)
+    slow = threading.Thread(target=_complete, args=(pool,))
+    slow.start()
+    while not one.requests:
+        time.sleep(0.01)
+    # The first replica is busy with the slow request, so the second one
+    # gets every request sent in the meantime
+    texts = [_complete(pool) for _ in range(3)]
+    slow.join()
+    assert texts == ["two"] * 3
+
+
+def test_failing_replica_is_ejected(servers):
+    one, two = servers
+    one.fail(500, count=100)
+    pool = _pool(servers, max_failures=2, ejection_time=60)
+    # Requests that fail on the first replica are sent again to the second
+    assert [_complete(pool) for _ in range(6)] == ["two"] * 6
+    # After two failures the first replica gets no more requests
+    assert len(one.requests) == 2
+    assert pool.stats()[0]["failures"] == 2
+    assert pool.stats()[0]["ejections"] == 1
+
+
+def test_ejected_replica_comes_back(servers):
+    one, _ = servers
+    one.fail(503, count=1)
+    pool = _pool(servers, max_failures=1, ejection_time=0.2)
+    _complete(pool)
+    assert pool.stats()[0]["ejections"] == 1
+    time.sleep(0.3)
+    texts = [_complete(pool) for _ in range(4)]
+    assert "one" in texts
+
+
+def test_client_errors_are_not_retried(servers):
+    one, two = servers
+    one.fail(400)
+    pool = _pool(servers)
+    with pytest.raises(openai.BadRequestError):
+        _complete(pool)
+    assert not two.requests
+    assert pool.stats()[0]["failures"] == 0
+
+
+def test_every_replica_failing_raises(servers):
+    for server in servers:
+        server.fail(500)
+    with pytest.raises(openai.InternalServerError):
+        _complete(_pool(servers, retry_policy=RetryPolicy(max_retries=0)))
+
+
+def test_server_supports_batched_is_cached_per_replica(servers):
+    one, two = servers
+    two.supports_batched = False
+    pool = _pool(servers)
+    assert not server_supports_batched(pool, "test-model")
+    assert [client.server_supports_batched for client in pool.clients] == [
+        True,
+        False,
+    ]
+    # Both replicas were only probed once
+    assert not server_supports_batched(pool, "test-model")
+    assert len(one.requests) == len(two.requests) == 1
+
+
+def test_llm_blocks_use_the_pool(servers):
+    pool = _pool(servers)
+    ctx = get_ctx(client=pool)
+    samples = Dataset.from_list([{"fruit": "apple"}, {"fruit": "pear"}])
+    with patch.object(LLMBlock, "_load_config") as load_config:
+        load_config.return_value = {
+            "system": "{{fruit}}",
+            "introduction": "",
+            "principles": "",
+            "examples": "",
+            "generation": "",
+            "start_tags": [""],
+            "end_tags": [""],
+        }
+        block = LLMBlock(ctx, None, "gen", "", ["output"], model_prompt="")
+    assert block.server_supports_batched
+    assert block.generate(samples)["output"] == ["one", "one"]
+
+    messages = Dataset.from_list(
+        [{"messages": [{"role": "user", "content": "hi"}]}] * 4
+    )
+    block = LLMMessagesBlock(ctx, None, "chat", "messages", "output")
+    outputs = asyncio.run(block.agenerate(messages))["output"]
+    assert sorted(outputs) == ["one", "one", "two", "two"]
+    assert ctx.get_async_client().pool is pool
+
+
+def test_streamed_requests_hold_the_replica(servers):
+    pool = _pool(servers[:1])
+    stream = pool.completions.create(model="test-model", prompt=["a", "b"], stream=True)
+    chunks = iter(stream)
+    assert next(chunks).choices[0].text == "one"
+    # The replica is still busy while the stream is read
+    assert pool.stats()[0]["outstanding"] == 1
+    assert len(list(chunks)) == 1
+    assert pool.stats()[0]["outstanding"] == 0
+
+    with pool.completions.create(model="test-model", prompt="a", stream=True):
+        assert pool.stats()[0]["outstanding"] == 1
+    assert pool.stats()[0]["outstanding"] == 0
+
+
+def test_async_streamed_requests_hold_the_replica(servers):
+    pool = _pool(servers[:1])
+
+    async def read():
+        stream = await pool.async_pool().chat.completions.create(
+            model="test-model",
+            messages=[{"role": "user", "content": "hi"}],
+            stream=True,
+        )
+        assert pool.stats()[0]["outstanding"] == 1
+        contents = [chunk.choices[0].delta.content async for chunk in stream]
+        return contents, pool.stats()[0]["outstanding"]
+
+    assert asyncio.run(read()) == (["one"], 0)
+
+
+def test_pool_arguments_are_checked():
+    with pytest.raises(ValueError):
+        ClientPool([])
+    with pytest.raises(ValueError):
+        ClientPool.from_urls(["http://localhost/v1"], weights=[1, 2])
+    with pytest.raises(ValueError):
+        ClientPool.from_urls(["http://localhost/v1"], weights=[0])
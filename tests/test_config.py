@@ -0,0 +1,74 @@
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Unit tests for the cache of parsed YAML config files
+"""
+
+# Standard
+from unittest.mock import patch
+import os
+
+# Third Party
+import pytest
+
+# First Party
+from instructlab.sdg.blocks.llmblock import template_from_struct_and_config
+from instructlab.sdg.utils import config
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    config.clear_yaml_cache()
+    yield
+    config.clear_yaml_cache()
+
+
+def _write(path, content, mtime_ns=None):
+    path.write_text(content, encoding="utf-8")
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_load_yaml_parses_once(tmp_path):
+    path = tmp_path / "config.yaml"
+    _write(path, "system: hello\n")
+    with patch.object(config.yaml, "load", wraps=config.yaml.load) as load:
+        assert config.load_yaml(str(path)) == {"system": "hello"}
+        assert config.load_yaml(str(tmp_path / "." / "config.yaml")) == {
+            "system": "hello"
+        }
+    assert load.call_count == 1
+
+
+def test_load_yaml_reloads_changed_files(tmp_path):
+    path = tmp_path / "config.yaml"
+    _write(path, "system: hello\n", mtime_ns=1_000_000_000)
+    assert config.load_yaml(str(path)) == {"system": "hello"}
+    _write(path, "system: bye\n", mtime_ns=2_000_000_000)
+    assert config.load_yaml(str(path)) == {"system": "bye"}
+
+
+def test_load_yaml_returns_copies(tmp_path):
+    path = tmp_path / "config.yaml"
+    _write(path, "gen_kwargs:\n  max_tokens: 10\n")
+    config.load_yaml(str(path))["gen_kwargs"]["max_tokens"] = 20
+    assert config.load_yaml(str(path)) == {"gen_kwargs": {"max_tokens": 10}}
+
+
+def test_load_yaml_missing_file(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        config.load_yaml(str(tmp_path / "missing.yaml"))
+
+
+def test_prompt_templates_are_compiled_once():
+    struct = "{system}\n{generation}"
+    first = template_from_struct_and_config(
+        struct, {"system": "hi", "generation": None}
+    )
+    second = template_from_struct_and_config(
+        struct, {"system": "hi", "generation": None}
+    )
+    other = template_from_struct_and_config(struct, {"system": "bye", "generation": ""})
+    assert first is second
+    assert other is not first
+    assert first.render() == "hi"
@@ -0,0 +1,319 @@
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Unit tests for estimating the cost of a pipeline run
+"""
+
+# Standard
+from unittest.mock import MagicMock, patch
+import json
+import subprocess
+import sys
+
+# Third Party
+from datasets import Dataset
+import pytest
+
+# First Party
+from instructlab.sdg import Pipeline
+from instructlab.sdg.estimate import (
+    BlockEstimate,
+    PipelineEstimate,
+    ServerThroughput,
+    measure_throughput,
+)
+
+# Local
+from .conftest import get_ctx
+from .stubserver import StubLLMServer
+
+
+class _WordTokenizer:
+    @staticmethod
+    def encode(text):
+        return text.split()
+
+
+def _llm_block(name, output_col, gen_kwargs=None):
+    return {
+        "name": name,
+        "type": "LLMBlock",
+        "config": {
+            "config_path": "",
+            "output_cols": [output_col],
+            "model_prompt": "",
+            "gen_kwargs": gen_kwargs or {},
+        },
+    }
+
+
+def _filter_block(name, column, value=1):
+    return {
+        "name": name,
+        "type": "FilterByValueBlock",
+        "config": {
+            "filter_column": column,
+            "filter_value": value,
+            "operation": "eq",
+            "convert_dtype": "int",
+        },
+    }
+
+
+@pytest.fixture(autouse=True)
+def prompt_config():
+    with patch("instructlab.sdg.blocks.block.Block._load_config") as load_config:
+        load_config.return_value = {
+            "system": "{{fruit}} is a fruit",
+            "introduction": "",
+            "principles": "",
+            "examples": "",
+            "generation": "",
+        }
+        yield
+
+
+@pytest.fixture
+def ctx():
+    ctx = get_ctx(batch_size=4)
+    ctx.client.server_supports_batched = False
+    return ctx
+
+
+@pytest.fixture
+def fruits():
+    return Dataset.from_dict({"fruit": ["apple", "pear", "plum", "fig", "kiwi"]})
+
+
+def test_estimate_llm_block_unbatched(ctx, fruits):
+    """Every completion is its own request, sending the rendered prompt"""
+    pipe_cfg = [_llm_block("gen", "question", {"n": 2, "max_tokens": 10})]
+    estimate = Pipeline(ctx, "", pipe_cfg).estimate(fruits, tokenizer=_WordTokenizer())
+    [block] = estimate.blocks
+    assert block.rows_in == 5
+    assert block.rows_out == 10
+    assert block.llm_requests == 10
+    # "<fruit> is a fruit" is 4 words
+    assert block.prompt_tokens == 40
+    assert block.max_completion_tokens == 100
+    assert block.assumed_yield == 1.0
+    ctx.client.completions.create.assert_not_called()
+
+
+def test_estimate_llm_block_batched(ctx, fruits):
+    """One request per batch, reading each prompt once for all n outputs"""
+    ctx.client.server_supports_batched = True
+    pipe_cfg = [_llm_block("gen", "question", {"n": 2, "max_tokens": 10})]
+    [block] = (
+        Pipeline(ctx, "", pipe_cfg).estimate(fruits, tokenizer=_WordTokenizer()).blocks
+    )
+    assert block.llm_requests == 2
+    assert block.prompt_tokens == 20
+    assert block.max_completion_tokens == 100
+
+
+def test_estimate_llm_block_batched_counts_valid_rows(ctx):
+    """Rows that fail validation are not sent, so they add no batches"""
+    ctx.client.server_supports_batched = True
+    dataset = Dataset.from_dict(
+        {"fruit": ["apple", None, None, None, None, "pear", "plum", "fig"]}
+    )
+    [block] = (
+        Pipeline(ctx, "", [_llm_block("gen", "question")]).estimate(dataset).blocks
+    )
+    assert block.rows_in == 8
+    assert block.llm_requests == 1
+
+
+def test_estimate_skips_invalid_samples(ctx):
+    dataset = Dataset.from_dict({"vegetable": ["kale", "leek"]})
+    [block] = (
+        Pipeline(ctx, "", [_llm_block("gen", "question")]).estimate(dataset).blocks
+    )
+    assert block.rows_in == 2
+    assert block.rows_out == 0
+    assert block.llm_requests == 0
+    assert block.prompt_tokens == 0
+
+
+def test_estimate_propagates_fan_out_and_yields(ctx, fruits):
+    """Rows flow from block to block, fanned out by n, IterBlock and
+    FlattenColumnsBlock and reduced by the assumed filter yields
+    """
+    pipe_cfg = [
+        {
+            "name": "duplicate",
+            "type": "DuplicateColumnsBlock",
+            "config": {"columns_map": {"fruit": "first"}},
+        },
+        {
+            "name": "flatten",
+            "type": "FlattenColumnsBlock",
+            "config": {
+                "var_cols": ["first", "color"],
+                "value_name": "attribute",
+                "var_name": "source",
+            },
+        },
+        {
+            "name": "gen",
+            "type": "IterBlock",
+            "config": {
+                "num_iters": 3,
+                "block_type": "LLMBlock",
+                **_llm_block("gen", "judgment", {"n": 2})["config"],
+            },
+        },
+        _filter_block("filter", "judgment"),
+    ]
+    fruits = fruits.add_column("color", ["red"] * len(fruits))
+    estimate = Pipeline(ctx, "", pipe_cfg).estimate(
+        fruits, yields={"filter": 0.25, "gen": 0.5}
+    )
+    assert [block.rows_out for block in estimate.blocks] == [5, 10, 30, 7.5]
+    assert estimate.blocks[2].llm_requests == 60
+    assert estimate.blocks[3].assumed_yield == 0.25
+    assert estimate.rows_out == 7.5
+    assert estimate.llm_requests == 60
+
+
+def test_estimate_branches(ctx, fruits):
+    """Branches are totalled, and the AND-join keeps the product of their
+    yields
+    """
+    pipe_cfg = [
+        {
+            "name": "evaluate",
+            "branches": [
+                {
+                    "name": name,
+                    "blocks": [
+                        _llm_block(f"eval_{name}", name),
+                        _filter_block(f"filter_{name}", name),
+                    ],
+                }
+                for name in ("faithfulness", "relevancy")
+            ],
+        }
+    ]
+    estimate = Pipeline(ctx, "", pipe_cfg).estimate(
+        fruits, yields={"filter_faithfulness": 0.5, "filter_relevancy": 0.8}
+    )
+    [group] = estimate.blocks
+    assert group.block_type == "_BranchGroup"
+    assert [branch.rows_out for branch in group.children] == [2.5, 4]
+    assert group.rows_out == pytest.approx(2)
+    assert group.llm_requests == 10
+    assert "- - eval_relevancy" in estimate.format()
+
+
+def test_estimate_pilot_measures_yields(ctx):
+    """A pilot run really runs the blocks, so filters on real data are
+    measured instead of assumed
+    """
+    dataset = Dataset.from_dict({"score": [1, 0, 1, 0, 0, 0, 0, 0]})
+    estimate = Pipeline(ctx, "", [_filter_block("filter", "score")]).estimate(
+        dataset, yields={"filter": 0.9}, pilot_size=4
+    )
+    [block] = estimate.blocks
+    assert block.rows_in == 8
+    assert block.rows_out == 4
+    assert block.assumed_yield is None
+
+
+def test_estimate_stops_when_no_rows_are_left(ctx, fruits):
+    pipe_cfg = [_filter_block("filter", "fruit"), _llm_block("gen", "question")]
+    estimate = Pipeline(ctx, "", pipe_cfg).estimate(fruits, yields={"filter": 0})
+    assert [block.rows_in for block in estimate.blocks] == [5, 0]
+    assert estimate.llm_requests == 0
+
+
+def test_projected_runtime_and_to_dict():
+    estimate = PipelineEstimate(
+        "pipe",
+        10,
+        [
+            BlockEstimate(
+                "gen",
+                "LLMBlock",
+                10,
+                20,
+                llm_requests=10,
+                prompt_tokens=1000,
+                max_completion_tokens=2000,
+            )
+        ],
+    )
+    throughput = ServerThroughput(100, 50)
+    assert estimate.projected_runtime(throughput) == 50
+    saved = estimate.to_dict(throughput)
+    assert saved["rows_out"] == 20
+    assert saved["projected_runtime"] == 50
+    assert saved["blocks"][0]["prompt_tokens"] == 1000
+    assert "Projected LLM time" in estimate.format(throughput)
+
+
+def test_measure_throughput():
+    client = MagicMock()
+    client.completions.create.return_value.usage.prompt_tokens = 100
+    client.completions.create.return_value.usage.completion_tokens = 10
+    throughput = measure_throughput(client, "model", concurrency=2, num_requests=4)
+    assert client.completions.create.call_count == 8
+    assert throughput.prompt_tokens_per_second > 0
+    assert throughput.completion_tokens_per_second > 0
+
+
+def test_estimate_cli_needs_no_teacher(tmp_path):
+    """A dry run needs no teacher, so building the pipeline does not probe it"""
+    tmp_path.joinpath("prompt.yaml").write_text(
+        "system: '{{fruit}} is a fruit'\n"
+        "introduction: ''\nprinciples: ''\nexamples: ''\ngeneration: ''\n",
+        encoding="utf-8",
+    )
+    tmp_path.joinpath("pipeline.yaml").write_text(
+        "version: '1.0'\n"
+        "blocks:\n"
+        "  - name: gen\n"
+        "    type: LLMBlock\n"
+        "    config:\n"
+        "      config_path: prompt.yaml\n"
+        "      output_cols: [question]\n"
+        "      model_prompt: ''\n",
+        encoding="utf-8",
+    )
+    input_path = tmp_path.joinpath("input.jsonl")
+    input_path.write_text(
+        "".join(json.dumps({"fruit": fruit}) + "\n" for fruit in ["apple", "fig"]),
+        encoding="utf-8",
+    )
+    output_path = tmp_path.joinpath("output.jsonl")
+    with StubLLMServer() as server:
+        # The pipeline would fail on any request to the server
+        server.fail(400, count=100)
+        subprocess.check_call(
+            [
+                sys.executable,
+                "-m",
+                "instructlab.sdg.cli.run_pipeline",
+                "--pipeline",
+                str(tmp_path.joinpath("pipeline.yaml")),
+                "--input",
+                str(input_path),
+                "--output",
+                str(output_path),
+                "--endpoint-url",
+                server.base_url,
+                "--model-id",
+                "test-model",
+                "--estimate",
+            ],
+            text=True,
+        )
+    # Only measuring the throughput reaches the server, and its failure is
+    # not fatal; whether the server batches is never probed
+    assert ["test1", "test2"] not in [body["prompt"] for body in server.requests]
+    estimate = json.loads(
+        output_path.with_suffix(".estimate.json").read_text(encoding="utf-8")
+    )
+    [block] = estimate["blocks"]
+    assert block["llm_requests"] == 1
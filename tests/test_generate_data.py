@@ -12,6 +12,7 @@ import os
 import re
 import shutil
 import tempfile
+import threading
 import unittest
 
 # Third Party
@@ -24,9 +25,15 @@ from instructlab.sdg import LLMBlock, PipelineContext
 from instructlab.sdg.generate_data import (
     _context_init,
     _locate_docling_models,
+    _run_leaf_nodes,
     _sdg_init,
     generate_data,
+    generate_taxonomy,
+    preprocess_taxonomy,
 )
+from instructlab.sdg.leaf_cache import LeafNodeCache
+from instructlab.sdg.utils import GenerateException
+from instructlab.sdg.workqueue import WorkQueue
 
 # Local
 from .taxonomy import load_test_skills
@@ -355,6 +362,181 @@ class TestGenerateCompositionalData(unittest.TestCase):
             elif name.startswith("skills_train_msgs_"):
                 validate_mixed_dataset(matches[0])
 
+    def test_generate_overlap_phases(self):
+        """Overlapping the phases writes the same files as running them one
+        after the other
+        """
+        self.test_taxonomy.create_untracked(
+            os.path.join("compositional_skills", "new2", "qna.yaml"),
+            load_test_skills(
+                os.path.join(TEST_DATA_DIR, "test_valid_compositional_skill.yaml")
+            ),
+        )
+        # Neither depends on the order the file system lists leaf nodes in
+        list_files = glob.glob
+        with patch.object(
+            glob,
+            "glob",
+            lambda *args, **kwargs: list(reversed(list_files(*args, **kwargs))),
+        ):
+            sequential = self._generate_files(os.path.join(self.tmp_path, "sequential"))
+        overlapped = self._generate_files(
+            os.path.join(self.tmp_path, "overlapped"),
+            overlap_phases=True,
+            max_concurrent_leaf_nodes=2,
+        )
+        assert "generated_DATE/compositional_skills_new2.jsonl" in overlapped
+        assert overlapped == sequential
+
+    def test_generate_reuses_unchanged_leaf_nodes(self):
+        """A rerun with the same leaf node cache generates nothing again,
+        and writes the same files
+        """
+        cache_dir = os.path.join(self.tmp_path, "cache")
+        first = self._generate_files(
+            os.path.join(self.tmp_path, "first"), leaf_node_cache_dir=cache_dir
+        )
+        with patch.object(LLMBlock, "_generate") as llm_generate:
+            second = self._generate_files(
+                os.path.join(self.tmp_path, "second"), leaf_node_cache_dir=cache_dir
+            )
+        llm_generate.assert_not_called()
+        assert second == first
+
+    def test_generate_taxonomy_shards(self):
+        """Workers sharing a work queue generate the same files as one"""
+        self.test_taxonomy.create_untracked(
+            os.path.join("compositional_skills", "new2", "qna.yaml"),
+            load_test_skills(
+                os.path.join(TEST_DATA_DIR, "test_valid_compositional_skill.yaml")
+            ),
+        )
+        preprocessed_dir = os.path.join(self.tmp_path, "preprocessed")
+        os.makedirs(self.tmp_path, exist_ok=True)
+        preprocess_taxonomy(
+            self.test_taxonomy.root, preprocessed_dir, taxonomy_base=TEST_TAXONOMY_BASE
+        )
+
+        def generate(output_dir, **kwargs):
+            generate_taxonomy(
+                MagicMock(),
+                preprocessed_dir,
+                output_dir,
+                model_family="granite",
+                model_id="test-model",
+                num_instructions_to_generate=10,
+                console_output=False,
+                checkpoint_dir=os.path.join(output_dir, "checkpoints"),
+                **kwargs,
+            )
+
+        single_dir = os.path.join(self.tmp_path, "single")
+        generate(single_dir)
+        sharded_dir = os.path.join(self.tmp_path, "sharded")
+        workers = [
+            threading.Thread(
+                target=generate,
+                args=(sharded_dir,),
+                kwargs={
+                    "work_queue_dir": os.path.join(self.tmp_path, "queue"),
+                    "shard_size": 1,
+                },
+            )
+            for _ in range(2)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        for name in (
+            "compositional_skills_new.jsonl",
+            "compositional_skills_new2.jsonl",
+        ):
+            with open(os.path.join(single_dir, name), encoding="utf-8") as single:
+                with open(os.path.join(sharded_dir, name), encoding="utf-8") as sharded:
+                    assert sharded.read() == single.read()
+            checkpoint_dir = os.path.join(
+                sharded_dir, "checkpoints", name[: -len(".jsonl")]
+            )
+            assert os.listdir(checkpoint_dir)
+
+    def test_generate_taxonomy_shards_whole_batches(self):
+        """Shards are rounded up to whole batches, and still merge into
+        what a single host generates
+        """
+        preprocessed_dir = os.path.join(self.tmp_path, "preprocessed")
+        os.makedirs(self.tmp_path, exist_ok=True)
+        preprocess_taxonomy(
+            self.test_taxonomy.root, preprocessed_dir, taxonomy_base=TEST_TAXONOMY_BASE
+        )
+
+        def generate(output_dir, **kwargs):
+            generate_taxonomy(
+                MagicMock(),
+                preprocessed_dir,
+                output_dir,
+                model_family="granite",
+                model_id="test-model",
+                num_instructions_to_generate=10,
+                console_output=False,
+                batch_size=2,
+                **kwargs,
+            )
+
+        single_dir = os.path.join(self.tmp_path, "single")
+        generate(single_dir)
+        sharded_dir = os.path.join(self.tmp_path, "sharded")
+        queue_dir = os.path.join(self.tmp_path, "queue")
+        generate(sharded_dir, work_queue_dir=queue_dir, shard_size=3)
+
+        shards = WorkQueue(queue_dir).shards()
+        assert len(shards) > 1
+        assert all(shard.end - shard.start == 4 for shard in shards[:-1])
+        name = "compositional_skills_new.jsonl"
+        with open(os.path.join(single_dir, name), encoding="utf-8") as single:
+            with open(os.path.join(sharded_dir, name), encoding="utf-8") as sharded:
+                assert sharded.read() == single.read()
+
+        for kwargs in (
+            {"max_concurrent_leaf_nodes": 2},
+            {"leaf_node_cache": LeafNodeCache(os.path.join(self.tmp_path, "cache"))},
+        ):
+            with pytest.raises(GenerateException):
+                generate(sharded_dir, work_queue_dir=queue_dir, **kwargs)
+
+    def _generate_files(self, output_dir, **kwargs):
+        with patch("logging.Logger.info") as mocked_logger:
+            generate_data(
+                client=MagicMock(),
+                logger=mocked_logger,
+                model_family="granite",
+                model_name=os.path.join(
+                    TEST_DATA_DIR, "models/instructlab/granite-7b-lab"
+                ),
+                num_instructions_to_generate=10,
+                taxonomy=self.test_taxonomy.root,
+                taxonomy_base=TEST_TAXONOMY_BASE,
+                output_dir=output_dir,
+                pipeline="simple",
+                system_prompt=TEST_SYS_PROMPT,
+                **kwargs,
+            )
+        # The lines of every file written, with the date left out of names
+        # and contents, and random ids left out
+        date = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}_\d{2}_\d{2}")
+        uuid = re.compile(
+            r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
+        )
+        files = {}
+        for path in glob.glob(os.path.join(output_dir, "**", "*"), recursive=True):
+            if os.path.isfile(path):
+                name = date.sub("DATE", os.path.relpath(path, output_dir))
+                with open(path, encoding="utf-8") as f:
+                    content = uuid.sub("ID", date.sub("DATE", f.read()))
+                files[name] = content.splitlines()
+        return files
+
     def teardown(self) -> None:
         """Recursively remove the temporary repository and all of its
         subdirectories and files.
@@ -574,6 +756,46 @@ def test_context_init_batch_size_optional():
     assert ctx.batch_size == 20
 
 
+def test_run_leaf_nodes_concurrently():
+    """Test that leaf nodes run at the same time, sharing one batch executor"""
+    ctx = _context_init(
+        None, "mixtral", "foo.bar", 1, None, 1, batch_size=None, batch_num_workers=4
+    )
+    barrier = threading.Barrier(3, timeout=10)
+    executors = []
+
+    def run_leaf_node(input_file):
+        executors.append(ctx.batch_executor)
+        # Only returns once all three leaf nodes are running
+        barrier.wait()
+
+    _run_leaf_nodes(ctx, run_leaf_node, ["a", "b", "c"], 3)
+    assert len(executors) == 3
+    assert executors[0] is not None
+    assert all(executor is executors[0] for executor in executors)
+    assert ctx.batch_executor is None
+
+
+def test_run_leaf_nodes_stops_on_error():
+    """Test that the first error is raised, and later leaf nodes are skipped"""
+    ctx = _context_init(
+        None, "mixtral", "foo.bar", 1, None, 1, batch_size=None, batch_num_workers=4
+    )
+    started = []
+
+    def run_leaf_node(input_file):
+        started.append(input_file)
+        if input_file == "a":
+            raise ValueError(input_file)
+
+    with pytest.raises(ValueError):
+        _run_leaf_nodes(ctx, run_leaf_node, ["a", "b", "c"], 1)
+    assert started == ["a"]
+    with pytest.raises(ValueError):
+        _run_leaf_nodes(ctx, run_leaf_node, ["a"] + ["b"] * 50, 2)
+    assert ctx.batch_executor is None
+
+
 def test_locate_docling_models_config_found(testdata_path):
     with patch.dict(os.environ):
         os.environ["XDG_DATA_HOME"] = str(testdata_path.joinpath("mock_xdg_data_dir"))
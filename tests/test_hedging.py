@@ -0,0 +1,129 @@
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Unit tests for hedging slow LLM requests
+"""
+
+# Standard
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import time
+
+# Third Party
+import pytest
+
+# First Party
+from instructlab.sdg import ClientPool, HedgePolicy
+
+# Local
+from .stubserver import StubLLMServer
+
+REQUEST = {"model": "test-model", "prompt": "hi", "max_tokens": 1, "temperature": 0}
+KIND = HedgePolicy.request_kind(("completions",), REQUEST)
+
+
+def _warm_up(policy, latency=0.05, count=5):
+    for _ in range(count):
+        policy.record(KIND, latency)
+
+
+def test_hedge_delay_is_a_latency_percentile():
+    policy = HedgePolicy(percentile=90, min_samples=10)
+    for latency in range(1, 10):
+        policy.record(KIND, latency)
+    assert policy.delay(KIND) is None
+    policy.record(KIND, 10)
+    assert policy.delay(KIND) == 9
+    # Other kinds of requests have latencies of their own
+    assert policy.delay(HedgePolicy.request_kind(("completions",), {})) is None
+
+
+def test_hedges_are_capped():
+    policy = HedgePolicy(max_hedge_ratio=0.25, min_samples=1)
+    policy.record(KIND, 1)
+    hedged = []
+    for _ in range(8):
+        policy.delay(KIND)
+        hedged.append(policy.try_hedge())
+    assert hedged.count(True) == 2
+    assert policy.stats()["hedge_ratio"] == 0.25
+
+
+def test_only_greedy_requests_are_hedged():
+    policy = HedgePolicy()
+    assert policy.applies_to(REQUEST)
+    assert not policy.applies_to({**REQUEST, "temperature": 0.7})
+    assert not policy.applies_to({"prompt": "hi"})
+    assert not policy.applies_to({**REQUEST, "stream": True})
+    assert HedgePolicy(hedge_sampled=True).applies_to({"prompt": "hi"})
+
+
+@pytest.fixture
+def servers():
+    with StubLLMServer("slow", delay=1.0) as slow, StubLLMServer("fast") as fast:
+        yield slow, fast
+
+
+def _pool(servers, **kwargs):
+    kwargs.setdefault("min_samples", 5)
+    kwargs.setdefault("max_hedge_ratio", 1.0)
+    policy = HedgePolicy(**kwargs)
+    _warm_up(policy)
+    return ClientPool.from_urls(
+        [server.base_url for server in servers], hedge_policy=policy
+    )
+
+
+def test_slow_request_is_hedged(servers):
+    pool = _pool(servers)
+    start = time.monotonic()
+    response = pool.completions.create(**REQUEST)
+    assert time.monotonic() - start < 0.9
+    assert response.choices[0].text == "fast"
+    assert pool.hedge_policy.stats()["hedges"] == 1
+    assert pool.hedge_policy.stats()["hedge_wins"] == 1
+
+
+def test_hedge_budget_exhausted(servers):
+    pool = _pool(servers, max_hedge_ratio=0)
+    assert pool.completions.create(**REQUEST).choices[0].text == "slow"
+    assert pool.hedge_policy.stats()["hedges"] == 0
+
+
+def test_sampled_request_is_not_hedged(servers):
+    pool = _pool(servers)
+    response = pool.completions.create(**{**REQUEST, "temperature": 0.7})
+    assert response.choices[0].text == "slow"
+    assert pool.hedge_policy.stats()["requests"] == 0
+
+
+def test_async_hedge_cancels_the_slow_request(servers):
+    pool = _pool(servers)
+
+    async def create():
+        return await pool.async_pool().completions.create(**REQUEST)
+
+    start = time.monotonic()
+    response = asyncio.run(create())
+    assert time.monotonic() - start < 0.9
+    assert response.choices[0].text == "fast"
+    assert pool.hedge_policy.stats()["hedge_wins"] == 1
+    # The slow request was cancelled instead of waited for
+    assert [endpoint["outstanding"] for endpoint in pool.stats()] == [0, 0]
+
+
+def test_requests_are_not_capped_by_the_hedging_threads():
+    """More requests than hedging threads are all sent at once, and none of
+    them is hedged for waiting on a thread
+    """
+    with StubLLMServer("one", delay=0.3) as one, StubLLMServer("two", delay=0.3) as two:
+        pool = _pool((one, two), max_workers=1)
+        _warm_up(pool.hedge_policy, latency=1.0, count=20)
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            responses = list(
+                executor.map(lambda _: pool.completions.create(**REQUEST), range(6))
+            )
+        assert time.monotonic() - start < 0.9
+    assert len(responses) == 6
+    assert pool.hedge_policy.stats()["hedges"] == 0
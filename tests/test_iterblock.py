@@ -37,6 +37,7 @@ class TestIterBlock(unittest.TestCase):
     def setUp(self):
         self.ctx = MagicMock()
         self.ctx.dataset_num_procs = 1
+        self.ctx.spill_dataset.side_effect = lambda dataset: dataset
         self.pipe = MagicMock()
         self.block = IterBlock(
             self.ctx,
@@ -0,0 +1,114 @@
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Unit tests for the cache of what generate_data produces from each leaf node
+"""
+
+# Standard
+from types import SimpleNamespace
+
+# First Party
+from instructlab.sdg.leaf_cache import LeafNodeCache, pipeline_fingerprint
+
+# Local
+from .conftest import get_ctx
+
+
+def _pipe(tmp_path):
+    (tmp_path / "gen.yaml").write_text("introduction: Write a question\n")
+    (tmp_path / "pipeline.yaml").write_text("version: '1.0'\nblocks: []\n")
+    return SimpleNamespace(
+        ctx=get_ctx(),
+        config_path=str(tmp_path / "pipeline.yaml"),
+        chained_blocks=[
+            {
+                "name": "gen",
+                "type": "LLMBlock",
+                "config": {"config_path": "gen.yaml", "output_cols": ["output"]},
+            }
+        ],
+    )
+
+
+def test_put_and_get(tmp_path):
+    cache = LeafNodeCache(str(tmp_path / "cache"))
+    data_file = tmp_path / "data.jsonl"
+    data_file.write_text('{"a": 1}\n')
+    key = cache.key("generate", "some input")
+    assert cache.get("generated", key) is None
+    cache.put("generated", key, str(data_file))
+    with open(cache.get("generated", key), encoding="utf-8") as f:
+        assert f.read() == '{"a": 1}\n'
+    # Kinds do not share entries
+    assert cache.get("eval", key) is None
+    assert cache.stats() == {
+        "eval": {"hits": 0, "misses": 1},
+        "generated": {"hits": 1, "misses": 1},
+    }
+
+
+def test_put_nothing(tmp_path):
+    """An empty entry records that nothing was generated"""
+    cache = LeafNodeCache(str(tmp_path))
+    cache.put("generated", "ab12", None)
+    path = cache.get("generated", "ab12")
+    assert path is not None
+    assert (tmp_path / "generated" / "ab" / "ab12.jsonl").stat().st_size == 0
+
+
+def test_keys_are_stable():
+    assert LeafNodeCache.key({"b": 1, "a": [2]}) == LeafNodeCache.key(
+        {"a": [2], "b": 1}
+    )
+    assert LeafNodeCache.key("a", "b") != LeafNodeCache.key("ab")
+
+
+def test_preprocess_key_covers_documents(tmp_path):
+    cache = LeafNodeCache(str(tmp_path / "cache"))
+    document = tmp_path / "doc.md"
+    document.write_text("# Apples\n")
+    leaf_node = [
+        {
+            "taxonomy_path": "knowledge->fruit",
+            "filepaths": [document],
+            "questions_and_answers": [{"question": "Red?", "answer": "Yes"}],
+        }
+    ]
+    key = cache.preprocess_key(leaf_node, 4096, 1000, "teacher", None)
+    # The clone the document was read from does not matter
+    moved = tmp_path / "moved.md"
+    moved.write_text("# Apples\n")
+    leaf_node[0]["filepaths"] = [moved]
+    assert cache.preprocess_key(leaf_node, 4096, 1000, "teacher", None) == key
+    # Its contents, the seed examples and the chunking settings do
+    moved.write_text("# Pears\n")
+    changed = cache.preprocess_key(leaf_node, 4096, 1000, "teacher", None)
+    assert changed != key
+    assert cache.preprocess_key(leaf_node, 4096, 500, "teacher", None) != changed
+    leaf_node[0]["questions_and_answers"][0]["answer"] = "No"
+    assert cache.preprocess_key(leaf_node, 4096, 1000, "teacher", None) != changed
+
+
+def test_pipeline_key_covers_configs_and_model(tmp_path):
+    cache = LeafNodeCache(str(tmp_path / "cache"))
+    samples = tmp_path / "samples.jsonl"
+    samples.write_text('{"seed_question": "Why?"}\n')
+    pipe = _pipe(tmp_path)
+    key = cache.pipeline_key(pipe, str(samples))
+    fingerprint = pipeline_fingerprint(pipe)
+    assert cache.pipeline_key(_pipe(tmp_path), str(samples)) == key
+
+    # A changed block config changes the pipeline
+    (tmp_path / "gen.yaml").write_text("introduction: Write two questions\n")
+    assert pipeline_fingerprint(pipe) != fingerprint
+    assert cache.pipeline_key(pipe, str(samples)) != key
+
+    # As does another teacher model
+    other = SimpleNamespace(
+        ctx=get_ctx(model_id="other-model"),
+        config_path=pipe.config_path,
+        chained_blocks=pipe.chained_blocks,
+    )
+    assert cache.pipeline_key(other, str(samples)) != cache.pipeline_key(
+        pipe, str(samples)
+    )
@@ -1,16 +1,21 @@
 # SPDX-License-Identifier: Apache-2.0
 
 # Standard
+from concurrent.futures import ProcessPoolExecutor
 from importlib import resources
 from unittest.mock import MagicMock, patch
+import asyncio
+import multiprocessing
 import os
+import threading
+import time
 import unittest
 
 # Third Party
 from datasets import Dataset, Features, Value
 from httpx import URL
 from jinja2 import StrictUndefined, Template, UndefinedError
-from openai import InternalServerError, NotFoundError
+from openai import InternalServerError, NotFoundError, OpenAI
 import pytest
 
 # First Party
@@ -22,6 +27,8 @@ from src.instructlab.sdg import (
     LLMMessagesBlock,
 )
 from src.instructlab.sdg.blocks.llmblock import server_supports_batched
+from src.instructlab.sdg.pipeline import PipelineContext
+from src.instructlab.sdg.response_cache import SQLiteResponseCache
 from src.instructlab.sdg.utils import models
 
 
@@ -203,6 +210,49 @@ class TestLLMBlockOtherFunctions(unittest.TestCase):
         assert not block._validate(block.prompt_template, {})
         assert block._validate(block.prompt_template, {"var1": "foo", "var2": "bar"})
 
+    def test_valid_samples(self, mock_load_config):
+        mock_load_config.return_value = {
+            **self.config_return_value,
+            "system": "{{var1}} {{var2}}",
+        }
+        block = LLMBlock(
+            ctx=self.mock_ctx,
+            pipe=self.mock_pipe,
+            block_name="gen_knowledge",
+            config_path="",
+            output_cols=[],
+        )
+        samples = Dataset.from_dict(
+            {"var1": ["a", None, "c"], "var2": ["x", "y", "z"]}
+        ).select([2, 1, 0])
+        # Validating checks the columns without rendering any prompt
+        with patch.object(
+            type(block.prompt_template), "render", side_effect=AssertionError
+        ):
+            valid_samples = block._valid_samples(samples)
+        assert valid_samples == [
+            {"var1": "c", "var2": "z"},
+            {"var1": "a", "var2": "x"},
+        ]
+        assert block._valid_samples(samples.remove_columns("var2")) == []
+
+    def test_model_prompt_compiled_once(self, mock_load_config):
+        mock_load_config.return_value = self.config_return_value
+        block = LLMBlock(
+            ctx=self.mock_ctx,
+            pipe=self.mock_pipe,
+            block_name="gen_knowledge",
+            config_path="",
+            output_cols=[],
+            model_prompt="<<{{prompt}}>>",
+        )
+        with patch(
+            "src.instructlab.sdg.registry.PromptRegistry.template_from_string"
+        ) as template_from_string:
+            prompts = block._format_prompts([{"fruit": "apple"}, {"fruit": "pear"}])
+        template_from_string.assert_not_called()
+        assert prompts[1] == "<<pear\nintroduction\nprinciples\nexamples\ngeneration>>"
+
     def test_n_scaled_with_num_instructions(self, mock_load_config):
         mock_load_config.return_value = {
             "system": "{{fruit}}",
@@ -410,6 +460,438 @@ class TestLLMBlockBatching(unittest.TestCase):
         assert supports_batched
 
 
+@patch("src.instructlab.sdg.blocks.block.Block._load_config")
+class TestLLMBlockAsync(unittest.TestCase):
+    def setUp(self):
+        self.mock_client = MagicMock()
+        self.mock_client.server_supports_batched = False
+        self.ctx = PipelineContext(
+            client=self.mock_client,
+            model_family="mixtral",
+            model_id="test_model",
+            max_concurrent_requests=2,
+        )
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+        async def create(prompt, **kwargs):
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            await asyncio.sleep(0.01)
+            self.in_flight -= 1
+            choice = MagicMock()
+            choice.text = prompt
+            response = MagicMock()
+            response.choices = [choice]
+            return response
+
+        self.ctx.async_client = MagicMock()
+        self.ctx.async_client.completions.create = create
+        self.dataset = Dataset.from_dict(
+            {"fruit": ["apple", "pear", "mango", "kiwi", "plum"]},
+            features=Features({"fruit": Value("string")}),
+        )
+
+    def test_agenerate_caps_in_flight_requests(self, mock_load_config):
+        mock_load_config.return_value = {
+            "system": "{{fruit}}",
+            "introduction": "",
+            "principles": "",
+            "examples": "",
+            "generation": "",
+            "start_tags": [""],
+            "end_tags": [""],
+        }
+        block = LLMBlock(
+            ctx=self.ctx,
+            pipe=MagicMock(),
+            block_name="test_block",
+            config_path="",
+            output_cols=["output"],
+            model_prompt="",
+            gen_kwargs={"n": 2},
+        )
+        output = asyncio.run(block.agenerate(self.dataset))
+        assert self.max_in_flight == 2
+        # Outputs stay lined up with their inputs despite running concurrently
+        assert output["fruit"] == [f for f in self.dataset["fruit"] for _ in range(2)]
+        assert output["fruit"] == output["output"]
+
+    def test_agenerate_caps_block_requests(self, mock_load_config):
+        mock_load_config.return_value = {
+            "system": "{{fruit}}",
+            "introduction": "",
+            "principles": "",
+            "examples": "",
+            "generation": "",
+            "start_tags": [""],
+            "end_tags": [""],
+        }
+        block = LLMBlock(
+            ctx=self.ctx,
+            pipe=MagicMock(),
+            block_name="test_block",
+            config_path="",
+            output_cols=["output"],
+            model_prompt="",
+            max_concurrency=1,
+        )
+        output = asyncio.run(block.agenerate(self.dataset))
+        assert self.max_in_flight == 1
+        assert output["fruit"] == output["output"]
+
+
+class _InFlight:
+    """Counts the requests in flight at once, sleeping longer on the earlier
+    ones so they finish out of order
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.calls = 0
+
+    def __enter__(self):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            self.calls += 1
+            delay = 0.05 / self.calls
+        time.sleep(delay)
+
+    def __exit__(self, *args):
+        with self.lock:
+            self.in_flight -= 1
+
+
+@patch("src.instructlab.sdg.blocks.block.Block._load_config")
+class TestLLMBlockMaxConcurrency(unittest.TestCase):
+    def setUp(self):
+        self.ctx = MagicMock()
+        self.ctx.model_family = "mixtral"
+        self.ctx.model_id = "test_model"
+        self.ctx.max_num_tokens = 4096
+        self.ctx.client.server_supports_batched = False
+        self.requests = _InFlight()
+
+        def create(prompt, **kwargs):
+            with self.requests:
+                choice = MagicMock()
+                choice.text = prompt
+                response = MagicMock()
+                response.choices = [choice]
+                return response
+
+        self.ctx.client.completions.create = create
+        self.dataset = Dataset.from_dict(
+            {"fruit": ["apple", "pear", "mango", "kiwi", "plum"]},
+            features=Features({"fruit": Value("string")}),
+        )
+        self.config_return_value = {
+            "system": "{{fruit}}",
+            "introduction": "",
+            "principles": "",
+            "examples": "",
+            "generation": "",
+            "start_tags": [""],
+            "end_tags": [""],
+        }
+
+    def _block(self, max_concurrency):
+        return LLMBlock(
+            ctx=self.ctx,
+            pipe=MagicMock(),
+            block_name="test_block",
+            config_path="",
+            output_cols=["output"],
+            model_prompt="",
+            gen_kwargs={"n": 2},
+            max_concurrency=max_concurrency,
+        )
+
+    def test_sequential_by_default(self, mock_load_config):
+        mock_load_config.return_value = self.config_return_value
+        output = self._block(None).generate(self.dataset)
+        assert self.requests.max_in_flight == 1
+        assert output["fruit"] == output["output"]
+
+    def test_generate_caps_in_flight_requests(self, mock_load_config):
+        mock_load_config.return_value = self.config_return_value
+        output = self._block(3).generate(self.dataset)
+        assert self.requests.calls == 10
+        assert self.requests.max_in_flight == 3
+        # Outputs stay lined up with their inputs despite running concurrently
+        assert output["fruit"] == [f for f in self.dataset["fruit"] for _ in range(2)]
+        assert output["fruit"] == output["output"]
+
+    def test_invalid_max_concurrency(self, mock_load_config):
+        mock_load_config.return_value = self.config_return_value
+        with pytest.raises(BlockConfigParserError):
+            self._block(0)
+
+
+def _chunk(index, text):
+    choice = MagicMock()
+    choice.index = index
+    choice.text = text
+    chunk = MagicMock()
+    chunk.choices = [choice]
+    return chunk
+
+
+class _Stream:
+    """A streamed response, counting the chunks read before it was closed"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.read = 0
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.read += 1
+            yield chunk
+
+    async def __aiter__(self):
+        for chunk in self:
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+class _AsyncStream(_Stream):
+    async def close(self):  # pylint: disable=invalid-overridden-method
+        self.closed = True
+
+
+@patch("src.instructlab.sdg.blocks.block.Block._load_config")
+class TestLLMBlockStreaming(unittest.TestCase):
+    def setUp(self):
+        self.ctx = MagicMock()
+        self.ctx.model_family = "mixtral"
+        self.ctx.model_id = "test_model"
+        self.ctx.max_num_tokens = 4096
+        self.ctx.client.server_supports_batched = True
+        self.config_return_value = {
+            "system": "{{fruit}}",
+            "introduction": "",
+            "principles": "",
+            "examples": "",
+            "generation": "",
+            "start_tags": ["[Q]"],
+            "end_tags": ["[/Q]"],
+            "one_value_per_column": True,
+        }
+        self.dataset = Dataset.from_dict({"fruit": ["apple", "pear"]})
+
+    def _block(self, **kwargs):
+        return LLMBlock(
+            ctx=self.ctx,
+            pipe=MagicMock(),
+            block_name="test_block",
+            config_path="",
+            output_cols=["question"],
+            model_prompt="",
+            stream_completions=True,
+            **kwargs,
+        )
+
+    def _chunks(self):
+        return [
+            _chunk(0, "[Q] Red"),
+            _chunk(1, "[Q] Green?"),
+            _chunk(0, "?[/"),
+            _chunk(1, " [/Q]"),
+            _chunk(0, "Q] and then"),
+            _chunk(0, " some rambling"),
+        ]
+
+    def test_stream_stops_once_complete(self, mock_load_config):
+        mock_load_config.return_value = self.config_return_value
+        stream = _Stream(self._chunks())
+        self.ctx.client.completions.create.return_value = stream
+        output = self._block().generate(self.dataset)
+        assert output["question"] == ["Red?", "Green?"]
+        assert self.ctx.client.completions.create.call_args.kwargs["stream"]
+        assert stream.read == 5
+        assert stream.closed
+
+    def test_astream_stops_once_complete(self, mock_load_config):
+        mock_load_config.return_value = self.config_return_value
+        stream = _AsyncStream(self._chunks())
+
+        async def create(**kwargs):
+            assert kwargs["stream"]
+            return stream
+
+        self.ctx.get_async_client.return_value.completions.create = create
+        self.ctx.request_semaphore = asyncio.Semaphore
+        output = asyncio.run(self._block().agenerate(self.dataset))
+        assert output["question"] == ["Red?", "Green?"]
+        assert stream.read == 5
+        assert stream.closed
+
+    def test_not_streamed_with_several_values(self, mock_load_config):
+        """Blocks that may get several values for a column are not cut short"""
+        mock_load_config.return_value = {
+            **self.config_return_value,
+            "one_value_per_column": False,
+        }
+        block = self._block()
+        assert not block.stream_completions
+        self.ctx.client.completions.create.return_value.choices = [
+            MagicMock(text="[Q] Red?[/Q] [Q] Ripe?[/Q]"),
+            MagicMock(text="[Q] Green?[/Q]"),
+        ]
+        output = block.generate(self.dataset)
+        assert output["question"] == ["Red?", "Ripe?", "Green?"]
+        assert "stream" not in self.ctx.client.completions.create.call_args.kwargs
+
+    def test_not_streamed_without_end_tags(self, mock_load_config):
+        mock_load_config.return_value = {
+            **self.config_return_value,
+            "start_tags": [""],
+            "end_tags": [""],
+        }
+        assert not self._block().stream_completions
+
+
+class TestLLMBlockProcessExecutor(unittest.TestCase):
+    def setUp(self):
+        client = OpenAI(api_key="EMPTY", base_url="http://localhost:8000/v1")
+        client.server_supports_batched = True
+        self.response = MagicMock()
+        self.response.choices = [
+            MagicMock(text=f"<q>{fruit}?</q>") for fruit in ("apple", "pear")
+        ]
+        client.completions.create = MagicMock(return_value=self.response)
+        self.executor = ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        )
+        self.ctx = PipelineContext(
+            client=client,
+            model_family="mixtral",
+            model_id="test_model",
+            cpu_executor=self.executor,
+        )
+        self.dataset = Dataset.from_dict({"fruit": ["apple", "pear"]})
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    @patch("src.instructlab.sdg.blocks.block.Block._load_config")
+    def test_generate_renders_and_parses_in_worker_process(self, mock_load_config):
+        mock_load_config.return_value = {
+            "system": "{{fruit}}",
+            "introduction": "",
+            "principles": "",
+            "examples": "",
+            "generation": "",
+            "start_tags": ["<q>"],
+            "end_tags": ["</q>"],
+        }
+        block = LLMBlock(
+            ctx=self.ctx,
+            pipe=None,
+            block_name="test_block",
+            config_path="",
+            output_cols=["question"],
+            model_prompt="",
+        )
+        output = block.generate(self.dataset)
+        self.ctx.client.completions.create.assert_called_once()
+        assert self.ctx.client.completions.create.call_args.kwargs["prompt"] == [
+            "apple",
+            "pear",
+        ]
+        assert output.to_list() == [
+            {"fruit": "apple", "question": "apple?"},
+            {"fruit": "pear", "question": "pear?"},
+        ]
+
+
+@patch("src.instructlab.sdg.blocks.block.Block._load_config")
+class TestLLMBlockResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.mock_client = MagicMock()
+        self.mock_client.server_supports_batched = True
+        self.mock_client.completions.create.side_effect = lambda prompt, **kwargs: (
+            MagicMock(choices=[MagicMock(text=f"<q>{p}?</q>") for p in prompt])
+        )
+        self.ctx = PipelineContext(
+            client=self.mock_client,
+            model_family="mixtral",
+            model_id="test_model",
+            response_cache=SQLiteResponseCache(":memory:"),
+        )
+        self.config = {
+            "system": "{{fruit}}",
+            "introduction": "",
+            "principles": "",
+            "examples": "",
+            "generation": "",
+            "start_tags": ["<q>"],
+            "end_tags": ["</q>"],
+        }
+
+    def _block(self, **gen_kwargs):
+        return LLMBlock(
+            ctx=self.ctx,
+            pipe=None,
+            block_name="test_block",
+            config_path="",
+            output_cols=["question"],
+            model_prompt="",
+            gen_kwargs=gen_kwargs,
+        )
+
+    def test_only_uncached_prompts_are_sent(self, mock_load_config):
+        mock_load_config.return_value = self.config
+        block = self._block()
+        first = block.generate(Dataset.from_dict({"fruit": ["apple", "pear"]}))
+        output = block.generate(Dataset.from_dict({"fruit": ["pear", "plum"]}))
+        create = self.mock_client.completions.create
+        assert [c.kwargs["prompt"] for c in create.call_args_list] == [
+            ["apple", "pear"],
+            ["plum"],
+        ]
+        assert first["question"] == ["apple?", "pear?"]
+        assert output["question"] == ["pear?", "plum?"]
+        assert self.ctx.response_cache.stats()["hits"] == 1
+
+        # Nothing is sent once every prompt is cached
+        asyncio.run(block.agenerate(Dataset.from_dict({"fruit": ["apple"]})))
+        assert create.call_count == 2
+
+    def test_sampled_prompts_are_sent_again(self, mock_load_config):
+        mock_load_config.return_value = self.config
+        block = self._block(temperature=0.7)
+        dataset = Dataset.from_dict({"fruit": ["apple"]})
+        block.generate(dataset)
+        block.generate(dataset)
+        assert self.mock_client.completions.create.call_count == 2
+        assert self.ctx.response_cache.stats()["uncached"] == 2
+
+    def test_n_completions_per_prompt(self, mock_load_config):
+        mock_load_config.return_value = self.config
+        self.mock_client.server_supports_batched = False
+        counter = iter(range(100))
+        self.mock_client.completions.create.side_effect = lambda prompt, **kwargs: (
+            MagicMock(choices=[MagicMock(text=f"<q>{prompt}{next(counter)}</q>")])
+        )
+        self.ctx.response_cache.reuse_sampled = True
+        block = self._block(n=2, temperature=0.7)
+        dataset = Dataset.from_dict({"fruit": ["apple", "pear"]})
+        first = block.generate(dataset)
+        assert first["question"] == ["apple0", "apple1", "pear2", "pear3"]
+        # A sampled rerun gets the same completions back, in the same order
+        self.ctx.response_cache._occurrences.clear()
+        assert block.generate(dataset)["question"] == first["question"]
+        assert self.mock_client.completions.create.call_count == 4
+
+
 @patch("src.instructlab.sdg.blocks.block.Block._load_config")
 class TestConditionalLLMBlock(unittest.TestCase):
     def setUp(self):
@@ -466,6 +948,37 @@ class TestConditionalLLMBlock(unittest.TestCase):
             block.prompt_template, {"selector": "_A_", "var1": "foo", "var2": "bar"}
         )
 
+    def test_valid_samples(self, mock_load_config):
+        config = {
+            "introduction": "introduction",
+            "principles": "principles",
+            "examples": "examples",
+            "generation": "generation",
+        }
+        mock_load_config.side_effect = [
+            {**config, "system": "{{var1}}"},
+            {**config, "system": "{{var1}}"},
+            {**config, "system": "{{var2}}"},
+        ]
+        block = ConditionalLLMBlock(
+            ctx=self.mock_ctx,
+            pipe=self.mock_pipe,
+            block_name="gen_knowledge",
+            config_paths=[["/foo/a", "_A_"], ["/foo/b", "_B_"]],
+            output_cols=[],
+            selector_column_name="selector",
+        )
+        samples = Dataset.from_dict(
+            {
+                "selector": ["_A_", "_B_", "_C_", "_B_", "_A_"],
+                "var1": ["a", "b", "c", "d", None],
+                "var2": [None, "w", "x", None, "z"],
+            }
+        )
+        # Each row only needs the variables of its own template
+        assert [s["var1"] for s in block._valid_samples(samples)] == ["a", "b"]
+        assert block._valid_samples(samples.remove_columns("selector")) == []
+
     def test_format_prompt_with_jinja_templates(self, mock_load_config):
         mock_load_config.return_value = {
             "system": "{{var1}} {{var2}}",
@@ -639,6 +1152,99 @@ class TestLLMMessagesBlock(unittest.TestCase):
         mock_completion.create.assert_called()
         assert mock_completion.create.call_args.kwargs["messages"] == "my message"
 
+    def test_calls_async_chat_completion_api(self):
+        ctx = PipelineContext(
+            client=MagicMock(),
+            model_id="test_model",
+            max_concurrent_requests=1,
+        )
+        messages_seen = []
+
+        async def create(messages, **kwargs):
+            messages_seen.append(messages)
+            choice = MagicMock()
+            choice.message.content = f"response to {messages}"
+            response = MagicMock()
+            response.choices = [choice]
+            return response
+
+        ctx.async_client = MagicMock()
+        ctx.async_client.chat.completions.create = create
+        block = LLMMessagesBlock(
+            ctx=ctx,
+            pipe=self.mock_pipe,
+            block_name="gen_knowledge",
+            input_col="messages",
+            output_col="output",
+        )
+        samples = Dataset.from_dict(
+            {"messages": ["first", "second"]},
+            features=Features({"messages": Value("string")}),
+        )
+        output = asyncio.run(block.agenerate(samples))
+        assert messages_seen == ["first", "second"]
+        assert output["output"] == ["response to first", "response to second"]
+
+    def test_max_concurrency(self):
+        requests = _InFlight()
+
+        def create(messages, **kwargs):
+            with requests:
+                choice = MagicMock()
+                choice.message.content = f"response to {messages}"
+                response = MagicMock()
+                response.choices = [choice]
+                return response
+
+        self.mock_client.chat.completions.create = create
+        block = LLMMessagesBlock(
+            ctx=self.mock_ctx,
+            pipe=self.mock_pipe,
+            block_name="gen_knowledge",
+            input_col="messages",
+            output_col="output",
+            max_concurrency=2,
+        )
+        messages = [f"message {i}" for i in range(6)]
+        samples = Dataset.from_dict(
+            {"messages": messages},
+            features=Features({"messages": Value("string")}),
+        )
+        output = block.generate(samples)
+        assert requests.max_in_flight == 2
+        assert output["output"] == [f"response to {m}" for m in messages]
+
+    def test_cached_chat_completions(self):
+        ctx = PipelineContext(
+            client=MagicMock(),
+            model_id="test_model",
+            response_cache=SQLiteResponseCache(":memory:"),
+        )
+        ctx.client.chat.completions.create.side_effect = lambda messages, **kwargs: (
+            MagicMock(
+                choices=[
+                    MagicMock(message=MagicMock(content=f"{messages} {i}"))
+                    for i in range(kwargs["n"])
+                ]
+            )
+        )
+        block = LLMMessagesBlock(
+            ctx=ctx,
+            pipe=self.mock_pipe,
+            block_name="gen_knowledge",
+            input_col="messages",
+            output_col="output",
+            gen_kwargs={"n": 2, "temperature": 0},
+        )
+        # n > 1 makes the block sample, which is only cached with opt-in
+        ctx.response_cache.reuse_sampled = True
+        samples = Dataset.from_dict({"messages": ["first", "second"]})
+        output = block.generate(samples)
+        assert output["output"] == [["first 0", "first 1"], ["second 0", "second 1"]]
+        ctx.response_cache._occurrences.clear()
+        assert block.generate(samples)["output"] == output["output"]
+        assert ctx.client.chat.completions.create.call_count == 2
+
     def test_resolve_model_id(self):
         # save state for future tests
         old_model_id = self.mock_ctx.model_id
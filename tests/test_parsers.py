@@ -0,0 +1,167 @@
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Unit tests for the parsers of LLM block outputs
+"""
+
+# Standard
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, patch
+import pickle
+
+# Third Party
+from datasets import Dataset
+import pytest
+
+# First Party
+from instructlab.sdg import BlockConfigParserError, LLMBlock
+from instructlab.sdg.blocks import llmblock
+from instructlab.sdg.blocks.parsers import (
+    OutputParser,
+    ParseStats,
+    RegexParser,
+    StreamedOutputs,
+    TagParser,
+    parser_from_config,
+)
+
+
+def test_tag_parser():
+    parser = TagParser(["<q>", ""], ["</q>", ""], ["question", "output"])
+    assert parser.parse_all(["<q> a </q><q>b</q>", "none", ""]) == [
+        {"question": ["a", "b"], "output": ["<q> a </q><q>b</q>"]},
+        {"question": [], "output": ["none"]},
+        {"question": [], "output": [None]},
+    ]
+
+
+def test_regex_parser():
+    parser = RegexParser(
+        r"\[Q\](.*?)\[A\](.*?)(?=\[Q\]|$)", ["question", "answer"], ["[END]"]
+    )
+    assert parser.parse("[Q] one [A] 1[END] [Q] two [A] 2") == {
+        "question": ["one", "two"],
+        "answer": ["1", "2"],
+    }
+    parser = RegexParser(r"\d+", ["number", "other"])
+    assert parser.parse("1 and 22") == {"number": ["1", "22"], "other": []}
+
+
+def test_parser_from_config():
+    config = {"start_tags": ["<q>"], "end_tags": ["</q>"]}
+    assert isinstance(parser_from_config("b", config, ["q"], {}), TagParser)
+    parser = parser_from_config(
+        "b", config, ["q"], {"parser_name": "custom", "parsing_pattern": "(.*)"}
+    )
+    assert isinstance(parser, RegexParser)
+    with pytest.raises(BlockConfigParserError):
+        parser_from_config("b", config, ["q"], {"parser_name": "custom"})
+
+
+def test_tag_parser_is_complete():
+    parser = TagParser(["<e>", "<s>"], ["</e>", "</s>"], ["evaluation", "score"], True)
+    assert parser.end_tags == ("</e>", "</s>")
+    assert not parser.is_complete("<e>fine</e><s>")
+    assert parser.is_complete("<s>3</s> and <e>fine</e>")
+    # Without tags a column takes the whole completion, which is never done
+    assert not TagParser([""], [""], ["output"]).end_tags
+    assert not RegexParser(r"(.*)", ["output"]).end_tags
+
+
+def test_tag_parser_several_values_never_complete():
+    """A completion may have several values for a column unless the config
+    says otherwise, so the first pair does not complete it
+    """
+    config = {"start_tags": ["<q>", "<a>"], "end_tags": ["</q>", "</a>"]}
+    parser = parser_from_config("b", config, ["question", "answer"], {})
+    assert not parser.end_tags
+    output = "<q>one</q><a>1</a><q>two</q><a>2</a>"
+    outputs = StreamedOutputs(parser, 1)
+    assert not outputs.add(0, output[:20])
+    assert not outputs.add(0, output[20:])
+    assert parser.parse(outputs.texts[0]) == {
+        "question": ["one", "two"],
+        "answer": ["1", "2"],
+    }
+    config["one_value_per_column"] = True
+    parser = parser_from_config("b", config, ["question", "answer"], {})
+    assert parser.end_tags == ("</q>", "</a>")
+
+
+def test_streamed_outputs():
+    parser = TagParser(["<e>", "<s>"], ["</e>", "</s>"], ["evaluation", "score"], True)
+    outputs = StreamedOutputs(parser, 2)
+    assert not outputs.add(0, "<e>fine</e><s>3</")
+    assert not outputs.add(1, "<s>1</s>")
+    # The end tag may be split between deltas, and what follows it is cut
+    assert not outputs.add(0, "s> and more")
+    assert not outputs.add(0, "ignored")
+    assert not outputs.add(2, "<e>no such completion</e>")
+    assert outputs.add(1, "<e>bad</e><e>")
+    assert outputs.texts == ["<e>fine</e><s>3</s>", "<s>1</s><e>bad</e>"]
+
+
+def test_output_parser_needs_parse():
+    with pytest.raises(TypeError):
+        OutputParser()  # pylint: disable=abstract-class-instantiated
+
+
+def test_parse_stats_pickle():
+    stats = ParseStats()
+    stats.record(3, 1)
+    stats = pickle.loads(pickle.dumps(stats))
+    stats.record(2, 0)
+    assert stats.as_dict() == {"outputs": 5, "unparseable": 1}
+
+
+@patch("instructlab.sdg.blocks.block.Block._load_config")
+def test_llmblock_parses_large_outputs_in_chunks(mock_load_config, monkeypatch):
+    mock_load_config.return_value = {
+        "system": "{{fruit}}",
+        "introduction": "",
+        "principles": "",
+        "examples": "",
+        "generation": "",
+        "start_tags": ["<q>"],
+        "end_tags": ["</q>"],
+    }
+    monkeypatch.setattr(llmblock, "PARALLEL_PARSE_MIN_CHARS", 10)
+    monkeypatch.setattr(llmblock, "PARSE_CHUNK_CHARS", 20)
+    fruits = [f"fruit{i}" for i in range(10)]
+    ctx = MagicMock()
+    ctx.model_id = "test_model"
+    ctx.model_family = "mixtral"
+    ctx.max_num_tokens = 4096
+    ctx.client.server_supports_batched = True
+    ctx.client.completions.create.return_value.choices = [
+        MagicMock(text="no tags" if i % 3 == 0 else f"<q>{fruit}?</q>")
+        for i, fruit in enumerate(fruits)
+    ]
+    ctx.cpu_executor = ThreadPoolExecutor(2)
+    block = LLMBlock(
+        ctx=ctx,
+        pipe=None,
+        block_name="test_block",
+        config_path="",
+        output_cols=["question"],
+        model_prompt="",
+    )
+    submit = MagicMock(wraps=ctx.cpu_executor.submit)
+    monkeypatch.setattr(ctx.cpu_executor, "submit", submit)
+    try:
+        output = block.generate(Dataset.from_dict({"fruit": fruits}))
+    finally:
+        ctx.cpu_executor.shutdown()
+
+    parse_calls = [
+        call
+        for call in submit.call_args_list
+        if call.args[0].__name__ == "_parse_outputs"
+    ]
+    assert len(parse_calls) > 1
+    # The chunks are joined back in order
+    assert output["question"] == [
+        f"{fruit}?" for i, fruit in enumerate(fruits) if i % 3 != 0
+    ]
+    assert output["fruit"] == [fruit for i, fruit in enumerate(fruits) if i % 3 != 0]
+    assert block.parse_stats.as_dict() == {"outputs": 10, "unparseable": 4}
@@ -5,16 +5,35 @@ Unit tests for common Pipeline functionality
 """
 
 # Standard
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from threading import Event
 from unittest import mock
+import asyncio
+import json
+import pickle
 
 # Third Party
-from datasets import Dataset
+from datasets import Dataset, concatenate_datasets
+from openai import OpenAI
 import pytest
 
 # First Party
-from instructlab.sdg import Block, Pipeline, PipelineBlockError, PipelineContext
+from instructlab.sdg import (
+    Block,
+    CombineColumnsBlock,
+    DuplicateColumnsBlock,
+    FlattenColumnsBlock,
+    Pipeline,
+    PipelineBlockError,
+    PipelineConfigParserError,
+    PipelineContext,
+    RenameColumnsBlock,
+    SelectorBlock,
+)
+from instructlab.sdg.autotune import AutoTuner
+from instructlab.sdg.profiling import PipelineProfiler
+from instructlab.sdg.response_cache import SQLiteResponseCache
 
 ## Helpers ##
 
@@ -71,8 +90,6 @@ def test_pipeline_batching_order_correct(sample_dataset, threaded_ctx):
     """Make sure that batches are recombined in the correct order"""
 
     class MockBlockType:
-        # NOTE: This needs to be a class variable because it will be different
-        #   instances of the block for each batch
         _second_half_event = Event()
 
         def __init__(self, *_, **__):
@@ -102,6 +119,31 @@ def test_pipeline_batching_order_correct(sample_dataset, threaded_ctx):
     assert res.to_list() == [{"foo": i * 2} for i in range(10)]
 
 
+def test_pipeline_shared_batch_executor(sample_dataset, threaded_ctx):
+    """Batches run in the context's batch executor when it has one, which
+    is left running for the other pipelines sharing it
+    """
+    block_type_mock = mock.MagicMock()
+    block_type_mock().generate.side_effect = lambda dataset: dataset
+    pipe_cfg = [
+        {
+            "name": "block-one",
+            "type": "test",
+            "config": {},
+        }
+    ]
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        threaded_ctx.batch_executor = executor
+        with (
+            mock.patch.object(executor, "submit", wraps=executor.submit) as submit,
+            block_types({"test": block_type_mock}),
+        ):
+            res = Pipeline(threaded_ctx, "", pipe_cfg).generate(sample_dataset)
+        assert submit.call_count > 1
+        assert res.to_list() == sample_dataset.to_list()
+        assert executor.submit(lambda: 42).result() == 42
+
+
 def test_pipeline_batching_after_each_block(sample_dataset, threaded_ctx):
     """Test that batching occurs after each block in the pipeline."""
 
@@ -167,6 +209,679 @@ def test_pipeline_batching_after_each_block(sample_dataset, threaded_ctx):
     assert "foo" in result[0], "Feature 'foo' not found in the final dataset"
 
 
+def test_pipeline_blocks_instantiated_once(sample_dataset, threaded_ctx):
+    """Blocks are built once per Pipeline and shared by all batches, blocks
+    and calls to generate
+    """
+    instances = []
+
+    class CountingBlock:
+        def __init__(self, *_, **__):
+            instances.append(self)
+
+        def generate(self, dataset):
+            return dataset
+
+    pipe_cfg = [
+        {"name": "block-one", "type": "counting", "config": {}},
+        {"name": "block-two", "type": "counting", "config": {}},
+    ]
+    with block_types({"counting": CountingBlock}):
+        pipe = Pipeline(threaded_ctx, "", pipe_cfg)
+        pipe.generate(sample_dataset)
+        pipe.generate(sample_dataset)
+    assert len(instances) == 2
+
+
+## Pipeline Streaming ##
+
+
+def test_pipeline_streaming_matches_batching(
+    sample_dataset, threaded_ctx, streaming_ctx
+):
+    """Streaming batches through the blocks produces the same rows, in the same
+    order, as running each block over all batches before the next
+    """
+
+    class ExplodeBlock:
+        def __init__(self, ctx, pipeline, block_name, **block_config):
+            pass
+
+        def generate(self, dataset):
+            return Dataset.from_list(
+                [{"foo": r["foo"] * 10 + i} for r in dataset for i in range(3)]
+            )
+
+    class SlowFirstHalfBlock:
+        _second_half_event = Event()
+
+        def __init__(self, ctx, pipeline, block_name, **block_config):
+            self.ctx = ctx
+
+        def generate(self, dataset):
+            assert len(dataset) <= self.ctx.batch_size
+            # Hold the first batch back until a later batch went through
+            if dataset[0]["foo"] == 0:
+                self._second_half_event.wait(timeout=10)
+            else:
+                self._second_half_event.set()
+            return dataset.map(lambda r: {"foo": r["foo"] + 1})
+
+    pipe_cfg = [
+        {"name": "explode", "type": "explode", "config": {}},
+        {"name": "slow", "type": "slow", "config": {}},
+    ]
+    with block_types({"explode": ExplodeBlock, "slow": SlowFirstHalfBlock}):
+        expected = Pipeline(threaded_ctx, "", pipe_cfg).generate(sample_dataset)
+        SlowFirstHalfBlock._second_half_event.clear()
+        result = Pipeline(streaming_ctx, "", pipe_cfg).generate(sample_dataset)
+    assert result.to_list() == expected.to_list()
+    assert len(result) == len(sample_dataset) * 3
+
+
+def test_pipeline_streaming_filtered_to_empty(sample_dataset, streaming_ctx):
+    """Batches that are filtered out entirely do not reach later blocks"""
+    later_block = mock.MagicMock()
+    pipe_cfg = [
+        {"name": "filter", "type": "filter", "config": {}},
+        {"name": "later", "type": "later", "config": {}},
+    ]
+
+    class FilterAllBlock:
+        def __init__(self, *_, **__):
+            pass
+
+        def generate(self, dataset):
+            return dataset.filter(lambda r: False)
+
+    with block_types({"filter": FilterAllBlock, "later": later_block}):
+        result = Pipeline(streaming_ctx, "", pipe_cfg).generate(sample_dataset)
+    assert len(result) == 0
+    later_block().generate.assert_not_called()
+
+
+def test_pipeline_streaming_error(sample_dataset, streaming_ctx):
+    """A failing block in a streaming pipeline raises a PipelineBlockError"""
+    failure_exc = RuntimeError("Oh no!")
+
+    class FailingBlock:
+        def __init__(self, *_, **__):
+            self.block_name = "failing"
+
+        def generate(self, dataset):
+            raise failure_exc
+
+    pipe_cfg = [{"name": "failing", "type": "failure", "config": {}}]
+    streaming_ctx.stream_queue_size = 1
+    with block_types({"failure": FailingBlock}):
+        with pytest.raises(PipelineBlockError) as exc_ctx:
+            Pipeline(streaming_ctx, "", pipe_cfg).generate(sample_dataset)
+    assert exc_ctx.value.exception is failure_exc
+    assert exc_ctx.value.block_name == "failing"
+
+
+def test_pipeline_streaming_checkpoints(sample_dataset, streaming_ctx, tmp_path):
+    """Each input batch is checkpointed once all of its output is done"""
+
+    class DoubleBlock:
+        def __init__(self, *_, **__):
+            pass
+
+        def generate(self, dataset):
+            return Dataset.from_list([r for r in dataset for _ in range(2)])
+
+    pipe_cfg = [
+        {"name": "double", "type": "double", "config": {}},
+        {"name": "double-again", "type": "double", "config": {}},
+    ]
+    streaming_ctx.checkpoint_dir = str(tmp_path)
+    with block_types({"double": DoubleBlock}):
+        result = Pipeline(streaming_ctx, "", pipe_cfg).generate(sample_dataset, "leaf")
+    assert len(result) == len(sample_dataset) * 4
+    checkpoints = list((tmp_path / "leaf").iterdir())
+    # 10 rows in batches of 6 means two input batches
+    assert len(checkpoints) == 2
+
+
+## Pipeline auto-tuning ##
+
+
+def test_pipeline_autotuned_batches(sample_dataset, threaded_ctx):
+    """Batch sizes follow the auto-tuner as it changes during the run and the
+    batches are recombined in order
+    """
+    autotuner = AutoTuner(batch_size=2, num_workers=1, probe_requests=0)
+    batch_sizes = []
+
+    class GrowingBlock(Block):
+        def generate(self, samples):
+            batch_sizes.append(len(samples))
+            # Pretend every sample was one fast, successful LLM request
+            autotuner.window = 1
+            for _ in samples:
+                autotuner.record_request(0.01)
+            return samples.map(lambda r: {"foo": r["foo"] * 2})
+
+    threaded_ctx.autotuner = autotuner
+    pipe_cfg = [{"name": "grow", "type": "grow", "config": {}}]
+    with block_types({"grow": GrowingBlock}):
+        res = Pipeline(threaded_ctx, "", pipe_cfg).generate(sample_dataset)
+    assert res.to_list() == [{"foo": i * 2} for i in range(10)]
+    assert batch_sizes[0] == 2
+    assert max(batch_sizes) > 2
+    assert autotuner.num_workers > 1
+
+
+def test_pipeline_autotune_calibrates(sample_dataset, threaded_ctx):
+    """The auto-tuner is calibrated against the client before the first run"""
+    threaded_ctx.autotuner = AutoTuner(probe_requests=1, max_workers=2)
+    pipe_cfg = [{"name": "noop", "type": "noop", "config": {}}]
+
+    class NoopBlock(Block):
+        def generate(self, samples):
+            return samples
+
+    with block_types({"noop": NoopBlock}):
+        Pipeline(threaded_ctx, "", pipe_cfg).generate(sample_dataset)
+    assert threaded_ctx.autotuner.calibrated
+    threaded_ctx.client.completions.create.assert_called_with(
+        model="test-model", prompt="test", max_tokens=1
+    )
+
+
+def test_pipeline_autotuner_starts_from_context(sample_dataset, threaded_ctx):
+    """The auto-tuner starts from the batching of the context, and runs its
+    batches on the shared batch executor
+    """
+    threaded_ctx.autotuner = AutoTuner(probe_requests=0)
+    batch_sizes = []
+
+    class RecordingBlock(Block):
+        def generate(self, samples):
+            batch_sizes.append(len(samples))
+            return samples
+
+    pipe_cfg = [{"name": "record", "type": "record", "config": {}}]
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        threaded_ctx.batch_executor = mock.MagicMock(wraps=executor)
+        with block_types({"record": RecordingBlock}):
+            Pipeline(threaded_ctx, "", pipe_cfg).generate(sample_dataset)
+    assert batch_sizes == [6, 4]
+    assert threaded_ctx.autotuner.num_workers == 2
+    assert threaded_ctx.batch_executor.submit.call_count == 2
+
+
+def test_pipeline_autotuner_not_streamed(sample_dataset, streaming_ctx):
+    streaming_ctx.autotuner = AutoTuner(probe_requests=0)
+    with pytest.raises(ValueError):
+        Pipeline(streaming_ctx, "", []).generate(sample_dataset)
+
+
+## Pipeline profiling ##
+
+
+def test_pipeline_profile(sample_dataset, threaded_ctx, tmp_path):
+    """Every block and batch is profiled"""
+
+    class HalvingBlock(Block):
+        def generate(self, samples):
+            return samples.filter(lambda r: r["foo"] % 2 == 0)
+
+    class NoopBlock(Block):
+        def generate(self, samples):
+            return samples
+
+    threaded_ctx.profiler = PipelineProfiler(str(tmp_path / "profile.json"))
+    pipe_cfg = [
+        {"name": "halve", "type": "halve", "config": {}},
+        {"name": "noop", "type": "noop", "config": {}},
+    ]
+    with block_types({"halve": HalvingBlock, "noop": NoopBlock}):
+        Pipeline(threaded_ctx, "knowledge.yaml", pipe_cfg).generate(sample_dataset)
+    threaded_ctx.profiler.save()
+
+    with open(tmp_path / "profile.json", encoding="utf-8") as f:
+        profile = json.load(f)
+    # 10 rows in batches of 6 means two batches through each block
+    assert len(profile["records"]) == 4
+    blocks = {block["block_name"]: block for block in profile["blocks"]}
+    assert blocks["halve"]["pipeline"] == "knowledge"
+    assert blocks["halve"]["batches"] == 2
+    assert blocks["halve"]["rows_in"] == 10
+    assert blocks["halve"]["rows_out"] == 5
+    assert blocks["halve"]["yield"] == 0.5
+    assert blocks["noop"]["rows_in"] == 5
+    assert blocks["noop"]["block_type"] == "NoopBlock"
+
+
+@pytest.mark.parametrize(
+    "ctx_fixture", ["single_threaded_ctx", "threaded_ctx", "streaming_ctx"]
+)
+def test_pipeline_memory_budget(sample_dataset, ctx_fixture, request, tmp_path):
+    """Intermediate datasets past the memory budget are spilled to disk
+    without changing the output
+    """
+
+    class ExplodeBlock:
+        def __init__(self, ctx, pipeline, block_name, **block_config):
+            pass
+
+        def generate(self, dataset):
+            return Dataset.from_list(
+                [{"foo": r["foo"] * 10 + i} for r in dataset for i in range(3)]
+            )
+
+    pipe_cfg = [
+        {"name": "explode", "type": "explode", "config": {}},
+        {"name": "explode-again", "type": "explode", "config": {}},
+    ]
+    ctx = request.getfixturevalue(ctx_fixture)
+    with block_types({"explode": ExplodeBlock}):
+        expected = Pipeline(ctx, "", pipe_cfg).generate(sample_dataset)
+        ctx.memory_budget = 0
+        ctx.spill_dir = str(tmp_path)
+        result = Pipeline(ctx, "", pipe_cfg).generate(sample_dataset)
+    assert result.to_list() == expected.to_list()
+    assert result.cache_files
+    assert all(f["filename"].startswith(str(tmp_path)) for f in result.cache_files)
+
+
+## Pipeline pickling ##
+
+
+def test_pipeline_context_pickles_without_clients():
+    """Contexts and pipelines can be sent to worker processes, leaving behind
+    the OpenAI client and its SSLContext
+    """
+    client = OpenAI(api_key="EMPTY", base_url="http://localhost:8000/v1")
+    ctx = PipelineContext(
+        client,
+        "mixtral",
+        "test-model",
+        autotuner=AutoTuner(),
+        memory_budget=0,
+        response_cache=SQLiteResponseCache(":memory:"),
+    )
+    ctx.batch_executor = ThreadPoolExecutor(max_workers=1)
+    ctx.spill_dataset(Dataset.from_dict({"foo": [1]}))
+    ctx.get_async_client()
+    pipe = Pipeline(ctx, "", [{"name": "noop", "type": "noop", "config": {}}])
+    copy = pickle.loads(pickle.dumps(pipe))
+    assert copy.ctx.client is None
+    assert copy.ctx.async_client is None
+    assert copy.ctx.autotuner is None
+    assert copy.ctx.batch_executor is None
+    assert copy.ctx._memory_budget is None
+    assert copy.ctx.response_cache is None
+    assert copy.ctx.model_id == "test-model"
+    assert copy.chained_blocks == pipe.chained_blocks
+    assert ctx.client is client
+    ctx.batch_executor.shutdown()
+
+
+## Pipeline asyncio ##
+
+
+def test_pipeline_agenerate(sample_dataset, threaded_ctx):
+    """Blocks are awaited concurrently per batch and the batches are
+    recombined in order, with sync-only blocks run in an executor
+    """
+
+    class AsyncBlock(Block):
+        _second_half_event = None
+
+        async def agenerate(self, samples):
+            # Make sure the second half is processed before the first half
+            if samples[0]["foo"] == 0:
+                await self._second_half_event.wait()
+            else:
+                self._second_half_event.set()
+            return samples.map(lambda r: {"foo": r["foo"] * 2})
+
+    class SyncBlock(Block):
+        def generate(self, samples):
+            return samples.map(lambda r: {"foo": r["foo"] + 1})
+
+    pipe_cfg = [
+        {"name": "async-block", "type": "async", "config": {}},
+        {"name": "sync-block", "type": "sync", "config": {}},
+    ]
+
+    async def run():
+        AsyncBlock._second_half_event = asyncio.Event()
+        return await Pipeline(threaded_ctx, "", pipe_cfg).agenerate(sample_dataset)
+
+    with block_types({"async": AsyncBlock, "sync": SyncBlock}):
+        res = asyncio.run(run())
+    assert res.to_list() == [{"foo": i * 2 + 1} for i in range(10)]
+
+
+def test_pipeline_agenerate_error(sample_dataset, single_threaded_ctx):
+    """A failing block in an asyncio pipeline raises a PipelineBlockError"""
+    failure_exc = RuntimeError("Oh no!")
+
+    class FailingBlock(Block):
+        def generate(self, samples):
+            raise failure_exc
+
+    pipe_cfg = [{"name": "failing", "type": "failure", "config": {}}]
+    with block_types({"failure": FailingBlock}):
+        with pytest.raises(PipelineBlockError) as exc_ctx:
+            asyncio.run(
+                Pipeline(single_threaded_ctx, "", pipe_cfg).agenerate(sample_dataset)
+            )
+    assert exc_ctx.value.exception is failure_exc
+    assert exc_ctx.value.block_name == "failing"
+
+
+## Pipeline Branches ##
+
+
+class _EvalBlock(Block):
+    """Adds a column and keeps the rows whose foo is a multiple of divisor"""
+
+    def __init__(self, ctx, pipe, block_name, output_col, divisor) -> None:
+        super().__init__(ctx, pipe, block_name)
+        self.output_col = output_col
+        self.divisor = divisor
+
+    def generate(self, samples):
+        samples = samples.map(lambda r: {self.output_col: r["foo"] * 10})
+        return samples.filter(lambda r: r["foo"] % self.divisor == 0)
+
+
+def _branches_cfg(divisors, drop_columns=None):
+    return [
+        {
+            "name": "evaluate",
+            "branches": [
+                {
+                    "name": f"div{divisor}",
+                    "blocks": [
+                        {
+                            "name": f"eval{divisor}",
+                            "type": "eval",
+                            "config": {
+                                "output_col": f"by{divisor}",
+                                "divisor": divisor,
+                            },
+                            "drop_columns": drop_columns or [],
+                        }
+                    ],
+                }
+                for divisor in divisors
+            ],
+        }
+    ]
+
+
+@pytest.mark.parametrize(
+    "ctx_fixture", ["single_threaded_ctx", "threaded_ctx", "streaming_ctx"]
+)
+def test_pipeline_branches_and_join(sample_dataset, ctx_fixture, request):
+    """Rows are kept if they pass every branch and gain every branch's new
+    columns, in the original order
+    """
+    ctx = request.getfixturevalue(ctx_fixture)
+    with block_types({"eval": _EvalBlock}):
+        res = Pipeline(ctx, "", _branches_cfg([2, 3])).generate(sample_dataset)
+    assert res.to_list() == [
+        {"foo": foo, "by2": foo * 10, "by3": foo * 10} for foo in (0, 6)
+    ]
+
+
+def test_pipeline_branches_agenerate(sample_dataset, threaded_ctx):
+    with block_types({"eval": _EvalBlock}):
+        res = asyncio.run(
+            Pipeline(threaded_ctx, "", _branches_cfg([2, 3])).agenerate(sample_dataset)
+        )
+    assert res["foo"] == [0, 6]
+
+
+def test_pipeline_branches_drop_columns(sample_dataset, single_threaded_ctx):
+    """Input columns dropped by a branch are dropped from the joined output"""
+    sample_dataset = sample_dataset.add_column("bar", list(range(10)))
+    with block_types({"eval": _EvalBlock}):
+        res = Pipeline(
+            single_threaded_ctx, "", _branches_cfg([2, 5], drop_columns=["bar"])
+        ).generate(sample_dataset)
+    assert res.column_names == ["foo", "by2", "by5"]
+    assert res["foo"] == [0]
+
+
+def test_pipeline_branches_run_concurrently(sample_dataset, single_threaded_ctx):
+    """Each branch waits for the other to start, which only completes if
+    they run at the same time
+    """
+    started = {"left": Event(), "right": Event()}
+
+    class WaitBlock(Block):
+        def __init__(self, ctx, pipe, block_name, me, other) -> None:
+            super().__init__(ctx, pipe, block_name)
+            self.me = me
+            self.other = other
+
+        def generate(self, samples):
+            started[self.me].set()
+            assert started[self.other].wait(timeout=5)
+            return samples
+
+    pipe_cfg = [
+        {
+            "name": "both",
+            "branches": [
+                {
+                    "name": me,
+                    "blocks": [
+                        {
+                            "name": f"wait-{me}",
+                            "type": "wait",
+                            "config": {"me": me, "other": other},
+                        }
+                    ],
+                }
+                for me, other in (("left", "right"), ("right", "left"))
+            ],
+        }
+    ]
+    with block_types({"wait": WaitBlock}):
+        res = Pipeline(single_threaded_ctx, "", pipe_cfg).generate(sample_dataset)
+    assert res.to_list() == sample_dataset.to_list()
+
+
+def test_pipeline_branches_reject_fan_out(sample_dataset, single_threaded_ctx):
+    """A branch producing several rows per input row can not be joined"""
+
+    class DoubleBlock(Block):
+        def generate(self, samples):
+            return concatenate_datasets([samples, samples])
+
+    pipe_cfg = _branches_cfg([1, 2])
+    pipe_cfg[0]["branches"][0]["blocks"] = [
+        {"name": "double", "type": "double", "config": {}}
+    ]
+    with block_types({"eval": _EvalBlock, "double": DoubleBlock}):
+        with pytest.raises(PipelineBlockError) as exc_ctx:
+            Pipeline(single_threaded_ctx, "", pipe_cfg).generate(sample_dataset)
+    assert exc_ctx.value.block_name == "evaluate"
+    assert "more than one row" in str(exc_ctx.value)
+
+
+def test_pipeline_branches_need_v2(tmp_path, single_threaded_ctx):
+    pipeline_yaml = tmp_path / "pipeline.yaml"
+    pipeline_yaml.write_text(
+        "version: '1.0'\nblocks:\n  - name: evaluate\n    branches: []\n"
+    )
+    with pytest.raises(PipelineConfigParserError, match="version 2.0"):
+        Pipeline.from_file(single_threaded_ctx, str(pipeline_yaml))
+
+
+## Pipeline column block fusion ##
+
+
+_COLUMN_BLOCKS_CFG = [
+    {
+        "name": "duplicate",
+        "type": "DuplicateColumnsBlock",
+        "config": {"columns_map": {"question": "first"}},
+    },
+    {
+        "name": "flatten",
+        "type": "FlattenColumnsBlock",
+        "config": {
+            "var_cols": ["first", "answer"],
+            "value_name": "text",
+            "var_name": "kind",
+        },
+        "drop_columns": ["id"],
+    },
+    {
+        "name": "rename",
+        "type": "RenameColumnsBlock",
+        "config": {"columns_map": {"text": "content"}},
+    },
+    {
+        "name": "select",
+        "type": "SelectorBlock",
+        "config": {
+            "choice_map": {"first": "question", "answer": "content"},
+            "choice_col": "kind",
+            "output_col": "picked",
+        },
+    },
+    {
+        "name": "combine",
+        "type": "CombineColumnsBlock",
+        "config": {
+            "columns": ["question", "picked"],
+            "output_col": "question",
+            "separator": " | ",
+        },
+    },
+]
+
+
+@pytest.fixture
+def qa_dataset():
+    return Dataset.from_dict(
+        {
+            "id": [0, 1, 2],
+            "question": ["q0", "q1", "q2"],
+            "answer": ["a0", "a1", "a2"],
+        }
+    )
+
+
+def _column_blocks_reference(dataset):
+    """What the blocks in _COLUMN_BLOCKS_CFG produced before they were
+    fused, one Dataset operation at a time
+    """
+    dataset = dataset.add_column("first", dataset["question"])
+    df = dataset.to_pandas().melt(
+        id_vars=["id", "question"],
+        value_vars=["first", "answer"],
+        value_name="text",
+        var_name="kind",
+    )
+    dataset = Dataset.from_pandas(df.reset_index(drop=True)).remove_columns(["id"])
+    dataset = dataset.rename_columns({"text": "content"})
+    choice_map = {"first": "question", "answer": "content"}
+    dataset = dataset.map(lambda row: {"picked": row[choice_map[row["kind"]]]})
+    return dataset.map(
+        lambda row: {"question": " | ".join([row["question"], row["picked"]])}
+    )
+
+
+@pytest.mark.parametrize("ctx_fixture", ["single_threaded_ctx", "threaded_ctx"])
+def test_pipeline_fuses_column_blocks(qa_dataset, ctx_fixture, request):
+    ctx = request.getfixturevalue(ctx_fixture)
+    pipe = Pipeline(ctx, "", _COLUMN_BLOCKS_CFG)
+    # pylint: disable=protected-access
+    [step] = pipe._get_steps()
+    assert step.block_name == "duplicate+flatten+rename+select+combine"
+    res = pipe.generate(qa_dataset)
+    expected = _column_blocks_reference(qa_dataset)
+    assert res.features == expected.features
+    assert res.to_list() == expected.to_list()
+
+
+@pytest.mark.parametrize("ctx_fixture", ["single_threaded_ctx", "threaded_ctx"])
+def test_pipeline_profiles_fused_blocks(qa_dataset, ctx_fixture, request):
+    """Each fused block keeps its own entry in the profile"""
+    ctx = request.getfixturevalue(ctx_fixture)
+    ctx.profiler = PipelineProfiler()
+    Pipeline(ctx, "", _COLUMN_BLOCKS_CFG).generate(qa_dataset)
+    records = ctx.profiler.records
+    assert [(r["block_name"], r["block_type"]) for r in records] == [
+        ("duplicate", "DuplicateColumnsBlock"),
+        ("flatten", "FlattenColumnsBlock"),
+        ("rename", "RenameColumnsBlock"),
+        ("select", "SelectorBlock"),
+        ("combine", "CombineColumnsBlock"),
+    ]
+    assert [(r["rows_in"], r["rows_out"]) for r in records] == [
+        (3, 3),
+        (3, 6),
+        (6, 6),
+        (6, 6),
+        (6, 6),
+    ]
+
+
+def test_pipeline_fusion_stops_at_other_blocks(qa_dataset, single_threaded_ctx):
+    """Blocks that drop duplicates or override generate end a run"""
+
+    class CustomRename(RenameColumnsBlock):
+        def generate(self, samples):
+            return super().generate(samples).add_column("custom", [1] * len(samples))
+
+    pipe_cfg = [
+        {**_COLUMN_BLOCKS_CFG[0], "drop_duplicates": ["question"]},
+        _COLUMN_BLOCKS_CFG[1],
+        {**_COLUMN_BLOCKS_CFG[2], "type": "custom_rename"},
+        *_COLUMN_BLOCKS_CFG[3:],
+    ]
+    with block_types(
+        {
+            "DuplicateColumnsBlock": DuplicateColumnsBlock,
+            "FlattenColumnsBlock": FlattenColumnsBlock,
+            "custom_rename": CustomRename,
+            "SelectorBlock": SelectorBlock,
+            "CombineColumnsBlock": CombineColumnsBlock,
+        }
+    ):
+        pipe = Pipeline(single_threaded_ctx, "", pipe_cfg)
+        # pylint: disable=protected-access
+        steps = pipe._get_steps()
+        assert [step.block_name for step in steps] == [
+            "duplicate",
+            "flatten",
+            "rename",
+            "select+combine",
+        ]
+        res = pipe.generate(qa_dataset)
+    expected = _column_blocks_reference(qa_dataset)
+    assert res["question"] == expected["question"]
+    assert res["custom"] == [1] * 6
+
+
+def test_pipeline_fused_block_error(qa_dataset, single_threaded_ctx):
+    """Errors name the block that failed within the fused step"""
+    pipe_cfg = [
+        _COLUMN_BLOCKS_CFG[0],
+        {
+            "name": "rename",
+            "type": "RenameColumnsBlock",
+            "config": {"columns_map": {"missing": "other"}},
+        },
+    ]
+    with pytest.raises(PipelineBlockError) as exc_ctx:
+        Pipeline(single_threaded_ctx, "", pipe_cfg).generate(qa_dataset)
+    assert exc_ctx.value.block_name == "duplicate+rename"
+    assert exc_ctx.value.exception.block_name == "rename"
+    assert "missing" in str(exc_ctx.value)
+
+
 ## Pipeline Error Handling ##
 
 
@@ -0,0 +1,137 @@
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Unit tests for pipeline profiling
+"""
+
+# Standard
+from unittest.mock import MagicMock, patch
+import json
+import threading
+import time
+
+# Third Party
+from datasets import Dataset
+
+# First Party
+from instructlab.sdg import LLMBlock, Pipeline, PipelineProfiler
+from instructlab.sdg.profiling import current_block_profile
+
+# Local
+from .conftest import get_ctx
+
+
+def test_profile_block_records_rows_and_time():
+    profiler = PipelineProfiler()
+    dataset = Dataset.from_dict({"foo": [1, 2, 3]})
+    with profiler.profile_block("pipe", "block", "TestBlock", dataset) as profile:
+        assert current_block_profile() is profile
+        time.sleep(0.01)
+        profile.rows_out = 1
+    assert current_block_profile() is None
+    [record] = profiler.records
+    assert record["rows_in"] == 3
+    assert record["rows_out"] == 1
+    assert record["wall_time"] >= 0.01
+    assert record["cpu_time"] == record["wall_time"]
+
+
+def test_concurrent_llm_requests_are_counted_once():
+    profiler = PipelineProfiler()
+    dataset = Dataset.from_dict({"foo": [1]})
+    with profiler.profile_block("pipe", "block", "TestBlock", dataset) as profile:
+
+        def request():
+            with profile.llm_request():
+                time.sleep(0.05)
+
+        threads = [threading.Thread(target=request) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    [record] = profiler.records
+    assert record["llm_requests"] == 4
+    assert 0.05 <= record["llm_time"] < 0.2
+    assert record["llm_time"] <= record["wall_time"]
+
+
+def test_save_writes_summary_sorted_by_wall_time(tmp_path):
+    profiler = PipelineProfiler(str(tmp_path / "out" / "profile.json"))
+    dataset = Dataset.from_dict({"foo": [1, 2]})
+    for block_name, delay in (("fast", 0), ("slow", 0.02), ("slow", 0.02)):
+        with profiler.profile_block("pipe", block_name, "T", dataset) as profile:
+            time.sleep(delay)
+            profile.rows_out = 2
+    profiler.save()
+    with open(tmp_path / "out" / "profile.json", encoding="utf-8") as f:
+        saved = json.load(f)
+    assert [block["block_name"] for block in saved["blocks"]] == ["slow", "fast"]
+    assert saved["blocks"][0]["batches"] == 2
+    assert saved["blocks"][0]["yield"] == 1.0
+    assert len(saved["records"]) == 3
+
+
+def test_pipeline_leaves_saving_to_the_end_of_the_run(tmp_path):
+    """Rewriting the profile after every Pipeline.generate would make a run
+    over many leaf nodes quadratic in I/O"""
+    ctx = get_ctx()
+    ctx.profiler = PipelineProfiler(str(tmp_path / "profile.json"))
+    pipe_cfg = [
+        {
+            "name": "dup",
+            "type": "DuplicateColumnsBlock",
+            "config": {"columns_map": {"fruit": "copy"}},
+        }
+    ]
+    pipeline = Pipeline(ctx, "", pipe_cfg)
+    for _ in range(2):
+        pipeline.generate(Dataset.from_dict({"fruit": ["apple"]}))
+    assert not (tmp_path / "profile.json").exists()
+    assert len(ctx.profiler.records) == 2
+    ctx.profiler.save()
+    assert (tmp_path / "profile.json").exists()
+
+
+@patch("instructlab.sdg.blocks.block.Block._load_config")
+def test_llmblock_reports_llm_time_validation_failures_and_empty_parses(
+    mock_load_config,
+):
+    mock_load_config.return_value = {
+        "system": "{{fruit}}",
+        "introduction": "",
+        "principles": "",
+        "examples": "",
+        "generation": "",
+        "start_tags": ["<q>"],
+        "end_tags": ["</q>"],
+    }
+    ctx = MagicMock()
+    ctx.model_id = "test_model"
+    ctx.model_family = "mixtral"
+    ctx.max_num_tokens = 4096
+    ctx.client.server_supports_batched = True
+    ctx.client.completions.create.return_value.choices = [
+        MagicMock(text="<q>apple?</q>"),
+        MagicMock(text="no tags here"),
+    ]
+    block = LLMBlock(
+        ctx=ctx,
+        pipe=None,
+        block_name="test_block",
+        config_path="",
+        output_cols=["question"],
+        model_prompt="",
+    )
+    dataset = Dataset.from_dict({"fruit": ["apple", "pear"]})
+    invalid_dataset = Dataset.from_dict({"vegetable": ["kale"]})
+    profiler = PipelineProfiler()
+    with profiler.profile_block("pipe", "test_block", "LLMBlock", dataset) as profile:
+        output = block.generate(dataset)
+        assert len(block.generate(invalid_dataset)) == 0
+        profile.rows_out = len(output)
+    [record] = profiler.records
+    assert record["rows_out"] == 1
+    assert record["llm_requests"] == 1
+    assert record["validation_failures"] == 1
+    assert record["empty_parses"] == 1
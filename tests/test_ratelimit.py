@@ -0,0 +1,143 @@
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Unit tests for rate limiting and retrying LLM requests
+"""
+
+# Standard
+from unittest.mock import MagicMock
+import asyncio
+import time
+
+# Third Party
+import httpx
+import openai
+import pytest
+
+# First Party
+from instructlab.sdg import ClientPool, RateLimiter, RetryPolicy
+from instructlab.sdg.ratelimit import estimate_request_tokens
+
+# Local
+from .stubserver import StubLLMServer
+
+
+def _status_error(status, headers=None):
+    request = httpx.Request("POST", "http://localhost/v1/completions")
+    response = httpx.Response(status, headers=headers, request=request)
+    return openai.APIStatusError("error", response=response, body=None)
+
+
+def test_requests_per_second_allow_a_burst_then_wait():
+    limiter = RateLimiter(requests_per_second=10)
+    waits = [limiter.reserve(0) for _ in range(12)]
+    assert waits[:10] == [0] * 10
+    # Each further request waits for its share of the next second
+    assert waits[10] == pytest.approx(0.1, abs=0.02)
+    assert waits[11] == pytest.approx(0.2, abs=0.02)
+    assert limiter.waited == pytest.approx(0.3, abs=0.04)
+
+
+def test_tokens_per_minute():
+    limiter = RateLimiter(tokens_per_minute=600)
+    assert limiter.delay(10) == 0
+    assert limiter.delay(25) == pytest.approx(1.5, abs=0.01)
+    assert limiter.reserve(25) == pytest.approx(1.5, abs=0.01)
+    # The budget of the previous request is still being waited for
+    assert limiter.delay(10) == pytest.approx(2.5, abs=0.01)
+
+
+def test_estimate_request_tokens():
+    prompt = "abcd" * 10
+    assert (
+        estimate_request_tokens({"prompt": [prompt, prompt], "n": 2, "max_tokens": 5})
+        == 40
+    )
+    messages = [{"role": "system", "content": None}, {"role": "user", "content": "hi"}]
+    assert estimate_request_tokens({"messages": messages, "max_tokens": 10}) == 11
+
+
+def test_retry_policy():
+    policy = RetryPolicy(initial_delay=1, max_delay=4)
+    assert policy.is_retryable(_status_error(429))
+    assert policy.is_retryable(_status_error(503))
+    assert policy.is_retryable(openai.APIConnectionError(request=MagicMock()))
+    assert not policy.is_retryable(_status_error(400))
+    assert not policy.is_retryable(ValueError())
+    assert all(0 <= policy.backoff(attempt) <= 4 for attempt in range(10))
+    throttled = _status_error(429, headers={"Retry-After": "3"})
+    assert policy.backoff(0, throttled) >= 3
+    throttled = _status_error(429, headers={"Retry-After": "30"})
+    assert policy.backoff(0, throttled) == 4
+
+
+@pytest.fixture
+def server():
+    with StubLLMServer("stub") as stub:
+        yield stub
+
+
+def _pool(server, **kwargs):
+    kwargs.setdefault("retry_policy", RetryPolicy(initial_delay=0.01))
+    return ClientPool.from_urls([server.base_url], **kwargs)
+
+
+def _complete(pool):
+    return pool.completions.create(model="test-model", prompt="hello", max_tokens=1)
+
+
+def test_throttled_requests_are_retried(server):
+    server.fail(429, count=2)
+    server.fail(503, count=1)
+    assert _complete(_pool(server)).choices[0].text == "stub"
+    assert len(server.requests) == 4
+
+
+def test_retries_are_limited(server):
+    server.fail(429, count=3)
+    with pytest.raises(openai.RateLimitError):
+        _complete(_pool(server, retry_policy=RetryPolicy(2, initial_delay=0.01)))
+    assert len(server.requests) == 3
+
+
+def test_other_errors_are_not_retried(server):
+    server.fail(422)
+    with pytest.raises(openai.UnprocessableEntityError):
+        _complete(_pool(server))
+    assert len(server.requests) == 1
+
+
+def test_pool_waits_for_its_rate_limit(server):
+    pool = _pool(server, requests_per_second=20)
+    start = time.monotonic()
+    for _ in range(30):
+        _complete(pool)
+    # A burst of 20 requests, then 10 more at 20 per second
+    assert time.monotonic() - start >= 0.45
+    assert pool.stats()[0]["rate_limited_seconds"] > 0
+
+
+def test_async_pool_waits_for_its_rate_limit(server):
+    pool = _pool(server, requests_per_second=20).async_pool()
+
+    async def complete_all():
+        await asyncio.gather(
+            *(
+                pool.completions.create(model="test-model", prompt="hi")
+                for _ in range(30)
+            )
+        )
+
+    start = time.monotonic()
+    asyncio.run(complete_all())
+    assert time.monotonic() - start >= 0.45
+
+
+def test_requests_go_to_replicas_with_budget_left():
+    with StubLLMServer("one") as one, StubLLMServer("two") as two:
+        pool = ClientPool.from_urls(
+            [one.base_url, two.base_url], requests_per_second=[1, 100]
+        )
+        texts = [_complete(pool).choices[0].text for _ in range(4)]
+    # The first replica only has budget for a single request right away
+    assert texts.count("one") == 1
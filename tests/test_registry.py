@@ -1,7 +1,7 @@
 # SPDX-License-Identifier: Apache-2.0
 
 # First Party
-from src.instructlab.sdg.registry import BlockRegistry
+from src.instructlab.sdg.registry import BlockRegistry, PromptRegistry
 
 
 def test_block_registry():
@@ -12,3 +12,18 @@ def test_block_registry():
     registry = BlockRegistry.get_registry()
     assert registry is not None
     assert registry["TestFooClass"] is TestFooClass
+
+
+def test_template_variables():
+    template = PromptRegistry.template_from_string("{{fruit}} and {{ veg }}")
+    assert PromptRegistry.template_variables(template) == {"fruit", "veg"}
+    assert (
+        PromptRegistry.template_variables(
+            PromptRegistry.template_from_string("no variables")
+        )
+        == frozenset()
+    )
+    # Only rendering tells whether these render
+    for source in ("{% if fruit %}{{fruit}}{% endif %}", "{{fruit.name}}"):
+        template = PromptRegistry.template_from_string(source)
+        assert PromptRegistry.template_variables(template) is None
@@ -0,0 +1,101 @@
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Unit tests for the cache of the completions of the teacher model
+"""
+
+# Third Party
+import pytest
+
+# First Party
+from instructlab.sdg import ResponseCache, SQLiteResponseCache
+
+GREEDY = {"model": "teacher", "temperature": 0.0, "max_tokens": 10}
+SAMPLED = {"model": "teacher", "temperature": 0.7, "max_tokens": 10, "n": 2}
+
+
+def test_put_and_get(tmp_path):
+    cache = SQLiteResponseCache(str(tmp_path / "cache.db"))
+    key = cache.key("teacher", "Why?", GREEDY)
+    assert cache.get(key) is None
+    cache.put(key, ["Because."])
+    assert cache.get(key) == ["Because."]
+    assert cache.stats() == {"hits": 1, "misses": 1, "uncached": 0, "hit_rate": 0.5}
+
+    # Entries outlive the cache that stored them
+    cache.close()
+    reopened = SQLiteResponseCache(str(tmp_path / "cache.db"))
+    assert reopened.get(reopened.key("teacher", "Why?", GREEDY)) == ["Because."]
+
+
+def test_keys_cover_the_request(tmp_path):
+    cache = SQLiteResponseCache(str(tmp_path / "cache.db"))
+    key = cache.key("teacher", "Why?", GREEDY)
+    # Equivalent generation arguments share a key
+    assert cache.key("teacher", "Why?", {**GREEDY, "temperature": 0}) == key
+    assert cache.key("teacher", "Why?", {**GREEDY, "stop": None}) == key
+    assert cache.key("teacher", "Why not?", GREEDY) != key
+    assert cache.key("student", "Why?", GREEDY) != key
+    assert cache.key("teacher", "Why?", {**GREEDY, "n": 3}) != key
+    assert cache.key("teacher", [{"role": "user", "content": "Why?"}], GREEDY) != key
+
+
+def test_sampled_requests_need_opt_in(tmp_path):
+    cache = SQLiteResponseCache(str(tmp_path / "cache.db"))
+    key = cache.key("teacher", "Why?", SAMPLED)
+    assert key is None
+    cache.put(key, ["Because.", "Just because."])
+    assert cache.get(key) is None
+    assert cache.stats()["uncached"] == 1
+
+
+def test_sampled_requests_replay_in_order(tmp_path):
+    """Identical sampled requests of a run get different completions, which a
+    rerun gets back in the same order
+    """
+    cache = SQLiteResponseCache(str(tmp_path / "cache.db"), reuse_sampled=True)
+    first, second = (cache.key("teacher", "Why?", SAMPLED) for _ in range(2))
+    assert first != second
+    cache.put(first, ["a", "b"])
+    cache.put(second, ["c", "d"])
+
+    rerun = SQLiteResponseCache(str(tmp_path / "cache.db"), reuse_sampled=True)
+    assert [rerun.get(rerun.key("teacher", "Why?", SAMPLED)) for _ in range(3)] == [
+        ["a", "b"],
+        ["c", "d"],
+        None,
+    ]
+
+
+def test_sampled_keys_do_not_depend_on_batch_order(tmp_path):
+    """Batches sent concurrently get the same keys whichever is sent first"""
+    batches = [["Why?", "How?", "Why?"], ["Why?", "When?"]]
+    cache = SQLiteResponseCache(str(tmp_path / "cache.db"), reuse_sampled=True)
+    keys = [cache.keys("teacher", batch, SAMPLED) for batch in batches]
+    rerun = SQLiteResponseCache(str(tmp_path / "cache.db"), reuse_sampled=True)
+    assert [rerun.keys("teacher", batch, SAMPLED) for batch in batches[::-1]] == (
+        keys[::-1]
+    )
+    # Identical requests of a batch, and identical batches, differ
+    assert keys[0][0] != keys[0][2]
+    assert keys[1][0] not in keys[0]
+    assert cache.keys("teacher", batches[0], SAMPLED) != keys[0]
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    # Room for two entries of ["xxxx"], which take 8 bytes each
+    cache = SQLiteResponseCache(str(tmp_path / "cache.db"), max_size=20)
+    keys = [cache.key("teacher", prompt, GREEDY) for prompt in ("a", "b", "c")]
+    cache.put(keys[0], ["xxxx"])
+    cache.put(keys[1], ["xxxx"])
+    # Using the first one makes the second the least recently used
+    assert cache.get(keys[0]) == ["xxxx"]
+    cache.put(keys[2], ["xxxx"])
+    assert cache.get(keys[0]) == ["xxxx"]
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[2]) == ["xxxx"]
+
+
+def test_response_cache_needs_storage():
+    with pytest.raises(TypeError):
+        ResponseCache()  # pylint: disable=abstract-class-instantiated
@@ -6,6 +6,7 @@ import unittest
 
 # Third Party
 from datasets import Dataset, Features, Value
+import pytest
 
 # First Party
 from src.instructlab.sdg import (
@@ -14,6 +15,7 @@ from src.instructlab.sdg import (
     RenameColumnsBlock,
     SetToMajorityValueBlock,
 )
+from src.instructlab.sdg.blocks.utilblocks import ColumnTransformBlock
 
 
 class TestUtilBlock(unittest.TestCase):
@@ -101,3 +103,11 @@ class TestUtilBlock(unittest.TestCase):
         }
 
         assert new_samples.to_dict() == new_data_dict
+
+
+def test_column_transform_needs_transform_table():
+    class NoTransform(ColumnTransformBlock):
+        pass
+
+    with pytest.raises(TypeError):
+        NoTransform(MagicMock(), MagicMock(), "no_transform")
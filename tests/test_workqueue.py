@@ -0,0 +1,169 @@
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Unit tests for sharing the work of a pipeline between workers through a
+directory
+"""
+
+# Standard
+import os
+import threading
+import time
+
+# Third Party
+import pytest
+
+# First Party
+from instructlab.sdg import GenerateException, WorkQueue
+from instructlab.sdg.utils.json import jlload
+from instructlab.sdg.workqueue import batch_shard_size
+
+INPUTS = {"a.jsonl": list(range(7)), "b.jsonl": list(range(100, 103))}
+
+
+def _plan(queue_dir, worker_id, shard_size=2, lease_timeout=60.0):
+    queue = WorkQueue(str(queue_dir), worker_id, lease_timeout=lease_timeout)
+    queue.plan([(name, len(rows)) for name, rows in INPUTS.items()], shard_size)
+    return queue
+
+
+def _process(shard):
+    return [{"n": n * 2} for n in INPUTS[shard.input_name][shard.start : shard.end]]
+
+
+def test_plan_splits_inputs_into_shards(tmp_path):
+    queue = _plan(tmp_path, "one", shard_size=3)
+    assert [(s.input_name, s.start, s.end) for s in queue.shards()] == [
+        ("a.jsonl", 0, 3),
+        ("a.jsonl", 3, 6),
+        ("a.jsonl", 6, 7),
+        ("b.jsonl", 0, 3),
+    ]
+    # Another worker planning the same inputs shares the plan
+    assert _plan(tmp_path, "two", shard_size=3).shards() == queue.shards()
+    with pytest.raises(GenerateException):
+        _plan(tmp_path, "three", shard_size=2)
+
+
+def test_shard_size_is_whole_batches():
+    assert batch_shard_size(100, 8) == 104
+    assert batch_shard_size(96, 8) == 96
+    assert batch_shard_size(3, 8) == 8
+    assert batch_shard_size(100, None) == 100
+
+
+def test_workers_share_the_shards(tmp_path):
+    processed = {}
+
+    def worker(worker_id):
+        queue = _plan(tmp_path, worker_id)
+
+        def process(shard):
+            # Give the other worker a chance to claim the next shard
+            time.sleep(0.01)
+            return _process(shard)
+
+        processed[worker_id] = queue.run(process)
+
+    threads = [threading.Thread(target=worker, args=(w,)) for w in ("one", "two")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    queue = WorkQueue(str(tmp_path))
+    assert sum(processed.values()) == len(queue.shards()) == 6
+    assert not queue.pending()
+    assert queue.merge(str(tmp_path / "merged")) == [
+        str(tmp_path / "merged" / name) for name in INPUTS
+    ]
+    # The merged outputs are what processing the whole inputs gives
+    for name, rows in INPUTS.items():
+        assert jlload(str(tmp_path / "merged" / name)) == [{"n": n * 2} for n in rows]
+
+
+def test_claimed_shards_are_not_claimed_again(tmp_path):
+    one = _plan(tmp_path, "one")
+    two = _plan(tmp_path, "two")
+    first = one.claim()
+    second = two.claim()
+    assert first.shard_id == "a.jsonl.00000"
+    assert second.shard_id == "a.jsonl.00001"
+    one.release(first)
+    assert two.claim() == first
+
+
+def test_expired_claims_are_taken_over(tmp_path):
+    one = _plan(tmp_path, "one", lease_timeout=0.2)
+    two = _plan(tmp_path, "two", lease_timeout=0.2)
+    shard = one.claim()
+    # The claim is still fresh
+    assert two.claim() != shard
+    time.sleep(0.3)
+    assert two.claim() == shard
+
+
+def test_claims_are_renewed_while_processing(tmp_path):
+    one, two = (
+        WorkQueue(str(tmp_path), worker_id, lease_timeout=0.2)
+        for worker_id in ("one", "two")
+    )
+    one.plan([("a.jsonl", 7)], 10)
+    stolen = []
+
+    def process(shard):
+        time.sleep(0.4)
+        stolen.append(two.claim())
+        return _process(shard)
+
+    assert one.run(process) == 1
+    assert stolen == [None]
+
+
+def test_failed_shards_are_released(tmp_path):
+    queue = _plan(tmp_path, "one")
+
+    def process(shard):
+        raise ValueError(shard.shard_id)
+
+    with pytest.raises(ValueError):
+        queue.run(process)
+    assert queue.claim().shard_id == "a.jsonl.00000"
+
+
+def test_merge_needs_every_shard(tmp_path):
+    queue = _plan(tmp_path, "one")
+    shard = queue.claim()
+    queue.complete(shard, _process(shard))
+    with pytest.raises(GenerateException, match="a.jsonl.00001"):
+        queue.merge_input("a.jsonl", str(tmp_path / "a.jsonl"))
+
+
+def test_merge_checkpoints_and_skip_empty(tmp_path):
+    queue = _plan(tmp_path, "one")
+    while (shard := queue.claim()) is not None:
+        rows = _process(shard) if shard.input_name == "a.jsonl" else []
+        checkpoint_dir = os.path.join(queue.checkpoint_dir, shard.shard_id)
+        os.makedirs(checkpoint_dir)
+        with open(
+            os.path.join(checkpoint_dir, f"data_checkpoint_{shard.index}.jsonl"),
+            "w",
+            encoding="utf-8",
+        ) as f:
+            f.write("{}\n")
+        queue.complete(shard, rows)
+
+    output_files = queue.merge(
+        str(tmp_path / "merged"), str(tmp_path / "checkpoints"), skip_empty=True
+    )
+    assert output_files == [str(tmp_path / "merged" / "a.jsonl")]
+    assert sorted(os.listdir(tmp_path / "checkpoints" / "a")) == [
+        "data_checkpoint_0.jsonl",
+        "data_checkpoint_1.jsonl",
+        "data_checkpoint_2.jsonl",
+        "data_checkpoint_3.jsonl",
+    ]
+    assert sorted(os.listdir(tmp_path / "checkpoints" / "b")) == [
+        "data_checkpoint_0.jsonl",
+        "data_checkpoint_1.jsonl",
+    ]
@@ -0,0 +1,47 @@
+"""Import-time benchmark for instructlab.sdg
+
+Measures, in fresh interpreters, how long the common ways of importing the
+package take. Run it directly:
+
+    python tests/testdata/importtime.py [--runs N]
+"""
+
+# Standard
+import argparse
+import subprocess
+import sys
+import time
+
+STATEMENTS = {
+    "package": "import instructlab.sdg",
+    "pipeline": "from instructlab.sdg import LLMBlock, Pipeline, PipelineContext",
+    "generate_data": "from instructlab.sdg import generate_data",
+}
+
+
+def import_time(statement: str, runs: int) -> float:
+    """The best wall-clock time of running statement in a new interpreter,
+    minus the startup time of the interpreter itself
+    """
+
+    def best(code):
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.check_call([sys.executable, "-c", code])
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    return best(statement) - best("pass")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+    for name, statement in STATEMENTS.items():
+        print(f"{name:<15} {import_time(statement, args.runs):.3f}s  {statement}")
+
+
+if __name__ == "__main__":
+    main()
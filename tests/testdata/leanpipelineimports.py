@@ -0,0 +1,31 @@
+"""Helper for test_sdg_pipeline_imports"""
+
+# Standard
+import sys
+
+# block the packages that only generate_data needs
+for unwanted in [
+    "deepspeed",
+    "docling",
+    "git",
+    "h5py",
+    "instructlab.schema",
+    "llama_cpp",
+    "torch",
+    "transformers",
+    "vllm",
+    "xdg_base_dirs",
+]:
+    # importlib raises ModuleNotFound when sys.modules value is None.
+    assert unwanted not in sys.modules
+    sys.modules[unwanted] = None  # type: ignore[assignment]
+
+# First Party
+# This will trigger errors if any of the import chain tries to load
+# the unwanted modules
+from instructlab.sdg import LLMBlock, Pipeline, PipelineContext
+from instructlab.sdg.pipeline import _lookup_block_type
+
+# The built-in blocks are still found by name
+for block_type in ["FilterByValueBlock", "IterBlock", "LLMBlock"]:
+    _lookup_block_type(block_type)